@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Compare polling throughput of the blocking and asynchronous clients.
+
+Runs against a local stand-in server which delays every response, to make
+the cost of waiting on the network visible::
+
+    bin/python benchmarks/async_client.py [requests] [delay] [workers]
+"""
+
+from threading import Thread
+import sys
+import time
+
+from queuey_py import AsyncClient
+from queuey_py import Client
+from standin import StandinServer
+
+APP_KEY = u'67e8107559e34fa48f91a746e775a751'
+
+
+def bench_sequential(url, queue_name, requests):
+    client = Client(APP_KEY, connection=url)
+    for i in xrange(requests):
+        client.messages(queue_name)
+
+
+def bench_threads(url, queue_name, requests, workers):
+    # the way consumers work today, one client and one thread per poller
+    def poll(count):
+        client = Client(APP_KEY, connection=url)
+        for i in xrange(count):
+            client.messages(queue_name)
+    threads = [Thread(target=poll, args=(requests // workers, ))
+        for i in xrange(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def bench_async(url, queue_name, requests, workers):
+    with AsyncClient(APP_KEY, connection=url, workers=workers) as client:
+        futures = [client.messages(queue_name) for i in xrange(requests)]
+        for f in futures:
+            f.result()
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    server = StandinServer(delay=delay).start()
+    try:
+        client = Client(APP_KEY, connection=server.url)
+        queue_name = client.create_queue()
+        client.post(queue_name, data=[u'message %s' % i for i in range(100)])
+        runs = [
+            (u'sequential Client', bench_sequential, ()),
+            (u'%s threads, one Client each' % workers, bench_threads,
+                (workers, )),
+            (u'AsyncClient, %s workers' % workers, bench_async,
+                (workers, )),
+        ]
+        print(u'%s requests, %.3fs server delay' % (requests, delay))
+        for name, func, args in runs:
+            start = time.time()
+            func(server.url, queue_name, requests, *args)
+            duration = time.time() - start
+            print(u'%-32s %8.1f requests/s' % (name, requests / duration))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
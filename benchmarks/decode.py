@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Compare decoding a page of messages via `response.text` with decoding
+the raw response bytes::
+
+    bin/python benchmarks/decode.py [messages] [body size] [rounds]
+"""
+
+import sys
+import time
+import uuid
+
+from requests.models import Response
+import ujson
+
+from queuey_py.client import _decode
+
+
+def make_page(messages, size):
+    result = []
+    for i in xrange(messages):
+        message_id = uuid.uuid1().hex
+        result.append({
+            u'message_id': message_id,
+            u'timestamp': time.time(),
+            u'partition': 1,
+            u'body': u'\xfc' * (size // 2) + u'x' * (size - size // 2),
+            u'metadata': {},
+        })
+    return ujson.encode({u'status': u'ok', u'messages': result})
+
+
+def make_response(content):
+    response = Response()
+    response.status_code = 200
+    response.headers = {'content-type': 'application/json'}
+    response._content = content
+    response._content_consumed = True
+    return response
+
+
+def decode_text(response):
+    return ujson.decode(response.text)
+
+
+def bench(func, content, rounds):
+    responses = [make_response(content) for i in xrange(rounds)]
+    start = time.clock()
+    for response in responses:
+        func(response)
+    return (time.clock() - start) / rounds
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    content = make_page(messages, size)
+    assert decode_text(make_response(content)) == \
+        _decode(make_response(content))
+    text = make_response(content).text
+    print(u'%s messages, %s bytes per page' % (messages, len(content)))
+    print(u'unicode copy avoided per page: %s bytes' % sys.getsizeof(text))
+    timings = [
+        (u'response.text', bench(decode_text, content, rounds)),
+        (u'raw bytes', bench(_decode, content, rounds)),
+    ]
+    for name, duration in timings:
+        print(u'%-16s %10.3f ms CPU per page' % (name, duration * 1000))
+    print(u'speedup: %.1fx' % (timings[0][1] / timings[1][1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""A minimal in-memory stand-in for the :term:`Queuey` HTTP API.
+
+Only implements as much of the API as the benchmarks need. Messages are
+kept in memory and each request can be delayed by a fixed amount of time
+to simulate network and server latency.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import current_thread
+from threading import Lock
+from threading import Thread
+from urlparse import parse_qs
+from urlparse import urlsplit
+import socket
+import time
+import urllib
+import uuid
+
+import ujson
+
+PREFIX = u'/v1/queuey/'
+
+
+def _message_time(message_id):
+    return (uuid.UUID(message_id).time - 0x01b21dd213814000L) / 1e7
+
+
+class StandinQueuey(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.queues = {}
+
+    def create(self, queue_name, partitions):
+        with self.lock:
+            self.queues[queue_name] = dict(
+                (p, []) for p in range(1, partitions + 1))
+
+    def add(self, queue_name, partition, body, message_id=None):
+        message_id = message_id or uuid.uuid1().hex
+        message = {
+            u'message_id': message_id,
+            u'timestamp': _message_time(message_id),
+            u'partition': partition,
+            u'body': body,
+            u'metadata': {},
+        }
+        with self.lock:
+            messages = self.queues[queue_name][partition]
+            messages[:] = [m for m in messages
+                if m[u'message_id'] != message_id]
+            messages.append(message)
+            messages.sort(key=lambda m: m[u'timestamp'])
+        return message
+
+    def fetch(self, queue_name, partitions, since, limit, order):
+        with self.lock:
+            result = []
+            for p in partitions:
+                result.extend(self.queues[queue_name].get(p, []))
+        if since:
+            # accept both plain message ids and partition prefixed keys
+            since = since.split(u':')[-1]
+            # like Queuey, include the since message itself
+            since_time = uuid.UUID(since).time
+            result = [m for m in result
+                if uuid.UUID(m[u'message_id']).time >= since_time]
+        result.sort(key=lambda m: uuid.UUID(m[u'message_id']).time,
+            reverse=(order == u'descending'))
+        return result[:limit]
+
+    def remove(self, queue_name, keys):
+        with self.lock:
+            for key in keys:
+                partition, message_id = key.split(u':', 1)
+                messages = self.queues[queue_name].get(int(partition), [])
+                messages[:] = [m for m in messages
+                    if m[u'message_id'] != message_id]
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # buffer the whole response and send it in one go
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, data=None):
+        body = ujson.encode(data) if data is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _parse(self):
+        time.sleep(self.server.delay)
+        parts = urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(parts.query).items())
+        path = urllib.unquote(parts.path)
+        if not path.startswith(PREFIX):
+            return None, None, query
+        names = path[len(PREFIX):].strip(u'/').split(u'/')
+        queue_name = names[0] or None
+        rest = names[1] if len(names) > 1 else None
+        return queue_name, rest, query
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def do_HEAD(self):
+        time.sleep(self.server.delay)
+        self._reply(200)
+
+    def do_GET(self):
+        queue_name, rest, query = self._parse()
+        store = self.server.store
+        if queue_name is None:
+            names = sorted(store.queues.keys())
+            # pages start at the queue named by the offset, like Queuey
+            offset = query.get('offset')
+            if offset:
+                names = [n for n in names if n >= offset]
+            names = names[:int(query.get('limit', 100))]
+            if query.get('details'):
+                names = [{u'queue_name': n,
+                          u'partitions': len(store.queues[n])}
+                    for n in names]
+            return self._reply(200, {u'status': u'ok', u'queues': names})
+        if queue_name not in store.queues:
+            return self._reply(404, {u'status': u'error'})
+        order = query.get('order', u'ascending')
+        if order not in (u'ascending', u'descending'):
+            return self._reply(400, {u'status': u'error',
+                u'error_msg': {u'order': u'Invalid order'}})
+        partitions = [int(p) for p in
+            query.get('partitions', u'1').split(u',')]
+        messages = store.fetch(queue_name, partitions, query.get('since'),
+            int(query.get('limit', 100)), order)
+        self._reply(200, {u'status': u'ok', u'messages': messages})
+
+    def do_POST(self):
+        queue_name, rest, query = self._parse()
+        store = self.server.store
+        body = self._body()
+        if queue_name is None:
+            form = dict((k, v[0]) for k, v in parse_qs(body).items())
+            partitions = int(form.get('partitions', 1))
+            if partitions < 1:
+                return self._reply(400, {u'status': u'error'})
+            queue_name = form.get('queue_name') or uuid.uuid4().hex
+            store.create(queue_name, partitions)
+            return self._reply(201, {u'status': u'ok',
+                u'queue_name': queue_name, u'partitions': partitions})
+        if queue_name not in store.queues:
+            return self._reply(404, {u'status': u'error'})
+        if 'json' in (self.headers.get('Content-Type') or ''):
+            batch = ujson.decode(body)[u'messages']
+        else:
+            batch = [{u'body': body.decode('utf-8')}]
+        result = []
+        for m in batch:
+            partition = int(m.get(u'partition', 1))
+            message = store.add(queue_name, partition, m[u'body'])
+            result.append({
+                u'key': u'%s:%s' % (partition, message[u'message_id']),
+                u'partition': partition,
+                u'timestamp': message[u'timestamp'],
+            })
+        self._reply(201, {u'status': u'ok', u'messages': result})
+
+    def do_PUT(self):
+        queue_name, rest, query = self._parse()
+        store = self.server.store
+        if queue_name not in store.queues or not rest:
+            return self._reply(404, {u'status': u'error'})
+        partition, message_id = rest.split(u':', 1)
+        store.add(queue_name, int(partition),
+            self._body().decode('utf-8'), message_id=message_id)
+        self._reply(200, {u'status': u'ok'})
+
+    def do_DELETE(self):
+        queue_name, rest, query = self._parse()
+        store = self.server.store
+        if queue_name not in store.queues:
+            return self._reply(404, {u'status': u'error'})
+        if rest:
+            store.remove(queue_name, rest.split(u','))
+        else:
+            with store.lock:
+                del store.queues[queue_name]
+        self._reply(200, {u'status': u'ok'})
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port=0, delay=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.store = StandinQueuey()
+        self.delay = delay
+        self._thread = None
+        self._requests = {}
+        self._requests_lock = Lock()
+
+    @property
+    def url(self):
+        return u'http://127.0.0.1:%s%s' % (self.server_address[1], PREFIX)
+
+    def handle_error(self, request, client_address):
+        # clients going away while the benchmarks shut down
+        pass
+
+    def process_request(self, request, client_address):
+        # keep track of the handler threads, to stop them in stop
+        thread = Thread(target=self._handle,
+            args=(request, client_address))
+        thread.daemon = True
+        with self._requests_lock:
+            self._requests[thread] = request
+        thread.start()
+
+    def _handle(self, request, client_address):
+        try:
+            self.process_request_thread(request, client_address)
+        finally:
+            with self._requests_lock:
+                self._requests.pop(current_thread(), None)
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+        # handlers wait for further requests on keep-alive connections
+        with self._requests_lock:
+            requests = self._requests.items()
+        for thread, request in requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for thread, request in requests:
+            thread.join()
@@ -3,7 +3,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from queuey_py.asyncclient import AsyncClient
 from queuey_py.client import Client
 from queuey_py.client import HTTPError
+from queuey_py.consumer import Consumer
+from queuey_py.producer import Producer
 
-__all__ = (Client, HTTPError)
+__all__ = (AsyncClient, Client, Consumer, HTTPError, Producer)
@@ -0,0 +1,142 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from concurrent.futures import ThreadPoolExecutor
+
+from queuey_py.client import Client
+from queuey_py.client import DEFAULT_TTL
+
+
+class AsyncClient(object):
+    """Represents a non-blocking connection to a :term:`Queuey` server or
+    cluster.
+
+    Offers the same methods as :py:class:`queuey_py.client.Client`, but
+    each of them returns immediately with a
+    :py:class:`concurrent.futures.Future`. Requests are run by a pool of
+    worker threads sharing one :py:class:`~queuey_py.client.Client`, so
+    retries and fall back to alternate servers work just the same. The
+    client keeps one keep-alive connection per worker open to each server.
+
+    :param app_key: The applications key used for authorization
+    :type app_key: str
+    :param connection: Connection information for the Queuey server.
+        Either a single full URL to the Queuey app or multiple comma
+        separated URLs.
+    :type connection: str
+    :param retries: Number of retries on connection timeouts, defaults to 3.
+    :type retries: int
+    :param timeout: Connection timeout in seconds, defaults to 5.0.
+    :type timeout: float
+    :param workers: Maximum number of requests in flight, defaults to 20.
+    :type workers: int
+
+    Further keyword arguments are passed on to the
+    :py:class:`~queuey_py.client.Client`.
+    """
+
+    def __init__(self, app_key,
+                 connection=u'https://127.0.0.1:5001/v1/queuey/',
+                 retries=3, timeout=5.0, workers=20, **kwargs):
+        kwargs.setdefault('pool_maxsize', workers)
+        self.client = Client(app_key, connection=connection,
+            retries=retries, timeout=timeout, **kwargs)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Wait for all pending requests and stop the worker threads."""
+        self.executor.shutdown(wait=True)
+
+    def connect(self):
+        """Asynchronous version of
+        :py:meth:`queuey_py.client.Client.connect`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.connect)
+
+    def get(self, url='', params=None):
+        """Asynchronous version of :py:meth:`queuey_py.client.Client.get`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.get, url, params=params)
+
+    def post(self, url='', params=None, data='', headers=None):
+        """Asynchronous version of :py:meth:`queuey_py.client.Client.post`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.post, url, params=params,
+            data=data, headers=headers)
+
+    def put(self, url='', params=None, data='', headers=None):
+        """Asynchronous version of :py:meth:`queuey_py.client.Client.put`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.put, url, params=params,
+            data=data, headers=headers)
+
+    def delete(self, url='', params=None):
+        """Asynchronous version of
+        :py:meth:`queuey_py.client.Client.delete`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.delete, url, params=params)
+
+    def create_queue(self, partitions=1, queue_name=None):
+        """Asynchronous version of
+        :py:meth:`queuey_py.client.Client.create_queue`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.create_queue,
+            partitions=partitions, queue_name=queue_name)
+
+    def messages(self, queue_name, partition=1, since=None, limit=100,
+                 order='ascending'):
+        """Asynchronous version of
+        :py:meth:`queuey_py.client.Client.messages`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.messages, queue_name,
+            partition=partition, since=since, limit=limit, order=order)
+
+    def post_messages(self, queue_name, messages, ttl=DEFAULT_TTL,
+                      max_messages=1000, max_bytes=1048576):
+        """Asynchronous version of
+        :py:meth:`queuey_py.client.Client.post_messages`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.post_messages, queue_name,
+            messages, ttl=ttl, max_messages=max_messages, max_bytes=max_bytes)
+
+    def delete_messages(self, queue_name, keys, max_url_length=4096):
+        """Asynchronous version of
+        :py:meth:`queuey_py.client.Client.delete_messages`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.delete_messages, queue_name,
+            keys, max_url_length=max_url_length)
+
+    def update_messages(self, queue_name, messages, concurrency=None):
+        """Asynchronous version of
+        :py:meth:`queuey_py.client.Client.update_messages`.
+
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(self.client.update_messages, queue_name,
+            messages, concurrency=concurrency)
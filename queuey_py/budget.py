@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from threading import Lock
+import time
+
+
+class RetryBudget(object):
+    """A token bucket limiting retries to a share of all requests.
+
+    Every request adds `ratio` tokens to the bucket and every retry takes
+    one out. In addition `min_per_second` tokens are added each second,
+    so a client making few requests can still retry. Once the bucket is
+    empty, failing requests aren't retried anymore, which keeps retries
+    from multiplying the load on already overloaded servers.
+
+    A single budget can be shared between multiple clients.
+
+    :param ratio: Allowed retries per request, defaults to 0.2.
+    :type ratio: float
+    :param min_per_second: Retries allowed per second regardless of the
+        number of requests, defaults to 1.0.
+    :type min_per_second: float
+    :param capacity: Maximum number of tokens in the bucket, defaults
+        to 10.
+    :type capacity: float
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, capacity=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.requests = 0
+        self.retries = 0
+        self.exhausted = 0
+        self._updated = time.time()
+        self._lock = Lock()
+
+    def _refill(self, tokens):
+        now = time.time()
+        tokens += (now - self._updated) * self.min_per_second
+        self._updated = now
+        self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def deposit(self):
+        """Account for a new request."""
+        with self._lock:
+            self.requests += 1
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        """Ask for permission to retry a request.
+
+        :rtype: bool
+        """
+        with self._lock:
+            self._refill(0.0)
+            if self.tokens < 1.0:
+                self.exhausted += 1
+                return False
+            self.tokens -= 1.0
+            self.retries += 1
+            return True
+
+    def stats(self):
+        """Return the number of requests, retries, retries denied due to
+        an exhausted budget and the currently available tokens.
+
+        :rtype: dict
+        """
+        with self._lock:
+            self._refill(0.0)
+            return {
+                u'requests': self.requests,
+                u'retries': self.retries,
+                u'exhausted': self.exhausted,
+                u'tokens': self.tokens,
+            }
@@ -0,0 +1,258 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from threading import Lock
+from uuid import UUID
+import mmap
+import os
+import sqlite3
+import struct
+import time
+
+from queuey_py.client import _message_id
+
+# used flag, queue name, partition, message id
+RECORD = struct.Struct('<B127sI16s')
+
+
+class MemoryBackend(object):
+    """Keeps checkpoints in memory, for tests and short lived consumers."""
+
+    def __init__(self):
+        self.checkpoints = {}
+
+    def load(self, queue_name, partition):
+        return self.checkpoints.get((queue_name, partition))
+
+    def save(self, checkpoints):
+        self.checkpoints.update(checkpoints)
+
+    def close(self):
+        pass
+
+
+class FileBackend(object):
+    """Keeps checkpoints in a file of fixed-size records, mapped into
+    memory.
+
+    Each (queue, partition) pair has its own record, which is overwritten
+    in place. A commit only touches the changed records and syncs them with
+    a single `msync`. Queue names can be up to 127 bytes long in UTF-8.
+
+    :param path: Path of the checkpoint file, created if it doesn't exist
+        yet.
+    :type path: str
+    :param slots: Number of records the file initially has room for,
+        defaults to 1024. The file grows as needed.
+    :type slots: int
+    """
+
+    def __init__(self, path, slots=1024):
+        self.path = path
+        self._file = open(path, 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+        if size < RECORD.size:
+            size = max(slots, 1) * RECORD.size
+            self._file.truncate(size)
+        self._map(size)
+        self._index = {}
+        for slot in xrange(size // RECORD.size):
+            used, name, partition, message_id = RECORD.unpack_from(
+                self._mmap, slot * RECORD.size)
+            if not used:
+                break
+            name = name.rstrip('\x00').decode('utf-8')
+            self._index[(name, partition)] = slot
+        self._count = len(self._index)
+
+    def _map(self, size):
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._slots = size // RECORD.size
+
+    def _grow(self):
+        self._mmap.flush()
+        self._mmap.close()
+        size = self._slots * 2 * RECORD.size
+        self._file.truncate(size)
+        self._map(size)
+
+    def load(self, queue_name, partition):
+        slot = self._index.get((queue_name, partition))
+        if slot is None:
+            return None
+        message_id = RECORD.unpack_from(self._mmap, slot * RECORD.size)[3]
+        return UUID(bytes=message_id).hex
+
+    def save(self, checkpoints):
+        for (queue_name, partition), message_id in checkpoints.items():
+            name = queue_name.encode('utf-8')
+            if len(name) > 127:
+                raise ValueError(u'Queue name too long: %s' % queue_name)
+            slot = self._index.get((queue_name, partition))
+            if slot is None:
+                if self._count >= self._slots:
+                    self._grow()
+                slot = self._count
+                self._count += 1
+                self._index[(queue_name, partition)] = slot
+            RECORD.pack_into(self._mmap, slot * RECORD.size, 1, name,
+                partition, UUID(message_id).bytes)
+        self._mmap.flush()
+
+    def close(self):
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
+
+
+class SQLiteBackend(object):
+    """Keeps checkpoints in a SQLite database, writing each commit in a
+    single transaction.
+
+    :param path: Path of the database file.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(u'CREATE TABLE IF NOT EXISTS checkpoints ('
+                u'queue_name TEXT, partition INTEGER, message_id TEXT, '
+                u'PRIMARY KEY (queue_name, partition))')
+
+    def load(self, queue_name, partition):
+        row = self._db.execute(u'SELECT message_id FROM checkpoints '
+            u'WHERE queue_name = ? AND partition = ?',
+            (queue_name, partition)).fetchone()
+        return row and row[0] or None
+
+    def save(self, checkpoints):
+        with self._db:
+            self._db.executemany(u'INSERT OR REPLACE INTO checkpoints '
+                u'(queue_name, partition, message_id) VALUES (?, ?, ?)',
+                [(q, p, m) for (q, p), m in checkpoints.items()])
+
+    def close(self):
+        self._db.close()
+
+
+class CheckpointStore(object):
+    """Remembers the last processed message of each queue partition.
+
+    Updates are collected in memory and committed to the backend once
+    `every` updates have been made or `interval` seconds have passed since
+    the last commit, as well as on :py:meth:`commit` and :py:meth:`close`.
+    After a crash, consumers resume at the last committed message, so
+    messages processed since then are delivered again.
+
+    Pass a store as `checkpoints` to
+    :py:meth:`queuey_py.client.Client.iter_messages` or
+    :py:meth:`queuey_py.client.Client.merge_messages` to resume from it and
+    update it automatically.
+
+    :param backend: Where to keep the checkpoints, defaults to a
+        :py:class:`MemoryBackend`. Also available are the
+        :py:class:`FileBackend` and the :py:class:`SQLiteBackend`.
+    :param every: Number of updates after which to commit, defaults to 100.
+    :type every: int
+    :param interval: Maximum number of seconds between commits, defaults to
+        1.0.
+    :type interval: float
+    """
+
+    def __init__(self, backend=None, every=100, interval=1.0):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.every = every
+        self.interval = interval
+        self.updates = 0
+        self.commits = 0
+        self._pending = {}
+        self._uncommitted = 0
+        self._committed = time.time()
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, queue_name, partition):
+        """Return the last processed message id of a partition.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partition: Partition number.
+        :type partition: int
+        :returns: The message id or `None` if there's no checkpoint.
+        :rtype: str
+        """
+        with self._lock:
+            message_id = self._pending.get((queue_name, partition))
+            if message_id is None:
+                message_id = self.backend.load(queue_name, partition)
+            return message_id
+
+    def cursors(self, queue_name, partitions):
+        """Return the checkpoints of multiple partitions, as cursors for
+        :py:meth:`queuey_py.client.Client.partition_messages`.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partitions: Partition numbers.
+        :type partitions: list
+        :rtype: dict
+        """
+        return dict((p, self.get(queue_name, p)) for p in partitions)
+
+    def update(self, queue_name, partition, message_id):
+        """Record a message as processed.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partition: Partition number.
+        :type partition: int
+        :param message_id: A message id or key.
+        :type message_id: str
+        """
+        with self._lock:
+            self._pending[(queue_name, partition)] = _message_id(message_id)
+            self.updates += 1
+            self._uncommitted += 1
+            if (self._uncommitted >= self.every or
+                time.time() - self._committed >= self.interval):
+                self._commit()
+
+    def _commit(self):
+        if self._pending:
+            self.backend.save(self._pending)
+            self._pending = {}
+            self.commits += 1
+        self._uncommitted = 0
+        self._committed = time.time()
+
+    def commit(self):
+        """Commit all pending updates to the backend."""
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        """Commit all pending updates and close the backend."""
+        with self._lock:
+            self._commit()
+            self.backend.close()
+
+    def stats(self):
+        """Return the number of updates, commits and pending checkpoints.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                u'updates': self.updates,
+                u'commits': self.commits,
+                u'pending': len(self._pending),
+            }
@@ -2,10 +2,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import partial
 from functools import wraps
+from hashlib import md5
+from heapq import merge
 from random import choice
+from random import uniform
+from threading import Lock
+from threading import Thread
+from urllib import quote_plus
+from urllib import urlencode
 from urlparse import urljoin
 from urlparse import urlsplit
+from uuid import UUID
+import os
+import struct
+import time
 
 from requests import exceptions
 from requests import session
@@ -15,35 +30,138 @@ from requests.exceptions import Timeout
 import ujson
 from ujson import decode as ujson_decode
 
+from queuey_py.budget import RetryBudget
+from queuey_py.pool import ServerPool
+from queuey_py.prefetch import Prefetcher
+from queuey_py.servers import CLOSED
+from queuey_py.servers import parse_server
+from queuey_py.servers import Server
+
+
+# default message time to live, three days
+DEFAULT_TTL = 259200
+
 
 def retry(func):
     @wraps(func)
     def wrapped(self, *args, **kwargs):
-        for n in range(self.retries):
+        self.retry_budget.deposit()
+        attempts = max(self.retries, 1)
+        for n in range(attempts):
             try:
                 return func(self, *args, **kwargs)
-            except Timeout:
-                pass
-        # raise timeout after all
-        raise
+            except Timeout, e:
+                if n + 1 == attempts or not self.retry_budget.withdraw():
+                    # raise timeout after all
+                    raise
+                if self.hooks:
+                    self._emit(u'on_retry', func.__name__, n + 1, e)
+            time.sleep(self._backoff(n))
     return wrapped
 
 
 def fallback(func):
     @wraps(func)
     def wrapped(self, *args, **kwargs):
+        self._check_pid()
+        if self.failed_urls:
+            self._recover_async()
+        app_url = self.app_url
         try:
             return func(self, *args, **kwargs)
-        except (SSLError, ConnectionError):
-            if self.fallback_urls:
-                self.failed_urls.append(self.app_url)
-                self.app_url = self.fallback_urls.pop()
+        except (SSLError, ConnectionError), e:
+            if self._fail_over(app_url):
+                if self.hooks:
+                    self._emit(u'on_fallback', func.__name__, app_url,
+                        self.app_url, e)
                 return func(self, *args, **kwargs)
             # raise connection error after all
             raise
     return wrapped
 
 
+def _decode(response):
+    # Queuey always sends UTF-8 encoded JSON without a charset. Decoding the
+    # raw bytes avoids the charset detection and the unicode copy of the
+    # whole body done by response.text
+    return ujson_decode(response.content)
+
+
+def _body_size(data):
+    # size of a request body, form values are sent url encoded
+    if not data:
+        return 0
+    if isinstance(data, dict):
+        data = urlencode(data)
+    return len(data)
+
+
+def _message_id(key):
+    # strip the partition prefix of a message key
+    return key.split(u':')[-1]
+
+
+def _timed(partition, messages):
+    # sortable tuples, counting up to keep messages of the same timestamp
+    # in their partition order
+    for n, m in enumerate(messages):
+        yield message_time(m[u'message_id']), partition, n, m
+
+
+def hash_partition(key, partitions):
+    """Map a routing key to one of a number of partitions.
+
+    Uses a jump consistent hash, so the mapping is stable across processes
+    and when the number of partitions grows from N to N + 1, only every
+    N + 1th key moves to another partition.
+
+    :param key: The routing key.
+    :type key: unicode
+    :param partitions: Number of partitions.
+    :type partitions: int
+    :returns: Partition number, starting at 1.
+    :rtype: int
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    h = struct.unpack('<Q', md5(key).digest()[:8])[0]
+    bucket, jump = -1, 0
+    while jump < partitions:
+        bucket = jump
+        h = (h * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * ((1 << 31) / float((h >> 33) + 1)))
+    return bucket + 1
+
+
+def _chunks(messages, max_messages, max_bytes):
+    # split a batch by count and encoded size, yielding (offset, chunk)
+    offset, chunk, size = 0, [], 0
+    for i, message in enumerate(messages):
+        length = len(ujson.encode(message)) + 1
+        if chunk and (len(chunk) >= max_messages or
+                      size + length > max_bytes):
+            yield offset, chunk
+            offset, chunk, size = i, [], 0
+        chunk.append(message)
+        size += length
+    if chunk:
+        yield offset, chunk
+
+
+def message_time(message_id):
+    """Return the time component of a message id or key.
+
+    Message ids are version 1 UUIDs. The time is given in 100-nanosecond
+    intervals since the start of the Gregorian calendar and can be used to
+    sort messages across partitions.
+
+    :param message_id: A message id or message key in `partition:id` form.
+    :type message_id: str
+    :rtype: int
+    """
+    return UUID(_message_id(message_id)).time
+
+
 class HTTPError(exceptions.HTTPError):
     """An HTTP error occurred.
 
@@ -52,6 +170,19 @@ class HTTPError(exceptions.HTTPError):
     """
 
 
+class BatchResult(list):
+    """The message keys of a batch, in the order the messages were given.
+
+    Keys of messages which couldn't be posted are `None`. For each failed
+    chunk, `errors` holds a tuple of the offset of its first message, the
+    number of messages in it and the exception raised.
+    """
+
+    def __init__(self, size):
+        list.__init__(self, [None] * size)
+        self.errors = []
+
+
 class Client(object):
     """Represents a connection to a :term:`Queuey` server or cluster.
 
@@ -59,51 +190,350 @@ class Client(object):
     :type app_key: str
     :param connection: Connection information for the Queuey server.
         Either a single full URL to the Queuey app or multiple comma
-        separated URLs.
+        separated URLs. Each URL can be followed by a relative weight for
+        the server, as in `https://10.0.0.1:5001/v1/queuey/;weight=2`.
     :type connection: str
     :param retries: Number of retries on connection timeouts, defaults to 3.
     :type retries: int
     :param timeout: Connection timeout in seconds, defaults to 5.0.
     :type timeout: float
+    :param pool_maxsize: Number of keep-alive connections kept open to each
+        server, defaults to 1. This is also the maximum number of concurrent
+        requests per server, further threads wait for a free connection.
+    :type pool_maxsize: int
+    :param reset_timeout: Seconds after which a failed server is probed
+        via its heartbeat url and put back into rotation once it responds,
+        defaults to 30.0.
+    :type reset_timeout: float
+    :param backoff: Base delay in seconds between retries, defaults to
+        0.05. The delay is doubled for each further retry and the actual
+        sleep time is chosen at random up to that delay.
+    :type backoff: float
+    :param max_backoff: Upper limit of the delay between retries in
+        seconds, defaults to 2.0.
+    :type max_backoff: float
+    :param retry_budget: Limits the share of retried requests, defaults to
+        a new :py:class:`queuey_py.budget.RetryBudget` for this client.
+    :type retry_budget: :py:class:`queuey_py.budget.RetryBudget`
+    :param hedge: Whether or not to hedge idempotent reads, defaults to
+        False. If a server takes longer than its 95th latency percentile to
+        answer a `connect`, `get` or `messages` call, the same request is
+        sent to the best fall back server and the first response wins.
+    :type hedge: bool
+    :param hooks: Instrumentation called around each request, retry and
+        fall back, see :py:class:`queuey_py.metrics.Hooks`.
+    :type hooks: list
+
+    A client can be used after `os.fork` or in :py:mod:`multiprocessing`
+    workers. On first use in a new process it opens new connections and
+    gets a new retry budget with the same settings. Pickling a client only
+    keeps its configuration, without the hooks.
     """
 
     def __init__(self, app_key,
                  connection=u'https://127.0.0.1:5001/v1/queuey/',
-                 retries=3, timeout=5.0):
+                 retries=3, timeout=5.0, pool_maxsize=1, reset_timeout=30.0,
+                 backoff=0.05, max_backoff=2.0, retry_budget=None,
+                 hedge=False, hooks=None):
         self.app_key = app_key
         self.retries = retries
         self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if retry_budget is None:
+            retry_budget = RetryBudget()
+        self.retry_budget = retry_budget
+        self.hedge = hedge
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.hooks = list(hooks or [])
+        self.pool_maxsize = pool_maxsize
+        self.reset_timeout = reset_timeout
         self.failed_urls = []
-        headers = {u'Authorization': u'Application %s' % app_key}
-        # Setting pool_maxsize to 1 ensures we re-use the same connection.
-        # requests/urllib3 will always create maxsize connections and then
-        # cycle through them one after the other
-        self.session = session(headers=headers, timeout=self.timeout,
-            config={u'pool_maxsize': 1, u'keep_alive': True}, prefetch=True)
+        self._connection_spec = connection
         self._configure_connection(connection)
+        self._partitions = {}
+        self._setup()
+
+    def _setup(self):
+        # per process state, rebuilt in child processes
+        self._pid = os.getpid()
+        self._servers_lock = Lock()
+        headers = {u'Authorization': u'Application %s' % self.app_key}
+        # requests/urllib3 cycles through all pooled connections of a server
+        # and opens throw-away ones if more requests than pool_maxsize run
+        # at the same time. The server pools below never let that happen.
+        config = {
+            u'pool_connections': max(10, len(self.connection)),
+            u'pool_maxsize': self.pool_maxsize,
+            u'keep_alive': True,
+        }
+        self.session = session(headers=headers, timeout=self.timeout,
+            config=config, prefetch=True)
+        self._pools = {}
+        self._pools_lock = Lock()
+        self._executor = None
+
+    def _check_pid(self):
+        # a forked child must not share the pooled sockets, locks and
+        # worker threads of its parent
+        if self._pid != os.getpid():
+            budget = self.retry_budget
+            self.retry_budget = RetryBudget(budget.ratio,
+                budget.min_per_second, budget.capacity)
+            for server in self.servers.values():
+                server.after_fork()
+            self._setup()
+
+    def __getstate__(self):
+        budget = self.retry_budget
+        return {
+            u'app_key': self.app_key,
+            u'connection': self._connection_spec,
+            u'retries': self.retries,
+            u'timeout': self.timeout,
+            u'pool_maxsize': self.pool_maxsize,
+            u'reset_timeout': self.reset_timeout,
+            u'backoff': self.backoff,
+            u'max_backoff': self.max_backoff,
+            u'retry_budget': (budget.ratio, budget.min_per_second,
+                budget.capacity),
+            u'hedge': self.hedge,
+        }
+
+    def __setstate__(self, state):
+        state = dict((str(k), v) for k, v in state.items())
+        state['retry_budget'] = RetryBudget(*state['retry_budget'])
+        self.__init__(**state)
 
     def _configure_connection(self, connection):
-        self.connection = [c.strip() for c in connection.split(',')]
+        self.servers = {}
+        self.connection = []
+        for spec in connection.split(','):
+            url, weight = parse_server(spec)
+            self.connection.append(url)
+            self.servers[url] = Server(url, weight=weight,
+                reset_timeout=self.reset_timeout)
         if len(self.connection) == 1:
             self.app_url = self.connection[0]
             self.fallback_urls = []
         else:
-            # choose random server, but prefer local ones
-            local = []
-            remote = []
-            for c in self.connection:
-                netloc = urlsplit(c).netloc
-                if netloc.startswith((u'127.0.0.', u'localhost', u'::1')):
-                    local.append(c)
-                else:
-                    remote.append(c)
-            all_servers = preferred = local + remote
-            if len(local) > 0:
-                preferred = local
+            # choose the best server, randomly among equals. Without any
+            # observed requests local servers are preferred
+            servers = [self.servers[c] for c in self.connection]
+            local = [s.url for s in servers if s.local]
+            remote = [s.url for s in servers if not s.local]
+            best = min([s.score() for s in servers])
+            preferred = [s.url for s in servers if s.score() == best]
             self.app_url = choice(preferred)
+            all_servers = local + remote
             all_servers.remove(self.app_url)
             self.fallback_urls = all_servers
 
+    def _rebalance(self):
+        # switch to the server with the lowest expected latency, keeping
+        # the remaining ones as fall backs, best last
+        with self._servers_lock:
+            candidates = [self.app_url] + self.fallback_urls[::-1]
+            ranked = sorted(candidates,
+                key=lambda url: self.servers[url].score())
+            self.app_url = ranked[0]
+            self.fallback_urls = ranked[:0:-1]
+
+    def _fail_over(self, app_url):
+        # take a failed server out of rotation, returns whether or not
+        # there is another server to retry the request on
+        with self._servers_lock:
+            if app_url != self.app_url:
+                # another thread already moved on
+                return True
+            if not self.fallback_urls:
+                return False
+            self.failed_urls.append(app_url)
+            self.app_url = self.fallback_urls.pop()
+            return True
+
+    def _backoff(self, attempt):
+        # exponential backoff with full jitter, spreads out the retries of
+        # many clients failing at the same time
+        return uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _heartbeat_url(self, app_url):
+        parts = urlsplit(app_url)
+        return parts.scheme + u'://' + parts.netloc + u'/__heartbeat__'
+
+    def _probe(self, app_url):
+        try:
+            response = self._request(app_url, u'head',
+                self._heartbeat_url(app_url), timeout=self.timeout)
+        except (SSLError, ConnectionError, Timeout):
+            # reopen the breaker, so the server is probed again later
+            self.servers[app_url].mark_failure()
+            return False
+        if not response.ok:
+            self.servers[app_url].mark_failure()
+            return False
+        with self._servers_lock:
+            if app_url in self.failed_urls:
+                self.failed_urls.remove(app_url)
+                self.fallback_urls.append(app_url)
+        self._rebalance()
+        return True
+
+    def _recover_async(self):
+        for app_url in list(self.failed_urls):
+            if self.servers[app_url].probe_due():
+                thread = Thread(target=self._probe, args=(app_url, ))
+                thread.daemon = True
+                thread.start()
+
+    def recover(self):
+        """Probe all failed servers whose circuit breaker is due to be
+        reset and put the responsive ones back into rotation.
+
+        This happens automatically in the background on every request, so
+        there is usually no need to call this method.
+
+        :returns: URLs of the recovered servers.
+        :rtype: list
+        """
+        recovered = []
+        for app_url in list(self.failed_urls):
+            if self.servers[app_url].probe_due() and self._probe(app_url):
+                recovered.append(app_url)
+        return recovered
+
+    def _pool(self, url):
+        parts = urlsplit(url)
+        server = parts.scheme + u'://' + parts.netloc
+        pool = self._pools.get(server)
+        if pool is None:
+            with self._pools_lock:
+                pool = self._pools.get(server)
+                if pool is None:
+                    pool = self._pools[server] = ServerPool(self.pool_maxsize)
+        return pool
+
+    def _emit(self, event, *args):
+        for hook in self.hooks:
+            getattr(hook, event)(*args)
+
+    def _request(self, app_url, method, url, **kwargs):
+        self._check_pid()
+        server = self.servers[app_url]
+        hooks = self.hooks
+        if hooks:
+            self._emit(u'before_request', app_url, method, url)
+        with self._pool(url).connection():
+            start = time.time()
+            try:
+                response = getattr(self.session, method)(url, **kwargs)
+            except (SSLError, ConnectionError), e:
+                server.record(error=True)
+                server.mark_failure()
+                if hooks:
+                    self._emit(u'on_error', app_url, method, e,
+                        time.time() - start)
+                raise
+            except Timeout, e:
+                server.record(error=True)
+                if hooks:
+                    self._emit(u'on_error', app_url, method, e,
+                        time.time() - start)
+                raise
+        latency = time.time() - start
+        server.record(latency, error=response.status_code >= 500)
+        if hooks:
+            self._emit(u'after_response', app_url, method, response,
+                latency, _body_size(kwargs.get(u'data')),
+                len(response.content))
+        if server.state != CLOSED:
+            server.mark_success()
+        if self.fallback_urls:
+            self._rebalance()
+        return response
+
+    def _get_executor(self):
+        # worker threads for requests running in the background
+        self._check_pid()
+        if self._executor is None:
+            with self._pools_lock:
+                if self._executor is None:
+                    workers = 2 * self.pool_maxsize * len(self.connection)
+                    self._executor = ThreadPoolExecutor(max(workers, 4))
+        return self._executor
+
+    def _hedged(self, app_url, method, make_url, **kwargs):
+        delay = self.servers[app_url].percentile(0.95)
+        backups = self.fallback_urls[-1:]
+        if delay is None or not backups:
+            return self._request(app_url, method, make_url(app_url), **kwargs)
+        executor = self._get_executor()
+        primary = executor.submit(self._request, app_url, method,
+            make_url(app_url), **kwargs)
+        done, pending = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        self.hedged += 1
+        backup_url = backups[0]
+        backup = executor.submit(self._request, backup_url, method,
+            make_url(backup_url), **kwargs)
+        pending = [primary, backup]
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        self.hedge_wins += 1
+                    return future.result()
+        # both failed, report the primary server's error
+        return primary.result()
+
+    def hedge_stats(self):
+        """Return the number of hedged requests and the number of times the
+        fall back server answered first.
+
+        :rtype: dict
+        """
+        return {u'hedged': self.hedged, u'backup_wins': self.hedge_wins}
+
+    def retry_stats(self):
+        """Return the retry budget statistics.
+
+        A dict with the number of requests, retries, retries denied because
+        the budget was exhausted and the currently available retry tokens.
+
+        :rtype: dict
+        """
+        return self.retry_budget.stats()
+
+    def server_stats(self):
+        """Return the observed performance of each configured server.
+
+        Each server URL maps to a dict with its weight, whether or not it is
+        considered local, the moving averages of its latency in seconds and
+        its error rate, the number of requests and failures and its
+        resulting score. The server with the lowest score is used.
+
+        :rtype: dict
+        """
+        return dict((url, server.stats())
+            for url, server in self.servers.items())
+
+    def pool_stats(self):
+        """Return connection pool statistics for each server used so far.
+
+        Each server, given as scheme and network location, maps to a dict
+        with the pool size, the number of connections in use, the number of
+        threads waiting for a connection, the number of requests made and
+        the total, maximum and average time spent waiting in seconds.
+
+        :rtype: dict
+        """
+        with self._pools_lock:
+            pools = self._pools.items()
+        return dict((server, pool.stats()) for server, pool in pools)
+
     @fallback
     @retry
     def connect(self):
@@ -112,9 +542,10 @@ class Client(object):
 
         :raises: :py:exc:`requests.exceptions.ConnectionError`
         """
-        parts = urlsplit(self.app_url)
-        url = parts.scheme + u'://' + parts.netloc + u'/__heartbeat__'
-        return self.session.head(url)
+        app_url = self.app_url
+        if self.hedge:
+            return self._hedged(app_url, u'head', self._heartbeat_url)
+        return self._request(app_url, u'head', self._heartbeat_url(app_url))
 
     @fallback
     @retry
@@ -128,8 +559,13 @@ class Client(object):
         :type params: dict
         :rtype: :py:class:`requests.models.Response`
         """
-        url = urljoin(self.app_url, url)
-        return self.session.get(url,
+        app_url = self.app_url
+        if self.hedge:
+            return self._hedged(app_url, u'get',
+                lambda base: urljoin(base, url),
+                params=params, timeout=self.timeout)
+        url = urljoin(app_url, url)
+        return self._request(app_url, u'get', url,
             params=params, timeout=self.timeout)
 
     @fallback
@@ -144,21 +580,28 @@ class Client(object):
         :type params: dict
         :param data: The body payload, either a string for a single message
             or a list of strings for posting multiple messages or a dict
-            for form encoded values.
+            for form encoded values. Instead of strings, the list can hold
+            dicts with a `body` and optionally a `ttl` and `partition`.
         :type data: str
         :param headers: Additional request headers.
         :type headers: dict
         :rtype: :py:class:`requests.models.Response`
         """
-        url = urljoin(self.app_url, url)
+        app_url = self.app_url
+        url = urljoin(app_url, url)
         if isinstance(data, list):
             # support message batches
             messages = []
             for d in data:
-                messages.append({u'body': d, u'ttl': 259200})  # three days
+                if isinstance(d, dict):
+                    message = {u'ttl': DEFAULT_TTL}
+                    message.update(d)
+                else:
+                    message = {u'body': d, u'ttl': DEFAULT_TTL}
+                messages.append(message)
             data = ujson.encode({u'messages': messages})
             headers = {u'content-type': u'application/json'}
-        return self.session.post(url, headers=headers,
+        return self._request(app_url, u'post', url, headers=headers,
             params=params, timeout=self.timeout, data=data)
 
     @fallback
@@ -177,8 +620,9 @@ class Client(object):
         :type headers: dict
         :rtype: :py:class:`requests.models.Response`
         """
-        url = urljoin(self.app_url, url)
-        return self.session.put(url, headers=headers,
+        app_url = self.app_url
+        url = urljoin(app_url, url)
+        return self._request(app_url, u'put', url, headers=headers,
             params=params, timeout=self.timeout, data=data)
 
     @fallback
@@ -193,8 +637,9 @@ class Client(object):
         :type params: dict
         :rtype: :py:class:`requests.models.Response`
         """
-        url = urljoin(self.app_url, url)
-        return self.session.delete(url,
+        app_url = self.app_url
+        url = urljoin(app_url, url)
+        return self._request(app_url, u'delete', url,
             params=params, timeout=self.timeout)
 
     def create_queue(self, partitions=1, queue_name=None):
@@ -213,7 +658,7 @@ class Client(object):
             data[u'queue_name'] = queue_name
         response = self.post(data=data)
         if response.ok:
-            return ujson.decode(response.text)[u'queue_name']
+            return _decode(response)[u'queue_name']
         # failure
         raise HTTPError(response.status_code, response)
 
@@ -235,17 +680,464 @@ class Client(object):
         :raises: :py:exc:`queuey_py.client.HTTPError`
         :rtype: list
         """
+        messages = self._fetch(queue_name, [partition], since, limit, order)
+        if not since:
+            return messages
+        # filter out exact timestamp matches, since may be a message key
+        since_id = _message_id(since)
+        return [m for m in messages if m[u'message_id'] != since_id]
+
+    def _fetch(self, queue_name, partitions, since, limit, order):
         params = {
             u'limit': limit,
             u'order': order,
-            u'partitions': partition,
+            u'partitions': u','.join([unicode(p) for p in partitions]),
         }
         if since:
             params[u'since'] = since
         response = self.get(queue_name, params=params)
         if response.ok:
-            messages = ujson_decode(response.text)[u'messages']
-            # filter out exact timestamp matches
-            return [m for m in messages if m[u'message_id'] != since]
+            return _decode(response)[u'messages']
         # failure
         raise HTTPError(response.status_code, response)
+
+    def post_messages(self, queue_name, messages, ttl=DEFAULT_TTL,
+                      max_messages=1000, max_bytes=1048576):
+        """Post a batch of messages to a queue and return their keys.
+
+        Each message is either a body string or a dict with a `body` and
+        any of a `ttl`, an explicit `partition` or a routing `key`. Messages
+        with the same routing key always go to the same partition, see
+        :py:meth:`partition_for`. Messages without either go to the first
+        partition.
+
+        Large batches are split into chunks of at most `max_messages`
+        messages and `max_bytes` of encoded JSON, which are posted
+        concurrently over the connection pool, so messages keep their order
+        within a chunk only. A failing chunk doesn't stop the others, its
+        error is reported in the `errors` of the result.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param messages: The messages to post.
+        :type messages: list
+        :param ttl: Default time to live of the messages in seconds,
+            defaults to three days.
+        :type ttl: int
+        :param max_messages: Maximum number of messages per request,
+            defaults to 1000.
+        :type max_messages: int
+        :param max_bytes: Maximum size of the encoded messages per request,
+            defaults to 1 MB.
+        :type max_bytes: int
+        :returns: The message keys, in `partition:message_id` form.
+        :rtype: :py:class:`queuey_py.client.BatchResult`
+        """
+        batch = []
+        for m in messages:
+            if not isinstance(m, dict):
+                m = {u'body': m}
+            message = {u'body': m[u'body'], u'ttl': ttl}
+            if m.get(u'ttl') is not None:
+                message[u'ttl'] = m[u'ttl']
+            if m.get(u'partition') is not None:
+                message[u'partition'] = m[u'partition']
+            elif m.get(u'key') is not None:
+                message[u'partition'] = self.partition_for(queue_name,
+                    m[u'key'])
+            batch.append(message)
+        result = BatchResult(len(batch))
+        offsets = []
+        chunks = []
+        for offset, chunk in _chunks(batch, max_messages, max_bytes):
+            offsets.append(offset)
+            chunks.append(chunk)
+        outcomes = self._run_chunks(partial(self._post_chunk, queue_name),
+            chunks)
+        for offset, chunk, (keys, error) in zip(offsets, chunks, outcomes):
+            if error is not None:
+                result.errors.append((offset, len(chunk), error))
+            else:
+                result[offset:offset + len(keys)] = keys
+        return result
+
+    def _run_chunks(self, func, chunks):
+        # call func for each chunk, concurrently if there's more than one,
+        # and return a (result, error) tuple per chunk
+        if len(chunks) > 1:
+            executor = self._get_executor()
+            futures = [executor.submit(func, chunk) for chunk in chunks]
+        else:
+            futures = [None] * len(chunks)
+        outcomes = []
+        for chunk, future in zip(chunks, futures):
+            try:
+                if future is None:
+                    outcomes.append((func(chunk), None))
+                else:
+                    outcomes.append((future.result(), None))
+            except Exception, e:
+                outcomes.append((None, e))
+        return outcomes
+
+    def _post_chunk(self, queue_name, chunk):
+        response = self.post(queue_name, data=chunk)
+        if response.ok:
+            return [m[u'key'] for m in _decode(response)[u'messages']]
+        # failure
+        raise HTTPError(response.status_code, response)
+
+    def delete_messages(self, queue_name, keys, max_url_length=4096):
+        """Delete messages from a queue.
+
+        The keys are grouped by partition and as many keys as fit into a
+        URL of `max_url_length` characters are deleted in one request. The
+        requests are sent concurrently over the connection pool.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param keys: Keys of the messages, in `partition:message_id` form.
+            Message ids without a partition refer to the first partition.
+        :type keys: list
+        :param max_url_length: Maximum length of a request URL, defaults to
+            4096.
+        :type max_url_length: int
+        :returns: A list of `(keys, error)` tuples, one for each failed
+            request, holding the keys of the request and the exception it
+            raised. Empty if all messages were deleted.
+        :rtype: list
+        """
+        partitions = {}
+        for key in keys:
+            if u':' not in key:
+                key = u'1:' + key
+            partition = int(key.split(u':', 1)[0])
+            partitions.setdefault(partition, []).append(key)
+        available = max_url_length - len(urljoin(self.app_url,
+            queue_name + u'/'))
+        chunks = []
+        for partition, partition_keys in sorted(partitions.items()):
+            chunk, length = [], 0
+            for key in partition_keys:
+                key_length = len(quote_plus(key)) + 1
+                if chunk and length + key_length > available:
+                    chunks.append(chunk)
+                    chunk, length = [], 0
+                chunk.append(key)
+                length += key_length
+            chunks.append(chunk)
+        outcomes = self._run_chunks(partial(self._delete_chunk, queue_name),
+            chunks)
+        return [(chunk, error) for chunk, (ignored, error) in
+            zip(chunks, outcomes) if error is not None]
+
+    def _delete_chunk(self, queue_name, keys):
+        url = queue_name + u'/' + u','.join([quote_plus(k) for k in keys])
+        response = self.delete(url)
+        if not response.ok:
+            raise HTTPError(response.status_code, response)
+
+    def update_messages(self, queue_name, messages, concurrency=None):
+        """Replace the bodies of messages in a queue.
+
+        Messages which don't exist yet are created. Updates are sent one
+        message per request, with up to `concurrency` requests in flight
+        over the keep-alive connections of the pool at any time.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param messages: A dict mapping message keys, in
+            `partition:message_id` form, to their new bodies, or an
+            iterable of such pairs. Message ids without a partition refer to
+            the first partition.
+        :type messages: dict
+        :param concurrency: Maximum number of requests in flight, defaults
+            to one per pooled connection.
+        :type concurrency: int
+        :returns: A dict mapping each key to `None` if the message was
+            updated or to the exception raised.
+        :rtype: dict
+        """
+        if isinstance(messages, dict):
+            messages = messages.iteritems()
+        if concurrency is None:
+            concurrency = self.pool_maxsize * len(self.connection)
+        executor = self._get_executor()
+        results = {}
+        pending = {}
+        for key, body in messages:
+            if len(pending) >= max(concurrency, 1):
+                done, ignored = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.exception()
+            future = executor.submit(self._update, queue_name, key, body)
+            pending[future] = key
+        wait(pending)
+        for future, key in pending.items():
+            results[key] = future.exception()
+        return results
+
+    def _update(self, queue_name, key, body):
+        if u':' not in key:
+            key = u'1:' + key
+        response = self.put(queue_name + u'/' + quote_plus(key), data=body)
+        if not response.ok:
+            raise HTTPError(response.status_code, response)
+
+    def partition_for(self, queue_name, key):
+        """Return the partition of a queue a routing key maps to.
+
+        The number of partitions of each queue is looked up once and then
+        cached.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param key: The routing key.
+        :type key: unicode
+        :raises: :py:exc:`queuey_py.client.HTTPError`, :py:exc:`ValueError`
+            if there's no such queue
+        :rtype: int
+        """
+        partitions = self._partitions.get(queue_name)
+        if partitions is None:
+            partitions = self.queue_partitions(queue_name)
+            self._partitions[queue_name] = partitions
+        return hash_partition(key, partitions)
+
+    def queue_partitions(self, queue_name, page_size=100):
+        """Return the number of partitions of a queue.
+
+        Pages through the queues of the application until the queue is
+        found.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param page_size: Number of queues listed per request, defaults to
+            100.
+        :type page_size: int
+        :raises: :py:exc:`queuey_py.client.HTTPError`, :py:exc:`ValueError`
+            if there's no such queue
+        :rtype: int
+        """
+        params = {u'details': True, u'limit': page_size}
+        while True:
+            response = self.get(params=params)
+            if not response.ok:
+                raise HTTPError(response.status_code, response)
+            queues = _decode(response)[u'queues']
+            for queue in queues:
+                if queue[u'queue_name'] == queue_name:
+                    return queue[u'partitions']
+            if len(queues) < params[u'limit']:
+                break
+            # the next page starts with the last queue of this one
+            params[u'offset'] = queues[-1][u'queue_name']
+            params[u'limit'] = page_size + 1
+        raise ValueError(u'Unknown queue: %s' % queue_name)
+
+    def merge_messages(self, queue_name, partitions=None, cursors=None,
+                       page_size=100, prefetch=1, checkpoints=None,
+                       dedup=None):
+        """Iterate over all messages of multiple partitions of a queue at
+        once, ordered by their timestamps.
+
+        All partitions are read concurrently via :py:meth:`iter_messages`
+        and their messages merged as they arrive, so only a few pages per
+        partition are held in memory. As messages are ordered by the time
+        encoded in their ids, the order is only as accurate as the clocks
+        of the Queuey servers.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partitions: Partition numbers to read, defaults to all
+            partitions of the queue.
+        :type partitions: list
+        :param cursors: Maps partition numbers to a message id, after which
+            to start reading the partition, defaults to the oldest message
+            of each partition.
+        :type cursors: dict
+        :param page_size: Number of messages per request, defaults to 100.
+        :type page_size: int
+        :param prefetch: Number of pages to fetch ahead per partition,
+            defaults to 1.
+        :type prefetch: int
+        :param checkpoints: Store to resume partitions without a cursor
+            from and to record processed messages in, see
+            :py:meth:`iter_messages`.
+        :type checkpoints: :py:class:`queuey_py.checkpoint.CheckpointStore`
+        :param dedup: Optional stage dropping messages seen before.
+        :type dedup: :py:class:`queuey_py.dedup.Deduplicator`
+        :raises: :py:exc:`queuey_py.client.HTTPError`
+        :rtype: iterator
+        """
+        if partitions is None:
+            partitions = range(1, self.queue_partitions(queue_name) + 1)
+        cursors = cursors or {}
+        streams = [self.iter_messages(queue_name, p, since=cursors.get(p),
+            page_size=page_size, prefetch=prefetch, checkpoints=checkpoints,
+            dedup=dedup) for p in partitions]
+        try:
+            timed = [_timed(p, stream) for p, stream in
+                zip(partitions, streams)]
+            for timestamp, partition, n, message in merge(*timed):
+                yield message
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def iter_messages(self, queue_name, partition=1, since=None,
+                      page_size=100, prefetch=1, follow=False,
+                      poll_interval=1.0, checkpoints=None, dedup=None):
+        """Iterate over all messages of a queue partition, from oldest to
+        newest.
+
+        Messages are fetched in pages. While the caller processes one page,
+        up to `prefetch` following pages are fetched in the background.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partition: Partition number, defaults to 1.
+        :type partition: int
+        :param since: Only return messages after (not including) a given
+            message id, defaults to no restriction.
+        :type since: str
+        :param page_size: Number of messages per request, defaults to 100.
+        :type page_size: int
+        :param prefetch: Number of pages to fetch ahead, defaults to 1.
+        :type prefetch: int
+        :param follow: Whether to wait for new messages once all existing
+            messages have been returned, defaults to False.
+        :type follow: bool
+        :param poll_interval: Seconds to wait before asking for new
+            messages again, if `follow` is set, defaults to 1.0.
+        :type poll_interval: float
+        :param checkpoints: Store to resume from, if no `since` is given.
+            A message is recorded as processed once the next message is
+            asked for or the iteration ends.
+        :type checkpoints: :py:class:`queuey_py.checkpoint.CheckpointStore`
+        :param dedup: Optional stage dropping messages seen before, such as
+            messages delivered again after a retry.
+        :type dedup: :py:class:`queuey_py.dedup.Deduplicator`
+        :raises: :py:exc:`queuey_py.client.HTTPError`
+        :rtype: iterator
+        """
+        if since is None and checkpoints is not None:
+            since = checkpoints.get(queue_name, partition)
+        pages = self._pages(queue_name, partition, since, page_size,
+            follow, poll_interval)
+        prefetcher = Prefetcher(pages, size=prefetch)
+        last = None
+        try:
+            for page in prefetcher:
+                for message in page:
+                    if dedup is not None and dedup.is_duplicate(message):
+                        continue
+                    if last is not None:
+                        checkpoints.update(queue_name, partition, last)
+                    yield message
+                    if checkpoints is not None:
+                        last = message[u'message_id']
+            if last is not None:
+                checkpoints.update(queue_name, partition, last)
+        finally:
+            prefetcher.close()
+
+    def _pages(self, queue_name, partition, since, page_size, follow,
+               poll_interval):
+        while True:
+            # the since message itself is returned and filtered out
+            limit = page_size + 1 if since else page_size
+            page = self._fetch(queue_name, [partition], since, limit,
+                u'ascending')
+            full = len(page) >= limit
+            if since:
+                since_id = _message_id(since)
+                page = [m for m in page if m[u'message_id'] != since_id]
+            if page:
+                since = page[-1][u'message_id']
+                yield page
+            if not full:
+                # reached the newest message
+                if not follow:
+                    return
+                time.sleep(poll_interval)
+                # give the prefetcher a chance to stop
+                yield []
+
+    def partition_messages(self, queue_name, cursors, limit=100):
+        """Returns messages for multiple partitions of a queue, from oldest
+        to newest, using as few requests as possible.
+
+        Each partition has its own cursor, marking the position up to which
+        its messages have already been seen. All partitions with a cursor
+        are queried in a single request, starting at the oldest cursor and
+        skipping any messages before a partition's own cursor. Partitions
+        without a cursor are queried in one more request. Advanced cursors
+        are returned for the next call. A cursor is a message id, but isn't
+        necessarily one of its own partition, if the partition had no new
+        messages.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param cursors: Maps each partition number to a message id or to
+            `None` to start at the oldest message.
+        :type cursors: dict
+        :param limit: Only return N number of messages per request, defaults
+            to 100.
+        :type limit: int
+        :raises: :py:exc:`queuey_py.client.HTTPError`
+        :returns: A dict mapping each partition to its list of messages and
+            a dict with the new cursors.
+        :rtype: tuple
+        """
+        result = dict((p, []) for p in cursors)
+        cursors = dict(cursors)
+        fresh = sorted([p for p, since in cursors.items() if not since])
+        started = sorted([p for p, since in cursors.items() if since])
+        for group in (fresh, started):
+            if not group:
+                continue
+            since = None
+            seen = {}
+            if group is started:
+                for p in group:
+                    seen[p] = message_time(cursors[p])
+                since = min(group, key=seen.get)
+                since = cursors[since]
+            # the since message itself is returned and filtered out
+            fetch_limit = limit + 1 if since else limit
+            page = self._fetch(queue_name, group, since, fetch_limit,
+                u'ascending')
+            # the server may group the messages by partition, the sort is
+            # stable and keeps the order within each partition
+            page = sorted(page, key=lambda m: message_time(m[u'message_id']))
+            counts = {}
+            newest = {}
+            for m in page:
+                partition = m.get(u'partition', group[0])
+                message_id = m[u'message_id']
+                counts[partition] = counts.get(partition, 0) + 1
+                newest[partition] = message_id
+                if partition in seen:
+                    timestamp = message_time(message_id)
+                    if timestamp < seen[partition] or (
+                        timestamp == seen[partition] and
+                        message_id == _message_id(cursors[partition])):
+                        continue
+                result[partition].append(m)
+                cursors[partition] = message_id
+            if page:
+                # the page holds all messages of the group up to its last,
+                # but not past a partition which filled the limit on its
+                # own, in case the server applies it per partition
+                last = page[-1][u'message_id']
+                for p, count in counts.items():
+                    if count >= fetch_limit and \
+                            message_time(newest[p]) < message_time(last):
+                        last = newest[p]
+                last_time = message_time(last)
+                for p in group:
+                    if (cursors[p] is None or
+                        message_time(cursors[p]) < last_time):
+                        cursors[p] = last
+        return result, cursors
@@ -0,0 +1,332 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from Queue import Empty
+from Queue import Full
+from Queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+# messages handled per task, before other partitions get a turn
+BATCH = 100
+
+
+class _Partition(object):
+
+    def __init__(self, number, buffer_size):
+        self.number = number
+        self.buffer = Queue(maxsize=buffer_size)
+        self.running = False
+        self.stopped = Event()
+        self.thread = None
+        self.fetched = 0
+        self.handled = 0
+
+
+class Consumer(object):
+    """Fetches the messages of a queue in the background and hands them to
+    a pool of handler threads.
+
+    Each partition has its own fetcher thread, polling for new messages
+    and keeping up to `buffer_size` of them in memory. The messages of a
+    partition are handled one after the other, in order, while different
+    partitions are handled in parallel. A partition's checkpoint only
+    advances past messages whose handler returned.
+
+    If a handler raises an exception, the consumer stops and
+    :py:meth:`wait` re-raises it. The failed message and all messages
+    after it are fetched again by the next consumer resuming from the
+    checkpoints.
+
+    :param client: The client used to fetch messages.
+    :type client: :py:class:`queuey_py.client.Client`
+    :param queue_name: Queue name
+    :type queue_name: unicode
+    :param handler: Called with each message.
+    :type handler: callable
+    :param partitions: Partition numbers to consume, defaults to all
+        partitions of the queue.
+    :type partitions: list
+    :param workers: Number of handler threads, defaults to 4.
+    :type workers: int
+    :param buffer_size: Maximum number of fetched messages per partition
+        waiting to be handled, defaults to 1000.
+    :type buffer_size: int
+    :param page_size: Number of messages per request, defaults to 100.
+    :type page_size: int
+    :param poll_interval: Seconds to wait before asking for new messages
+        after reaching the newest message of a partition, defaults to 1.0.
+    :type poll_interval: float
+    :param checkpoints: Store to resume from and to record handled
+        messages in.
+    :type checkpoints: :py:class:`queuey_py.checkpoint.CheckpointStore`
+    :param dedup: Optional stage dropping messages handled before.
+    :type dedup: :py:class:`queuey_py.dedup.Deduplicator`
+    """
+
+    def __init__(self, client, queue_name, handler, partitions=None,
+                 workers=4, buffer_size=1000, page_size=100,
+                 poll_interval=1.0, checkpoints=None, dedup=None):
+        self.client = client
+        self.queue_name = queue_name
+        self.handler = handler
+        if partitions is None:
+            partitions = range(1, client.queue_partitions(queue_name) + 1)
+        self.buffer_size = buffer_size
+        self.partitions = [_Partition(p, buffer_size) for p in partitions]
+        self.workers = workers
+        self.page_size = page_size
+        self.poll_interval = poll_interval
+        self.checkpoints = checkpoints
+        self.dedup = dedup
+        self.fetch_errors = 0
+        self.error = None
+        self._lock = Lock()
+        self._idle = Condition(self._lock)
+        self._stopped = Event()
+        self._executor = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        """Start fetching and handling messages."""
+        if self._executor is not None:
+            raise ValueError(u'Consumer has already been started')
+        self._stopped.clear()
+        self._executor = ThreadPoolExecutor(max(self.workers, 1))
+        for partition in self.partitions:
+            self._start_fetcher(partition)
+
+    def _start_fetcher(self, partition):
+        partition.thread = Thread(target=self._fetch, args=(partition, ))
+        partition.thread.daemon = True
+        partition.thread.start()
+
+    def _done(self, partition):
+        return self._stopped.is_set() or partition.stopped.is_set()
+
+    def assign(self, partitions):
+        """Change the consumed partitions, leaving all others running.
+
+        Removed partitions stop fetching, their running handlers are
+        waited for and the checkpoints are committed, so another consumer
+        can take them over. Their buffered messages are dropped.
+
+        :param partitions: Partition numbers to consume.
+        :type partitions: list
+        """
+        wanted = set(partitions)
+        with self._lock:
+            current = set([p.number for p in self.partitions])
+            removed = [p for p in self.partitions if p.number not in wanted]
+            added = [_Partition(n, self.buffer_size)
+                for n in sorted(wanted - current)]
+            self.partitions = [p for p in self.partitions
+                if p.number in wanted] + added
+        for partition in removed:
+            partition.stopped.set()
+        for partition in removed:
+            if partition.thread is not None:
+                partition.thread.join()
+            with self._idle:
+                while partition.running:
+                    self._idle.wait()
+        if removed and self.checkpoints is not None:
+            self.checkpoints.commit()
+        if self._executor is not None:
+            for partition in added:
+                self._start_fetcher(partition)
+
+    def _put(self, partition, message):
+        while not self._done(partition):
+            try:
+                partition.buffer.put(message, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _fetch(self, partition):
+        since = None
+        if self.checkpoints is not None:
+            since = self.checkpoints.get(self.queue_name, partition.number)
+        while not self._done(partition):
+            try:
+                # the since message itself is returned and filtered out
+                messages = self.client.messages(self.queue_name,
+                    partition.number, since=since,
+                    limit=self.page_size + 1 if since else self.page_size)
+            except Exception:
+                with self._lock:
+                    self.fetch_errors += 1
+                partition.stopped.wait(self.poll_interval)
+                continue
+            for message in messages:
+                if not self._put(partition, message):
+                    return
+                partition.fetched += 1
+                self._dispatch(partition)
+            if messages:
+                since = messages[-1][u'message_id']
+            if len(messages) < self.page_size:
+                partition.stopped.wait(self.poll_interval)
+
+    def _dispatch(self, partition):
+        with self._lock:
+            if partition.running or self._done(partition):
+                return
+            partition.running = True
+        self._executor.submit(self._drain, partition)
+
+    def _drain(self, partition):
+        for i in xrange(BATCH):
+            if self._done(partition):
+                break
+            try:
+                message = partition.buffer.get_nowait()
+            except Empty:
+                break
+            # only messages about to be handled count as seen, buffered
+            # ones may be dropped and fetched again
+            if self.dedup is not None and self.dedup.is_duplicate(message):
+                continue
+            try:
+                self.handler(message)
+            except Exception, e:
+                self._fail(e)
+                break
+            partition.handled += 1
+            if self.checkpoints is not None:
+                self.checkpoints.update(self.queue_name, partition.number,
+                    message[u'message_id'])
+        with self._lock:
+            partition.running = False
+            self._idle.notify_all()
+            if self._done(partition) or partition.buffer.empty():
+                return
+            # give other partitions a turn before continuing
+            partition.running = True
+        self._executor.submit(self._drain, partition)
+
+    def _fail(self, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+        self._stopped.set()
+
+    def wait(self, timeout=None):
+        """Wait until the consumer stops, because it was closed or a
+        handler failed.
+
+        :param timeout: Maximum number of seconds to wait, defaults to no
+            limit.
+        :type timeout: float
+        :raises: The exception raised by a handler.
+        :returns: Whether or not the consumer has stopped.
+        :rtype: bool
+        """
+        self._stopped.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self._stopped.is_set()
+
+    def close(self):
+        """Stop fetching, wait for running handlers and commit the
+        checkpoints. Buffered messages which haven't been handled are
+        dropped."""
+        self._stopped.set()
+        for partition in self.partitions:
+            partition.stopped.set()
+            if partition.thread is not None:
+                partition.thread.join()
+                partition.thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self.checkpoints is not None:
+            self.checkpoints.commit()
+
+    def stats(self):
+        """Return the number of fetched, handled and buffered messages per
+        partition, as well as the number of failed fetches.
+
+        :rtype: dict
+        """
+        partitions = {}
+        for partition in self.partitions:
+            partitions[partition.number] = {
+                u'fetched': partition.fetched,
+                u'handled': partition.handled,
+                u'buffered': partition.buffer.qsize(),
+            }
+        return {
+            u'partitions': partitions,
+            u'fetch_errors': self.fetch_errors,
+        }
+
+
+class ConsumerSet(object):
+    """Runs a :py:class:`Consumer` per queue for a changing set of
+    partitions.
+
+    :param client: The client used to fetch messages.
+    :type client: :py:class:`queuey_py.client.Client`
+    :param handler: Called with each message.
+    :type handler: callable
+    :param options: Further keyword arguments for the consumers, such as
+        `checkpoints` or `workers`.
+    """
+
+    def __init__(self, client, handler, **options):
+        self.client = client
+        self.handler = handler
+        self.options = options
+        self.consumers = {}
+        self._lock = Lock()
+
+    @property
+    def error(self):
+        """The exception raised by a handler of any of the consumers."""
+        for consumer in self.consumers.values():
+            if consumer.error is not None:
+                return consumer.error
+        return None
+
+    def assign(self, queues):
+        """Consume the given partitions. Partitions which keep being
+        consumed aren't interrupted, all others are stopped.
+
+        :param queues: Maps queue names to lists of partition numbers.
+        :type queues: dict
+        """
+        with self._lock:
+            for queue_name in set(self.consumers) | set(queues):
+                consumer = self.consumers.get(queue_name)
+                partitions = set(queues.get(queue_name) or [])
+                if consumer is None:
+                    if not partitions:
+                        continue
+                    consumer = Consumer(self.client, queue_name,
+                        self.handler, partitions=sorted(partitions),
+                        **self.options)
+                    consumer.start()
+                    self.consumers[queue_name] = consumer
+                elif partitions:
+                    # only start and stop the partitions which changed
+                    consumer.assign(partitions)
+                else:
+                    consumer.close()
+                    del self.consumers[queue_name]
+
+    def close(self):
+        """Stop all consumers."""
+        self.assign({})
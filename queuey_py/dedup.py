@@ -0,0 +1,217 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import deque
+from hashlib import md5
+from threading import Lock
+import math
+import struct
+
+from queuey_py.client import _message_id
+
+
+class LRUSet(object):
+    """Remembers the `size` most recently seen keys.
+
+    :param size: Maximum number of keys, defaults to 100000.
+    :type size: int
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self._stamps = {}
+        self._order = deque()
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._stamps)
+
+    def add(self, key):
+        """Add a key and return whether or not it was already present.
+
+        :rtype: bool
+        """
+        seen = key in self._stamps
+        self._counter += 1
+        self._stamps[key] = self._counter
+        self._order.append((self._counter, key))
+        while len(self._stamps) > self.size:
+            stamp, old = self._order.popleft()
+            if self._stamps.get(old) == stamp:
+                del self._stamps[old]
+        if len(self._order) > 2 * self.size:
+            # drop entries superseded by a more recent add
+            self._order = deque([(s, k) for s, k in self._order
+                if self._stamps.get(k) == s])
+        return seen
+
+
+class _BloomFilter(object):
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = self.size(capacity, error_rate)
+        self.hashes = max(int(round(
+            self.bits / float(capacity) * math.log(2))), 1)
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    @staticmethod
+    def size(capacity, error_rate):
+        return max(int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+
+    @property
+    def nbytes(self):
+        return len(self._array)
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack('<QQ', md5(key).digest())
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def __contains__(self, key):
+        array = self._array
+        for position in self._positions(key):
+            if not array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        array = self._array
+        for position in self._positions(key):
+            array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class ScalableBloomFilter(object):
+    """Probabilistically remembers keys in a fixed amount of memory.
+
+    Keys are added to a series of Bloom filters. Once a filter holds its
+    capacity, a new one with `growth` times the capacity and a tighter
+    error rate is started, so the overall false positive rate stays close
+    to `error_rate`. Once all filters together would exceed `max_bytes`,
+    the oldest filters are dropped, forgetting the oldest keys.
+
+    A false positive reports a new key as already present.
+
+    :param capacity: Number of keys the first filter holds, defaults to
+        100000.
+    :type capacity: int
+    :param error_rate: Targeted false positive rate, defaults to 0.001.
+    :type error_rate: float
+    :param max_bytes: Memory ceiling for all filters, defaults to 16 MB.
+    :type max_bytes: int
+    :param growth: Capacity factor of each following filter, defaults to 2.
+    :type growth: int
+    """
+
+    # error rate factor of each following filter
+    ratio = 0.9
+
+    def __init__(self, capacity=100000, error_rate=0.001, max_bytes=16777216,
+                 growth=2):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.max_bytes = max_bytes
+        self.growth = growth
+        first = error_rate * (1 - self.ratio)
+        self.filters = deque([_BloomFilter(capacity, first)])
+
+    @property
+    def nbytes(self):
+        return sum([f.nbytes for f in self.filters])
+
+    def __len__(self):
+        return sum([f.count for f in self.filters])
+
+    def _grow(self):
+        last = self.filters[-1]
+        capacity = last.capacity * self.growth
+        error_rate = last.error_rate * self.ratio
+        if (_BloomFilter.size(capacity, error_rate) + 7) // 8 > \
+                self.max_bytes // 2:
+            # stop growing and rotate filters of the same size instead
+            capacity, error_rate = last.capacity, last.error_rate
+        new = _BloomFilter(capacity, error_rate)
+        while self.filters and self.nbytes + new.nbytes > self.max_bytes:
+            self.filters.popleft()
+        self.filters.append(new)
+
+    def add(self, key):
+        """Add a key and return whether or not it was probably already
+        present.
+
+        :rtype: bool
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        for bloom in self.filters:
+            if key in bloom:
+                return True
+        if self.filters[-1].count >= self.filters[-1].capacity:
+            self._grow()
+        self.filters[-1].add(key)
+        return False
+
+
+class Deduplicator(object):
+    """Drops messages whose id has been seen before.
+
+    Pass a deduplicator as `dedup` to
+    :py:meth:`queuey_py.client.Client.iter_messages` or
+    :py:meth:`queuey_py.client.Client.merge_messages` to skip messages
+    delivered more than once.
+
+    :param seen: Remembers the seen message ids, defaults to a
+        :py:class:`LRUSet`. A :py:class:`ScalableBloomFilter` remembers
+        many more ids in the same memory, at the cost of occasionally
+        dropping a new message.
+    """
+
+    def __init__(self, seen=None):
+        self.seen = seen if seen is not None else LRUSet()
+        self.checked = 0
+        self.duplicates = 0
+        self._lock = Lock()
+
+    def is_duplicate(self, message):
+        """Record a message and return whether or not it was seen before.
+
+        :param message: A message as returned by
+            :py:meth:`queuey_py.client.Client.messages`.
+        :type message: dict
+        :rtype: bool
+        """
+        with self._lock:
+            self.checked += 1
+            if self.seen.add(_message_id(message[u'message_id'])):
+                self.duplicates += 1
+                return True
+            return False
+
+    def filter(self, messages):
+        """Iterate over all messages not seen before.
+
+        :param messages: Messages as returned by
+            :py:meth:`queuey_py.client.Client.messages`.
+        :rtype: iterator
+        """
+        for message in messages:
+            if not self.is_duplicate(message):
+                yield message
+
+    def stats(self):
+        """Return the number of checked messages, dropped duplicates and
+        the share of duplicates.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                u'checked': self.checked,
+                u'duplicates': self.duplicates,
+                u'hit_rate': self.checked and
+                    self.duplicates / float(self.checked) or 0.0,
+            }
@@ -0,0 +1,258 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from contextlib import contextmanager
+from socket import gethostname
+from threading import Event
+from threading import Lock
+from threading import Thread
+import fcntl
+import os
+import time
+
+import ujson
+
+
+class MemoryLeaseBackend(object):
+    """Keeps leases in memory, to coordinate consumers within a process or
+    in tests."""
+
+    def __init__(self):
+        self._state = {u'members': {}, u'leases': {}}
+        self._lock = Lock()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield self._state
+
+    def heartbeat(self, member, ttl):
+        """Announce a member to be alive for another `ttl` seconds."""
+        with self._transaction() as state:
+            state[u'members'][member] = time.time() + ttl
+
+    def leave(self, member):
+        """Remove a member and release all its leases."""
+        with self._transaction() as state:
+            state[u'members'].pop(member, None)
+            for resource, (owner, expires) in state[u'leases'].items():
+                if owner == member:
+                    del state[u'leases'][resource]
+
+    def members(self):
+        """Return the sorted names of all live members.
+
+        :rtype: list
+        """
+        now = time.time()
+        with self._transaction() as state:
+            return sorted([m for m, expires in state[u'members'].items()
+                if expires > now])
+
+    def acquire(self, resource, owner, ttl):
+        """Take or renew the lease on a resource for `ttl` seconds.
+
+        :returns: Whether or not the lease is held by `owner`.
+        :rtype: bool
+        """
+        now = time.time()
+        with self._transaction() as state:
+            lease = state[u'leases'].get(resource)
+            if lease and lease[0] != owner and lease[1] > now:
+                return False
+            state[u'leases'][resource] = [owner, now + ttl]
+            return True
+
+    def release(self, resource, owner):
+        """Give up the lease on a resource, if held by `owner`."""
+        with self._transaction() as state:
+            lease = state[u'leases'].get(resource)
+            if lease and lease[0] == owner:
+                del state[u'leases'][resource]
+
+
+class FileLeaseBackend(MemoryLeaseBackend):
+    """Keeps leases in a JSON file, guarded by an exclusive `flock` on a
+    lock file next to it. Coordinates consumers on one host or on hosts
+    sharing a file system with working `flock` support.
+
+    :param path: Path of the lease file.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            with open(self.path + u'.lock', 'a') as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                try:
+                    try:
+                        with open(self.path, 'rb') as f:
+                            state = ujson.decode(f.read())
+                    except (IOError, ValueError):
+                        state = {u'members': {}, u'leases': {}}
+                    data = ujson.encode(state)
+                    yield state
+                    if ujson.encode(state) != data:
+                        temp = self.path + u'.tmp'
+                        with open(temp, 'wb') as f:
+                            f.write(ujson.encode(state))
+                        os.rename(temp, self.path)
+                finally:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+class LeaseManager(object):
+    """Spreads queue partitions evenly across consumers, which may run on
+    different hosts.
+
+    Each consumer runs a manager with a unique `member` name and the same
+    list of partitions. Every `interval` seconds the manager announces its
+    member to be alive, works out its share of the partitions among all
+    live members and takes leases on them, which expire after `ttl`
+    seconds unless renewed. Partitions no longer in its share are handed
+    back, so other members can take them over. Partitions of members which
+    stopped renewing their leases are taken over once they expire.
+
+    `on_change` is called with a dict mapping queue names to the sorted
+    partition numbers held, whenever they change. Partitions are passed on
+    after their lease has been taken and are withdrawn before the lease is
+    given up, so no partition is consumed by two members at a time. A
+    manager which couldn't renew its leases in time withdraws all its
+    partitions.
+
+    :param backend: Keeps track of members and leases, such as a
+        :py:class:`FileLeaseBackend` or a :py:class:`MemoryLeaseBackend`.
+    :param partitions: List of (queue name, partition number) tuples.
+    :type partitions: list
+    :param member: Unique name of this consumer, defaults to the host name
+        and process id.
+    :type member: str
+    :param ttl: Seconds after which a lease expires, defaults to 10.0.
+    :type ttl: float
+    :param interval: Seconds between renewals, defaults to a third of
+        `ttl`.
+    :type interval: float
+    :param on_change: Called with the currently held partitions, for
+        example :py:meth:`queuey_py.consumer.ConsumerSet.assign`.
+    :type on_change: callable
+    """
+
+    def __init__(self, backend, partitions, member=None, ttl=10.0,
+                 interval=None, on_change=None):
+        self.backend = backend
+        self.partitions = sorted(partitions)
+        if member is None:
+            member = u'%s:%s' % (gethostname(), os.getpid())
+        self.member = member
+        self.ttl = ttl
+        self.interval = interval or ttl / 3.0
+        self.on_change = on_change
+        self.owned = set()
+        self.errors = 0
+        self._renewed = None
+        self._stopped = Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _resource(self, partition):
+        return u'%s:%s' % partition
+
+    def assignment(self):
+        """Return the held partitions.
+
+        :returns: A dict mapping queue names to sorted partition numbers.
+        :rtype: dict
+        """
+        result = {}
+        for queue_name, partition in sorted(self.owned):
+            result.setdefault(queue_name, []).append(partition)
+        return result
+
+    def _set_owned(self, owned):
+        if owned != self.owned:
+            self.owned = owned
+            if self.on_change is not None:
+                self.on_change(self.assignment())
+
+    def _share(self, members):
+        if self.member not in members:
+            members = sorted(members + [self.member])
+        index = members.index(self.member)
+        return set([p for i, p in enumerate(self.partitions)
+            if i % len(members) == index])
+
+    def _acquire(self, partitions):
+        owned = set()
+        for partition in partitions:
+            if self.backend.acquire(self._resource(partition), self.member,
+                    self.ttl):
+                owned.add(partition)
+        return owned
+
+    def tick(self):
+        """Renew the leases and adjust the share of partitions once."""
+        start = time.time()
+        if self._renewed is not None and start - self._renewed > self.ttl:
+            # the leases might have been taken over already
+            self._set_owned(set())
+        self.backend.heartbeat(self.member, self.ttl)
+        share = self._share(self.backend.members())
+        revoked = self.owned - share
+        if revoked:
+            # withdrawing partitions waits for their handlers, so renew the
+            # kept leases first and check them again afterwards
+            kept = self._acquire(self.owned & share)
+            self._set_owned(kept)
+            for partition in revoked:
+                self.backend.release(self._resource(partition), self.member)
+            self.backend.heartbeat(self.member, self.ttl)
+            start = time.time()
+        owned = self._acquire(share)
+        self._renewed = start
+        self._set_owned(owned)
+
+    def start(self):
+        """Start renewing the leases in a background thread."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.tick()
+            except Exception:
+                # keep trying, until the leases expire
+                self.errors += 1
+                if self._renewed is not None and \
+                        time.time() - self._renewed > self.ttl:
+                    self._set_owned(set())
+            self._stopped.wait(self.interval)
+
+    def close(self):
+        """Stop the background thread, withdraw all partitions and give up
+        their leases."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        owned = self.owned
+        self._set_owned(set())
+        for partition in owned:
+            self.backend.release(self._resource(partition), self.member)
+        self.backend.leave(self.member)
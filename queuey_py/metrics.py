@@ -0,0 +1,242 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from math import frexp
+from math import ldexp
+from threading import Lock
+
+# buckets per power of two, giving percentiles within 1/32 of the value
+SUB_BUCKETS = 32
+# shorter latencies are counted as one microsecond
+MIN_VALUE = 1e-6
+
+
+class Hooks(object):
+    """Base class for request instrumentation, with methods doing nothing.
+
+    Pass instances of subclasses overriding any of the methods in the
+    `hooks` argument of :py:class:`queuey_py.client.Client`. The methods
+    are called in the thread making the request, so they should be quick
+    and thread-safe. Exceptions raised by them aren't caught.
+    """
+
+    def before_request(self, server, method, url):
+        """Called before a request is sent.
+
+        :param server: URL of the Queuey app on the server.
+        :type server: str
+        :param method: HTTP method in lower case, like `get`.
+        :type method: str
+        :param url: Full URL of the request.
+        :type url: str
+        """
+
+    def after_response(self, server, method, response, latency, sent,
+                       received):
+        """Called after a response has been received, including error
+        responses.
+
+        :param server: URL of the Queuey app on the server.
+        :type server: str
+        :param method: HTTP method in lower case.
+        :type method: str
+        :param response: The response.
+        :type response: :py:class:`requests.models.Response`
+        :param latency: Seconds the request took.
+        :type latency: float
+        :param sent: Size of the request body in bytes.
+        :type sent: int
+        :param received: Size of the response body in bytes.
+        :type received: int
+        """
+
+    def on_error(self, server, method, error, latency):
+        """Called when a request failed without a response.
+
+        :param server: URL of the Queuey app on the server.
+        :type server: str
+        :param method: HTTP method in lower case.
+        :type method: str
+        :param error: The connection error or timeout.
+        :type error: Exception
+        :param latency: Seconds until the request failed.
+        :type latency: float
+        """
+
+    def on_retry(self, name, attempt, error):
+        """Called before a timed out call is retried.
+
+        :param name: Name of the client method, like `connect`.
+        :type name: str
+        :param attempt: Number of the failed attempt, starting at 1.
+        :type attempt: int
+        :param error: The timeout.
+        :type error: Exception
+        """
+
+    def on_fallback(self, name, failed, server, error):
+        """Called before a call is repeated on a fall back server.
+
+        :param name: Name of the client method, like `post`.
+        :type name: str
+        :param failed: URL of the server which couldn't be reached.
+        :type failed: str
+        :param server: URL of the server used from now on.
+        :type server: str
+        :param error: The connection error.
+        :type error: Exception
+        """
+
+
+class LatencyHistogram(object):
+    """Counts latencies in logarithmic buckets.
+
+    Each power of two is split into 32 buckets, so recording a value is a
+    constant time dict update and percentiles are estimated to within
+    about 3.1% of the actual value, using memory growing with the range of
+    values only.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._buckets = {}
+
+    def record(self, value):
+        """Add a single value.
+
+        :param value: Latency in seconds.
+        :type value: float
+        """
+        mantissa, exponent = frexp(max(value, MIN_VALUE))
+        index = exponent * SUB_BUCKETS + \
+            int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+        buckets = self._buckets
+        buckets[index] = buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Return an estimate of a percentile, or `None` if no values have
+        been recorded.
+
+        :param fraction: The percentile as a fraction, like 0.95.
+        :type fraction: float
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        rank = max(int(self.count * fraction + 0.5), 1)
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                break
+        exponent, sub = divmod(index, SUB_BUCKETS)
+        upper = ldexp(0.5 + (sub + 1) / (2.0 * SUB_BUCKETS), exponent)
+        return max(min(upper, self.max), self.min)
+
+    def stats(self):
+        """Return the number of values, their mean, minimum, maximum and
+        the estimated median, 95th and 99th percentiles.
+
+        :rtype: dict
+        """
+        return {
+            u'count': self.count,
+            u'mean': self.total / self.count if self.count else None,
+            u'min': self.min,
+            u'max': self.max,
+            u'p50': self.percentile(0.5),
+            u'p95': self.percentile(0.95),
+            u'p99': self.percentile(0.99),
+        }
+
+
+class MetricsCollector(Hooks):
+    """Collects request metrics of one or more clients.
+
+    Keeps latency histograms per HTTP method and per server, the number of
+    bytes sent and received, and counts failed requests, retries and
+    fall backs to other servers::
+
+        collector = MetricsCollector()
+        client = Client(app_key, hooks=[collector])
+        client.connect()
+        collector.stats()[u'methods'][u'head'][u'p95']
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all collected metrics."""
+        with self._lock:
+            self.methods = {}
+            self.servers = {}
+            self.requests = 0
+            self.errors = 0
+            self.retries = 0
+            self.fallbacks = 0
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def _histogram(self, histograms, key):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = LatencyHistogram()
+        return histogram
+
+    def after_response(self, server, method, response, latency, sent,
+                       received):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self._histogram(self.methods, method).record(latency)
+            self._histogram(self.servers, server).record(latency)
+
+    def on_error(self, server, method, error, latency):
+        with self._lock:
+            self.requests += 1
+            self.errors += 1
+
+    def on_retry(self, name, attempt, error):
+        with self._lock:
+            self.retries += 1
+
+    def on_fallback(self, name, failed, server, error):
+        with self._lock:
+            self.fallbacks += 1
+
+    def stats(self):
+        """Return the collected metrics.
+
+        A dict with the number of requests, failed requests, retries, fall
+        backs and bytes sent and received, as well as the latency
+        statistics of responses per HTTP method and per server, see
+        :py:meth:`LatencyHistogram.stats`.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                u'requests': self.requests,
+                u'errors': self.errors,
+                u'retries': self.retries,
+                u'fallbacks': self.fallbacks,
+                u'bytes_sent': self.bytes_sent,
+                u'bytes_received': self.bytes_received,
+                u'methods': dict((k, h.stats())
+                    for k, h in self.methods.items()),
+                u'servers': dict((k, h.stats())
+                    for k, h in self.servers.items()),
+            }
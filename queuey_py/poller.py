@@ -0,0 +1,247 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from Queue import Empty
+from Queue import Full
+from Queue import Queue
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+from queuey_py.scheduler import PollScheduler
+
+ROUND_ROBIN = u'round_robin'
+DEFICIT = u'deficit'
+
+
+class _Subscription(object):
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.deficit = 0
+        self.messages = 0
+        self.bytes = 0
+
+
+class MultiQueuePoller(object):
+    """Polls many queue partitions with a few threads sharing one client.
+
+    Partitions are polled as they become due according to a
+    :py:class:`queuey_py.scheduler.PollScheduler`. Partitions which keep
+    returning full pages take turns, sharing the client's connections
+    according to their weights:
+
+    * With `round_robin` scheduling, each turn fetches up to `weight` times
+      `limit` messages.
+    * With `deficit` scheduling, each turn fetches up to `weight` times
+      `limit` messages as well, and adds `weight` times `quantum` bytes to
+      a partition's allowance, which never holds more than one turn's
+      worth. Fetched message bodies are taken from it. A partition which
+      overdrew its allowance skips turns until it's positive again, so
+      partitions with large messages don't crowd out those with small
+      ones. While no other partition is being polled or due, there is no
+      one to take turns with and its allowance is reset instead. An idle
+      partition's allowance is reset as well.
+
+    The pages of a partition are handled one after the other, in order.
+    If polling a partition or handling its messages fails, the partition
+    backs off and its messages are fetched again.
+
+    :param client: The client used to fetch messages.
+    :type client: :py:class:`queuey_py.client.Client`
+    :param scheduling: Either `round_robin` or `deficit`, defaults to
+        `deficit`.
+    :type scheduling: str
+    :param limit: Number of messages per poll, defaults to 100.
+    :type limit: int
+    :param quantum: Bytes of message bodies added to a partition's
+        allowance each turn with `deficit` scheduling, defaults to 64 KB.
+    :type quantum: int
+    :param workers: Number of polling threads, defaults to the client's
+        number of pooled connections.
+    :type workers: int
+    :param scheduler: The scheduler deciding when to poll each partition,
+        defaults to a new :py:class:`~queuey_py.scheduler.PollScheduler`.
+    :type scheduler: :py:class:`queuey_py.scheduler.PollScheduler`
+    """
+
+    def __init__(self, client, scheduling=DEFICIT, limit=100, quantum=65536,
+                 workers=None, scheduler=None):
+        if scheduling not in (ROUND_ROBIN, DEFICIT):
+            raise ValueError(u'Unknown scheduling: %s' % scheduling)
+        self.client = client
+        self.scheduling = scheduling
+        self.limit = limit
+        self.quantum = quantum
+        if workers is None:
+            workers = client.pool_maxsize * len(client.connection)
+        self.workers = workers
+        self.scheduler = scheduler if scheduler is not None else \
+            PollScheduler()
+        self.errors = 0
+        self._polling = 0
+        self._subscriptions = {}
+        self._lock = Lock()
+        self._stopped = Event()
+        self._threads = []
+        self._queue = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def subscribe(self, queue_name, partition=1, weight=1, since=None):
+        """Start polling a queue partition.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partition: Partition number, defaults to 1.
+        :type partition: int
+        :param weight: Share of turns relative to other partitions,
+            defaults to 1.
+        :type weight: int
+        :param since: Message id after which to start, defaults to the
+            oldest message.
+        :type since: str
+        """
+        with self._lock:
+            self._subscriptions[(queue_name, partition)] = \
+                _Subscription(weight)
+        self.scheduler.add(queue_name, partition, since=since)
+
+    def unsubscribe(self, queue_name, partition=1):
+        """Stop polling a queue partition.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partition: Partition number, defaults to 1.
+        :type partition: int
+        """
+        self.scheduler.remove(queue_name, partition)
+        with self._lock:
+            self._subscriptions.pop((queue_name, partition), None)
+
+    def start(self, callback):
+        """Start the polling threads, calling `callback` with the queue
+        name, partition and list of messages for each non-empty page.
+
+        :param callback: Handles a page of messages.
+        :type callback: callable
+        """
+        if self._threads:
+            raise ValueError(u'Poller has already been started')
+        self._stopped.clear()
+        for i in xrange(max(self.workers, 1)):
+            thread = Thread(target=self._run, args=(callback, ))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _put(self, queue_name, partition, messages):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put((queue_name, partition, messages),
+                    timeout=0.1)
+                return
+            except Full:
+                pass
+        raise ValueError(u'Poller has been closed')
+
+    def __iter__(self):
+        """Start the polling threads and iterate over the queue name,
+        partition and list of messages of each non-empty page."""
+        if self._queue is None:
+            self._queue = Queue(maxsize=max(self.workers, 1))
+            self.start(self._put)
+        while not self._stopped.is_set():
+            try:
+                yield self._queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+    def _turn(self, queue_name, partition, since):
+        with self._lock:
+            subscription = self._subscriptions.get((queue_name, partition))
+        if subscription is None:
+            return None
+        limit = self.limit * subscription.weight
+        if self.scheduling == ROUND_ROBIN:
+            return subscription, limit
+        quantum = self.quantum * subscription.weight
+        # unused allowance isn't saved up beyond one turn
+        subscription.deficit = min(subscription.deficit + quantum, quantum)
+        if subscription.deficit <= 0:
+            with self._lock:
+                polling = self._polling
+            if polling or self.scheduler.due():
+                # wait for the next turn of another partition instead of
+                # handing this one straight back
+                self.scheduler.skip(queue_name, partition,
+                    delay=self.scheduler.min_delay)
+                return None
+            subscription.deficit = quantum
+        return subscription, limit
+
+    def _run(self, callback):
+        while not self._stopped.is_set():
+            item = self.scheduler.wait(timeout=0.1)
+            if item is None:
+                continue
+            queue_name, partition, since = item
+            turn = self._turn(queue_name, partition, since)
+            if turn is None:
+                continue
+            subscription, limit = turn
+            with self._lock:
+                self._polling += 1
+            try:
+                # the since message itself is returned and filtered out
+                messages = self.client.messages(queue_name, partition,
+                    since=since, limit=limit + 1 if since else limit)
+                if messages:
+                    callback(queue_name, partition, messages)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                self._record(queue_name, partition, [], limit)
+                continue
+            size = sum([len(m[u'body']) for m in messages])
+            subscription.messages += len(messages)
+            subscription.bytes += size
+            if len(messages) < limit:
+                # an idle partition doesn't save up turns
+                subscription.deficit = 0
+            else:
+                subscription.deficit -= size
+            self._record(queue_name, partition, messages, limit)
+
+    def _record(self, queue_name, partition, messages, limit):
+        self.scheduler.record(queue_name, partition, messages, limit)
+        with self._lock:
+            self._polling -= 1
+
+    def close(self):
+        """Stop the polling threads."""
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._queue = None
+
+    def stats(self):
+        """Return the scheduler's statistics, the number of errors and the
+        number of messages and bytes fetched per partition.
+
+        :rtype: dict
+        """
+        result = self.scheduler.stats()
+        with self._lock:
+            result[u'errors'] = self.errors
+            result[u'partitions'] = dict(((q, p), {
+                u'messages': s.messages,
+                u'bytes': s.bytes,
+            }) for (q, p), s in self._subscriptions.items())
+        return result
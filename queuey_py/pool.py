@@ -0,0 +1,73 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from contextlib import contextmanager
+from threading import Condition
+from threading import Lock
+import time
+
+
+class ServerPool(object):
+    """Bounds and tracks the requests in flight to a single server.
+
+    The limit matches the size of the underlying keep-alive connection
+    pool, so a request never has to open a throw-away connection. Threads
+    going over the limit wait for a connection to be returned.
+
+    :param maxsize: Maximum number of concurrent connections.
+    :type maxsize: int
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.in_use = 0
+        self.waiting = 0
+        self.requests = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._cond = Condition(Lock())
+
+    def acquire(self):
+        start = time.time()
+        with self._cond:
+            self.waiting += 1
+            while self.in_use >= self.maxsize:
+                self._cond.wait()
+            self.waiting -= 1
+            self.in_use += 1
+            waited = time.time() - start
+            self.requests += 1
+            self.wait_time += waited
+            if waited > self.max_wait:
+                self.max_wait = waited
+
+    def release(self):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """Return a snapshot of the pool occupancy and wait times.
+
+        :rtype: dict
+        """
+        with self._cond:
+            requests = self.requests
+            return {
+                u'maxsize': self.maxsize,
+                u'in_use': self.in_use,
+                u'waiting': self.waiting,
+                u'requests': requests,
+                u'wait_time': self.wait_time,
+                u'max_wait': self.max_wait,
+                u'avg_wait': self.wait_time / requests if requests else 0.0,
+            }
@@ -0,0 +1,70 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from Queue import Full
+from Queue import Queue
+from threading import Event
+from threading import Thread
+import sys
+
+_PAGE = 0
+_ERROR = 1
+_DONE = 2
+
+
+class Prefetcher(object):
+    """Consumes an iterator in a background thread, staying a bounded
+    number of items ahead of the caller.
+
+    Typically the iterator fetches pages of messages, so the next page is
+    requested while the caller still processes the current one. Errors
+    raised by the iterator are re-raised to the caller. Closing the
+    prefetcher, or abandoning iteration over it, stops the thread.
+
+    :param pages: The iterator to consume.
+    :param size: Maximum number of items fetched ahead, defaults to 1.
+    :type size: int
+    """
+
+    def __init__(self, pages, size=1):
+        self.queue = Queue(maxsize=max(size, 1))
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, args=(pages, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _run(self, pages):
+        try:
+            for page in pages:
+                if self.stopped.is_set() or not self._put((_PAGE, page)):
+                    return
+        except Exception:
+            self._put((_ERROR, sys.exc_info()))
+        else:
+            self._put((_DONE, None))
+
+    def __iter__(self):
+        try:
+            while True:
+                kind, value = self.queue.get()
+                if kind == _DONE:
+                    return
+                elif kind == _ERROR:
+                    raise value[0], value[1], value[2]
+                yield value
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the background thread."""
+        self.stopped.set()
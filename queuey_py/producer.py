@@ -0,0 +1,216 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import wait
+from threading import Condition
+from threading import Thread
+import time
+
+from requests.exceptions import ConnectionError
+from requests.exceptions import SSLError
+from requests.exceptions import Timeout
+
+from queuey_py.client import _decode
+from queuey_py.client import HTTPError
+
+
+class _Batch(object):
+
+    def __init__(self, queue_name, deadline):
+        self.queue_name = queue_name
+        self.deadline = deadline
+        self.bodies = []
+        self.futures = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def add(self, body, size, future):
+        self.bodies.append(body)
+        self.futures.append(future)
+        self.size += size
+
+
+class Producer(object):
+    """Collects messages per queue and posts them in batches.
+
+    A batch is posted once it holds `max_messages` messages, once adding
+    another message would grow it beyond `max_bytes` or once its oldest
+    message has waited for `linger` seconds. Batches are posted in order
+    by a background thread.
+
+    :param client: The client used to post messages.
+    :type client: :py:class:`queuey_py.client.Client`
+    :param max_messages: Maximum number of messages per batch, defaults
+        to 100.
+    :type max_messages: int
+    :param max_bytes: Maximum size of all message bodies in a batch in
+        bytes, defaults to 256 KB.
+    :type max_bytes: int
+    :param linger: Maximum number of seconds a message is held back
+        waiting for more messages, defaults to 0.05.
+    :type linger: float
+    :param spool: Optional spool taking batches which couldn't be posted
+        because no server was reachable. Their futures resolve to `None`
+        and the spool posts them once the cluster is back. While the spool
+        has pending messages, new batches are added to it directly, to keep
+        their order and to not wait for unreachable servers.
+    :type spool: :py:class:`queuey_py.spool.Spool`
+    """
+
+    def __init__(self, client, max_messages=100, max_bytes=262144,
+                 linger=0.05, spool=None):
+        self.client = client
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.spool = spool
+        if spool is not None:
+            spool.start(client)
+        self.closed = False
+        self._batches = {}
+        self._ready = deque()
+        self._cond = Condition()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _size(self, body):
+        if isinstance(body, unicode):
+            return len(body.encode('utf-8'))
+        return len(body)
+
+    def send(self, queue_name, body, ttl=None, partition=None, key=None):
+        """Add a message to the batch of its queue.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param body: The message body.
+        :type body: unicode
+        :param ttl: Time to live of the message in seconds, defaults to
+            three days.
+        :type ttl: int
+        :param partition: Partition for the message, defaults to the first
+            partition or the partition the routing key maps to.
+        :type partition: int
+        :param key: Routing key, see
+            :py:meth:`queuey_py.client.Client.partition_for`.
+        :type key: unicode
+        :returns: A future resolving to the key of the message, in
+            `partition:message_id` form, once the batch has been posted.
+        :rtype: :py:class:`concurrent.futures.Future`
+        """
+        future = Future()
+        size = self._size(body)
+        if partition is None and key is not None:
+            partition = self.client.partition_for(queue_name, key)
+        if ttl is not None or partition is not None:
+            message = {u'body': body}
+            if ttl is not None:
+                message[u'ttl'] = ttl
+            if partition is not None:
+                message[u'partition'] = partition
+            body = message
+        with self._cond:
+            if self.closed:
+                raise ValueError(u'Producer has been closed')
+            batch = self._batches.get(queue_name)
+            if batch is not None and batch.size + size > self.max_bytes:
+                self._ready.append(self._batches.pop(queue_name))
+                batch = None
+            if batch is None:
+                batch = _Batch(queue_name, time.time() + self.linger)
+                self._batches[queue_name] = batch
+            batch.add(body, size, future)
+            if len(batch) >= self.max_messages or batch.size >= self.max_bytes:
+                self._ready.append(self._batches.pop(queue_name))
+            self._cond.notify()
+        return future
+
+    def flush(self):
+        """Post all pending messages and wait until they are posted."""
+        with self._cond:
+            futures = [f for batch in self._batches.values()
+                for f in batch.futures]
+            futures.extend([f for batch in self._ready
+                for f in batch.futures])
+            for batch in self._batches.values():
+                batch.deadline = 0
+            self._cond.notify()
+        wait(futures)
+
+    def close(self):
+        """Post all pending messages and stop the background thread, as
+        well as the replay thread of the spool."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self._thread.join()
+        if self.spool is not None:
+            self.spool.close()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                for name, batch in self._batches.items():
+                    if self.closed or batch.deadline <= now:
+                        self._ready.append(self._batches.pop(name))
+                if self._ready:
+                    return self._ready.popleft()
+                if self.closed:
+                    return None
+                timeout = None
+                if self._batches:
+                    deadline = min([b.deadline for b in
+                        self._batches.values()])
+                    timeout = max(deadline - now, 0.001)
+                self._cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._post(batch)
+
+    def _spool(self, batch):
+        self.spool.append(batch.queue_name, batch.bodies)
+        for future in batch.futures:
+            future.set_result(None)
+
+    def _post(self, batch):
+        try:
+            if self.spool is not None and self.spool.pending():
+                return self._spool(batch)
+            try:
+                response = self.client.post(batch.queue_name,
+                    data=batch.bodies)
+            except (ConnectionError, SSLError, Timeout):
+                if self.spool is None:
+                    raise
+                return self._spool(batch)
+            if not response.ok:
+                raise HTTPError(response.status_code, response)
+            keys = [m[u'key'] for m in _decode(response)[u'messages']]
+        except Exception, e:
+            for future in batch.futures:
+                future.set_exception(e)
+            return
+        for future, key in zip(batch.futures, keys):
+            future.set_result(key)
+        if len(keys) < len(batch.futures):
+            error = ValueError(u'Queuey returned %s keys for %s messages' % (
+                len(keys), len(batch.futures)))
+            for future in batch.futures[len(keys):]:
+                future.set_exception(error)
@@ -0,0 +1,213 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from Queue import Empty
+from threading import Event
+import multiprocessing
+
+from queuey_py.client import Client
+from queuey_py.consumer import ConsumerSet
+
+
+def _work(control, app_key, connection, client_options, handler,
+          consumer_options, checkpoints):
+    # runs in a worker process, with a client of its own
+    client = Client(app_key, connection, **client_options)
+    store = checkpoints() if checkpoints is not None else None
+    consumers = ConsumerSet(client, handler, checkpoints=store,
+        **consumer_options)
+    try:
+        while True:
+            try:
+                assignment = control.get(timeout=0.5)
+            except Empty:
+                if consumers.error is not None:
+                    raise consumers.error
+                continue
+            if assignment is None:
+                return
+            consumers.assign(assignment)
+    finally:
+        consumers.close()
+        if store is not None:
+            store.close()
+
+
+class ProcessRunner(object):
+    """Consumes queues with a number of worker processes, to put handlers
+    on all CPU cores.
+
+    The partitions of all queues are spread evenly across the workers.
+    Each worker process builds a new :py:class:`queuey_py.client.Client`
+    after it has been started and runs a
+    :py:class:`queuey_py.consumer.Consumer` for its share of partitions of
+    each queue. If a worker dies, for example because a handler failed, a
+    new worker is started in its place, or without `respawn` its
+    partitions are spread across the remaining workers.
+
+    Workers resume each partition from the checkpoints, so these should be
+    kept in a store shared between processes, such as one using a
+    :py:class:`queuey_py.checkpoint.SQLiteBackend`.
+
+    :param app_key: The applications key used for authorization
+    :type app_key: str
+    :param connection: Connection information for the Queuey server, see
+        :py:class:`queuey_py.client.Client`.
+    :type connection: str
+    :param queues: Maps each queue name to a list of partition numbers to
+        consume or to `None` for all partitions of the queue.
+    :type queues: dict
+    :param handler: Called with each message, in a worker process.
+    :type handler: callable
+    :param processes: Number of worker processes, defaults to the number
+        of CPUs.
+    :type processes: int
+    :param client_options: Further keyword arguments for the client of
+        each worker.
+    :type client_options: dict
+    :param consumer_options: Further keyword arguments for the consumers,
+        such as `workers` or `page_size`.
+    :type consumer_options: dict
+    :param checkpoints: Called without arguments in each worker to create
+        its :py:class:`queuey_py.checkpoint.CheckpointStore`.
+    :type checkpoints: callable
+    :param respawn: Whether or not to replace dead workers, defaults to
+        True.
+    :type respawn: bool
+    """
+
+    def __init__(self, app_key, connection, queues, handler, processes=None,
+                 client_options=None, consumer_options=None,
+                 checkpoints=None, respawn=True):
+        self.app_key = app_key
+        self.connection = connection
+        self.handler = handler
+        self.processes = processes or multiprocessing.cpu_count()
+        self.client_options = client_options or {}
+        self.consumer_options = consumer_options or {}
+        self.checkpoints = checkpoints
+        self.respawn = respawn
+        self.restarts = 0
+        self.partitions = self._partitions(queues)
+        self.assignments = {}
+        self._workers = [None] * self.processes
+        self._controls = [None] * self.processes
+        self._stopped = Event()
+
+    def _partitions(self, queues):
+        result = []
+        client = None
+        for queue_name, partitions in sorted(queues.items()):
+            if partitions is None:
+                if client is None:
+                    client = Client(self.app_key, self.connection,
+                        **self.client_options)
+                partitions = range(1,
+                    client.queue_partitions(queue_name) + 1)
+            result.extend([(queue_name, p) for p in sorted(partitions)])
+        return result
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _spawn(self, slot):
+        control = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=_work, args=(control,
+            self.app_key, self.connection, self.client_options,
+            self.handler, self.consumer_options, self.checkpoints))
+        worker.daemon = True
+        worker.start()
+        self._workers[slot] = worker
+        self._controls[slot] = control
+        self.assignments.pop(slot, None)
+
+    def _assign(self):
+        live = [s for s, w in enumerate(self._workers) if w is not None]
+        result = dict((s, {}) for s in live)
+        for i, (queue_name, partition) in enumerate(self.partitions):
+            if not live:
+                break
+            queues = result[live[i % len(live)]]
+            queues.setdefault(queue_name, []).append(partition)
+        for slot, queues in result.items():
+            if self.assignments.get(slot) != queues:
+                self._controls[slot].put(queues)
+                self.assignments[slot] = queues
+
+    def start(self):
+        """Start the worker processes."""
+        self._stopped.clear()
+        for slot in xrange(self.processes):
+            self._spawn(slot)
+        self._assign()
+
+    def check(self):
+        """Replace dead workers or spread their partitions across the
+        remaining ones.
+
+        :returns: Number of workers found dead.
+        :rtype: int
+        """
+        dead = 0
+        for slot, worker in enumerate(self._workers):
+            if worker is not None and not worker.is_alive():
+                dead += 1
+                self._workers[slot] = None
+                self._controls[slot] = None
+                self.assignments.pop(slot, None)
+                if self.respawn and not self._stopped.is_set():
+                    self.restarts += 1
+                    self._spawn(slot)
+        if dead:
+            self._assign()
+        return dead
+
+    def run(self, interval=1.0):
+        """Start the workers and watch over them until :py:meth:`close` is
+        called from another thread or the process is interrupted.
+
+        :param interval: Seconds between checks of the workers, defaults to
+            1.0.
+        :type interval: float
+        """
+        self.start()
+        try:
+            while not self._stopped.is_set():
+                self.check()
+                self._stopped.wait(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def pids(self):
+        """Return the process ids of the live workers.
+
+        :rtype: list
+        """
+        return [w.pid for w in self._workers if w is not None]
+
+    def close(self, timeout=10.0):
+        """Stop all workers, giving them up to `timeout` seconds to commit
+        their checkpoints before they're terminated.
+
+        :param timeout: Seconds to wait for each worker, defaults to 10.0.
+        :type timeout: float
+        """
+        self._stopped.set()
+        for slot, worker in enumerate(self._workers):
+            if worker is not None and worker.is_alive():
+                self._controls[slot].put(None)
+        for slot, worker in enumerate(self._workers):
+            if worker is not None:
+                worker.join(timeout)
+                if worker.is_alive():
+                    worker.terminate()
+                self._workers[slot] = None
+                self._controls[slot] = None
+        self.assignments = {}
@@ -0,0 +1,264 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from heapq import heappop
+from heapq import heappush
+from threading import Condition
+import time
+
+
+class _Subscription(object):
+
+    def __init__(self, queue_name, partition, since):
+        self.queue_name = queue_name
+        self.partition = partition
+        self.since = since
+        self.delay = 0.0
+        self.active = True
+
+
+class PollScheduler(object):
+    """Decides when to poll each of a number of queue partitions.
+
+    A partition returning a full page is polled again right away. One
+    returning some messages is polled again after `min_delay`. For each
+    empty page in a row, the delay is multiplied by `factor`, up to
+    `max_delay`. Across all partitions, at most `max_rate` polls are
+    started per second.
+
+    The scheduler is thread-safe, so multiple threads can take turns
+    polling the partitions via :py:meth:`wait` and :py:meth:`record`.
+
+    :param min_delay: Seconds to wait before polling a partition which
+        returned less than a full page, defaults to 0.05.
+    :type min_delay: float
+    :param max_delay: Maximum number of seconds between polls of a
+        partition, defaults to 30.0.
+    :type max_delay: float
+    :param factor: Factor the delay grows by after each empty page,
+        defaults to 2.0.
+    :type factor: float
+    :param max_rate: Maximum number of polls per second, defaults to no
+        limit. Up to a second's worth of polls can be made at once.
+    :type max_rate: float
+    """
+
+    def __init__(self, min_delay=0.05, max_delay=30.0, factor=2.0,
+                 max_rate=None):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.max_rate = max_rate
+        self.subscriptions = {}
+        self.polls = 0
+        self.empty = 0
+        self.full = 0
+        self.throttled = 0
+        self._heap = []
+        self._counter = 0
+        self._tokens = max(max_rate or 0, 1)
+        self._updated = time.time()
+        self._cond = Condition()
+
+    def _schedule(self, subscription, delay):
+        subscription.delay = delay
+        self._counter += 1
+        heappush(self._heap, (time.time() + delay, self._counter,
+            subscription))
+        self._cond.notify_all()
+
+    def add(self, queue_name, partition=1, since=None):
+        """Subscribe to a queue partition, to be polled right away.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partition: Partition number, defaults to 1.
+        :type partition: int
+        :param since: Message id after which to start, defaults to the
+            oldest message.
+        :type since: str
+        """
+        with self._cond:
+            key = (queue_name, partition)
+            if key in self.subscriptions:
+                return
+            subscription = _Subscription(queue_name, partition, since)
+            self.subscriptions[key] = subscription
+            self._schedule(subscription, 0.0)
+
+    def remove(self, queue_name, partition=1):
+        """Stop polling a queue partition.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partition: Partition number, defaults to 1.
+        :type partition: int
+        """
+        with self._cond:
+            subscription = self.subscriptions.pop((queue_name, partition),
+                None)
+            if subscription is not None:
+                subscription.active = False
+
+    def _reserve(self, now):
+        # take a token from the rate limit or return the time to wait
+        if not self.max_rate:
+            return 0.0
+        self._tokens = min(max(self.max_rate, 1), self._tokens +
+            (now - self._updated) * self.max_rate)
+        self._updated = now
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0 - self._tokens) / self.max_rate
+
+    def wait(self, timeout=None):
+        """Wait for the next partition due to be polled.
+
+        The partition isn't handed out again until its result has been
+        passed to :py:meth:`record`.
+
+        :param timeout: Maximum number of seconds to wait, defaults to
+            waiting until a partition is due.
+        :type timeout: float
+        :returns: A tuple of queue name, partition and the message id to
+            poll messages after, or `None` on timeout.
+        :rtype: tuple
+        """
+        deadline = timeout is not None and time.time() + timeout
+        throttled = False
+        with self._cond:
+            while True:
+                now = time.time()
+                while self._heap and not self._heap[0][2].active:
+                    heappop(self._heap)
+                delay = None
+                if self._heap:
+                    delay = self._heap[0][0] - now
+                    if delay <= 0:
+                        delay = self._reserve(now)
+                        if delay <= 0:
+                            subscription = heappop(self._heap)[2]
+                            self.polls += 1
+                            self.throttled += throttled
+                            return (subscription.queue_name,
+                                subscription.partition, subscription.since)
+                        throttled = True
+                if deadline:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return None
+                    delay = min(delay, remaining) if delay else remaining
+                self._cond.wait(delay)
+
+    def record(self, queue_name, partition, messages, limit):
+        """Record the result of polling a partition and schedule its next
+        poll.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partition: Partition number.
+        :type partition: int
+        :param messages: The returned messages, empty if polling failed.
+        :type messages: list
+        :param limit: The maximum number of messages which were asked for.
+        :type limit: int
+        """
+        with self._cond:
+            subscription = self.subscriptions.get((queue_name, partition))
+            if subscription is None:
+                return
+            if messages:
+                subscription.since = messages[-1][u'message_id']
+            if len(messages) >= limit:
+                self.full += 1
+                delay = 0.0
+            elif messages:
+                delay = self.min_delay
+            else:
+                self.empty += 1
+                delay = min(max(subscription.delay * self.factor,
+                    self.min_delay), self.max_delay)
+            self._schedule(subscription, delay)
+
+    def due(self):
+        """Return whether or not any partition is due to be polled.
+
+        :rtype: bool
+        """
+        with self._cond:
+            while self._heap and not self._heap[0][2].active:
+                heappop(self._heap)
+            return bool(self._heap) and self._heap[0][0] <= time.time()
+
+    def skip(self, queue_name, partition, delay=0.0):
+        """Hand a partition back without polling it, putting it behind all
+        partitions which are currently due. If none is, the partition is
+        handed out again after `delay` seconds.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param partition: Partition number.
+        :type partition: int
+        :param delay: Seconds to wait if no other partition is due,
+            defaults to 0.0.
+        :type delay: float
+        """
+        with self._cond:
+            subscription = self.subscriptions.get((queue_name, partition))
+            if subscription is None:
+                return
+            self.polls -= 1
+            if self.max_rate:
+                self._tokens += 1.0
+            now = time.time()
+            while self._heap and not self._heap[0][2].active:
+                heappop(self._heap)
+            if not self._heap or self._heap[0][0] > now:
+                now += delay
+            self._counter += 1
+            heappush(self._heap, (now, self._counter, subscription))
+            self._cond.notify_all()
+
+    def poll(self, client, limit=100):
+        """Poll all subscribed partitions as they become due.
+
+        Errors are re-raised after backing off the failed partition.
+
+        :param client: The client used to fetch messages.
+        :type client: :py:class:`queuey_py.client.Client`
+        :param limit: Maximum number of messages per poll, defaults to 100.
+        :type limit: int
+        :raises: :py:exc:`queuey_py.client.HTTPError`
+        :returns: An iterator of queue name, partition and messages tuples,
+            for each non-empty page.
+        :rtype: iterator
+        """
+        while True:
+            queue_name, partition, since = self.wait()
+            try:
+                # the since message itself is returned and filtered out
+                messages = client.messages(queue_name, partition,
+                    since=since, limit=limit + 1 if since else limit)
+            except Exception:
+                self.record(queue_name, partition, [], limit)
+                raise
+            self.record(queue_name, partition, messages, limit)
+            if messages:
+                yield queue_name, partition, messages
+
+    def stats(self):
+        """Return the number of subscriptions, polls, empty and full pages
+        and polls delayed by the rate limit.
+
+        :rtype: dict
+        """
+        with self._cond:
+            return {
+                u'subscriptions': len(self.subscriptions),
+                u'polls': self.polls,
+                u'empty': self.empty,
+                u'full': self.full,
+                u'throttled': self.throttled,
+            }
@@ -0,0 +1,211 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import deque
+from threading import Lock
+from urlparse import urlsplit
+import time
+
+LOCAL_PREFIXES = (u'127.0.0.', u'localhost', u'::1')
+
+# assumed latency of servers without any observed requests, keeps the
+# preference for local servers until real numbers are known
+LOCAL_LATENCY = 0.001
+REMOTE_LATENCY = 0.05
+# a server with only failed requests is treated as that many times slower
+ERROR_PENALTY = 10.0
+# failures are forgotten over time, halving their impact every N seconds
+ERROR_HALF_LIFE = 60.0
+# the latency of a server without new requests returns to the assumed
+# latency, halving the difference every N seconds, so a server which was
+# slow once is tried again eventually
+LATENCY_HALF_LIFE = 60.0
+
+# circuit breaker states
+CLOSED = u'closed'
+OPEN = u'open'
+HALF_OPEN = u'half-open'
+
+
+def parse_server(spec):
+    """Split a single connection entry into its URL and weight.
+
+    An entry is a full URL to the :term:`Queuey` app, optionally followed
+    by a weight, as in `https://10.0.0.1:5001/v1/queuey/;weight=2`.
+
+    :rtype: tuple
+    """
+    url, sep, options = spec.strip().partition(u';')
+    weight = 1.0
+    for option in options.split(u';'):
+        if option.strip():
+            key, value = option.split(u'=', 1)
+            if key.strip() == u'weight':
+                weight = float(value)
+    if weight <= 0:
+        raise ValueError(u'Invalid server weight: %s' % spec)
+    return url.strip(), weight
+
+
+class Server(object):
+    """Tracks the observed latency and error rate of a single server.
+
+    Both are kept as exponentially weighted moving averages, which return
+    to their assumed values while no requests are made. The server
+    also acts as a circuit breaker. A connection failure opens the breaker
+    and takes the server out of rotation. Once `reset_timeout` seconds
+    have passed, the breaker becomes half-open and a single probe request
+    is allowed, which either closes the breaker again or reopens it.
+
+    :param url: Full URL to the Queuey app on this server.
+    :type url: str
+    :param weight: Relative preference for this server, defaults to 1.0.
+        A server with weight 2 is picked over a server with weight 1 up to
+        twice its latency.
+    :type weight: float
+    :param alpha: Smoothing factor for new observations, defaults to 0.3.
+    :type alpha: float
+    :param reset_timeout: Seconds before a failed server is probed again,
+        defaults to 30.0.
+    :type reset_timeout: float
+    """
+
+    def __init__(self, url, weight=1.0, alpha=0.3, reset_timeout=30.0):
+        self.url = url
+        self.weight = weight
+        self.alpha = alpha
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.opened = None
+        self.local = urlsplit(url).netloc.startswith(LOCAL_PREFIXES)
+        self._latency = None
+        self._latency_time = None
+        self.requests = 0
+        self.failures = 0
+        self._errors = 0.0
+        self._errors_time = time.time()
+        self._samples = deque(maxlen=100)
+        self._lock = Lock()
+
+    def _decayed_errors(self, now):
+        elapsed = now - self._errors_time
+        return self._errors * 0.5 ** (elapsed / ERROR_HALF_LIFE)
+
+    def _decayed_latency(self, now):
+        if self._latency is None:
+            return None
+        prior = self.local and LOCAL_LATENCY or REMOTE_LATENCY
+        elapsed = now - self._latency_time
+        return prior + (self._latency - prior) * \
+            0.5 ** (elapsed / LATENCY_HALF_LIFE)
+
+    def record(self, latency=None, error=False):
+        """Record the outcome of a single request.
+
+        :param latency: Duration of a successful request in seconds.
+        :type latency: float
+        :param error: Whether or not the request failed.
+        :type error: bool
+        """
+        now = time.time()
+        alpha = self.alpha
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.failures += 1
+            errors = self._decayed_errors(now)
+            self._errors = errors + alpha * ((error and 1.0 or 0.0) - errors)
+            self._errors_time = now
+            if latency is not None:
+                self._samples.append(latency)
+                current = self._decayed_latency(now)
+                if current is None:
+                    self._latency = latency
+                else:
+                    self._latency = current + alpha * (latency - current)
+                self._latency_time = now
+
+    def percentile(self, fraction):
+        """Return a percentile of the last 100 observed latencies, or
+        `None` if fewer than ten requests have been observed.
+
+        :param fraction: The percentile as a fraction, like 0.95.
+        :type fraction: float
+        :rtype: float
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < 10:
+            return None
+        return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+    def after_fork(self):
+        """Replace the lock in a forked child process, where it might have
+        been left held by a thread of the parent process."""
+        self._lock = Lock()
+
+    def mark_failure(self):
+        """Open the circuit breaker."""
+        with self._lock:
+            self.state = OPEN
+            self.opened = time.time()
+
+    def mark_success(self):
+        """Close the circuit breaker."""
+        with self._lock:
+            self.state = CLOSED
+            self.opened = None
+
+    def probe_due(self):
+        """Check whether an open breaker should be probed.
+
+        Moves the breaker to half-open once the reset timeout has passed
+        and only returns `True` for the single caller that should send
+        the probe.
+
+        :rtype: bool
+        """
+        if self.state != OPEN:
+            return False
+        with self._lock:
+            if (self.state == OPEN and
+                time.time() - self.opened >= self.reset_timeout):
+                self.state = HALF_OPEN
+                return True
+        return False
+
+    @property
+    def error_rate(self):
+        return self._decayed_errors(time.time())
+
+    @property
+    def latency(self):
+        return self._decayed_latency(time.time())
+
+    def score(self):
+        """Return the expected cost of a request, lower is better.
+
+        :rtype: float
+        """
+        latency = self.latency
+        if latency is None:
+            latency = self.local and LOCAL_LATENCY or REMOTE_LATENCY
+        penalty = 1.0 + ERROR_PENALTY * self.error_rate
+        return latency * penalty / self.weight
+
+    def stats(self):
+        """Return a snapshot of the observed performance.
+
+        :rtype: dict
+        """
+        return {
+            u'weight': self.weight,
+            u'local': self.local,
+            u'latency': self.latency,
+            u'error_rate': self.error_rate,
+            u'requests': self.requests,
+            u'failures': self.failures,
+            u'score': self.score(),
+            u'state': self.state,
+        }
@@ -0,0 +1,249 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from threading import Event
+from threading import Lock
+from threading import Thread
+import logging
+import os
+import time
+
+from requests.exceptions import ConnectionError
+from requests.exceptions import SSLError
+from requests.exceptions import Timeout
+import ujson
+
+from queuey_py.client import HTTPError
+
+SUFFIX = u'.spool'
+REJECTED = u'rejected.jsonl'
+# statuses with which Queuey refuses a batch for good
+REJECT_STATUSES = (400, 404, 413)
+
+log = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """An append-only on-disk outbox for messages which couldn't be posted.
+
+    Messages are written as one JSON line per batch to segment files in
+    `directory`. Writes are synced to disk in batches, once `sync_every`
+    batches have been written or `sync_interval` seconds have passed. A
+    background thread started via :py:meth:`start` waits for the
+    :term:`Queuey` cluster to respond to a heartbeat again and replays the
+    spooled messages in large batches, deleting each segment once all of
+    its messages have been posted. Messages may be posted more than once
+    if replaying fails halfway through a segment.
+
+    Batches the cluster refuses as invalid, too large or for a queue which
+    has been deleted would never be accepted. They are moved to a
+    `rejected.jsonl` file in `directory` instead, together with the
+    response status code, and logged. Batches failing with any other
+    status are kept for the next replay.
+
+    :param directory: Directory holding the segment files, created if it
+        doesn't exist yet.
+    :type directory: str
+    :param segment_size: Size in bytes after which a new segment file is
+        started, defaults to 16 MB.
+    :type segment_size: int
+    :param sync_every: Number of writes after which to sync the segment to
+        disk, defaults to 100.
+    :type sync_every: int
+    :param sync_interval: Maximum number of seconds between syncs, defaults
+        to 0.1.
+    :type sync_interval: float
+    """
+
+    def __init__(self, directory, segment_size=16777216, sync_every=100,
+                 sync_interval=0.1):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = Lock()
+        self._file = None
+        self._unsynced = 0
+        self._synced = time.time()
+        self._stopped = Event()
+        self._thread = None
+        self.rejected = 0
+        segments = self.segments()
+        # number of segment files, kept in memory to not list the directory
+        # for every pending check
+        self._segment_count = len(segments)
+        self._number = segments and self._segment_number(segments[-1]) or 0
+
+    def _segment_number(self, path):
+        return int(os.path.basename(path)[:-len(SUFFIX)])
+
+    def segments(self):
+        """Return the paths of all segment files, oldest first.
+
+        :rtype: list
+        """
+        names = [n for n in os.listdir(self.directory) if n.endswith(SUFFIX)]
+        names.sort()
+        return [os.path.join(self.directory, n) for n in names]
+
+    def pending(self):
+        """Return whether or not there are spooled messages.
+
+        :rtype: bool
+        """
+        with self._lock:
+            if self._file is None:
+                return self._segment_count > 0
+            return self._file.tell() > 0 or self._segment_count > 1
+
+    def append(self, queue_name, bodies):
+        """Add a batch of messages to the spool.
+
+        :param queue_name: Queue name
+        :type queue_name: unicode
+        :param bodies: The message bodies.
+        :type bodies: list
+        """
+        line = ujson.encode({u'queue_name': queue_name, u'bodies': bodies})
+        with self._lock:
+            if self._file is None:
+                self._number += 1
+                path = os.path.join(self.directory,
+                    u'%020d%s' % (self._number, SUFFIX))
+                self._file = open(path, 'ab')
+                self._segment_count += 1
+            self._file.write(line + '\n')
+            self._file.flush()
+            self._unsynced += 1
+            if (self._unsynced >= self.sync_every or
+                time.time() - self._synced >= self.sync_interval):
+                self._sync()
+            if self._file.tell() >= self.segment_size:
+                self._close_segment()
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced = time.time()
+
+    def _close_segment(self):
+        self._sync()
+        self._file.close()
+        self._file = None
+
+    def sync(self):
+        """Sync all written messages to disk."""
+        with self._lock:
+            self._sync()
+
+    def _read(self, path):
+        with open(path, 'rb') as segment:
+            for line in segment:
+                # ignore a partially written last line
+                if line.endswith('\n'):
+                    yield ujson.decode(line)
+
+    def _reject(self, queue_name, bodies, status):
+        log.error(u'Queuey refused %s spooled messages for queue %s with '
+            u'status %s, moving them to %s', len(bodies), queue_name, status,
+            REJECTED)
+        line = ujson.encode({u'queue_name': queue_name, u'bodies': bodies,
+            u'status': status})
+        with open(os.path.join(self.directory, REJECTED), 'ab') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.rejected += len(bodies)
+
+    def replay(self, client, batch_size=1000):
+        """Post all spooled messages.
+
+        :param client: The client used to post messages.
+        :type client: :py:class:`queuey_py.client.Client`
+        :param batch_size: Maximum number of messages per request, defaults
+            to 1000.
+        :type batch_size: int
+        :raises: :py:exc:`requests.exceptions.ConnectionError` and other
+            request errors, :py:exc:`queuey_py.client.HTTPError` for error
+            responses other than rejections
+        :returns: Number of posted messages.
+        :rtype: int
+        """
+        with self._lock:
+            if self._file is not None and self._file.tell() > 0:
+                self._close_segment()
+        posted = 0
+        for path in self.segments():
+            with self._lock:
+                if self._file is not None and path == self._file.name:
+                    break
+            batches = {}
+            for record in self._read(path):
+                bodies = batches.setdefault(record[u'queue_name'], [])
+                bodies.extend(record[u'bodies'])
+            for queue_name, bodies in sorted(batches.items()):
+                for i in xrange(0, len(bodies), batch_size):
+                    chunk = bodies[i:i + batch_size]
+                    response = client.post(queue_name, data=chunk)
+                    if not response.ok:
+                        if response.status_code not in REJECT_STATUSES:
+                            raise HTTPError(response.status_code, response)
+                        self._reject(queue_name, chunk,
+                            response.status_code)
+                        continue
+                    posted += len(chunk)
+            os.remove(path)
+            with self._lock:
+                self._segment_count -= 1
+        return posted
+
+    def start(self, client, interval=5.0, batch_size=1000):
+        """Start a background thread replaying the spool once the
+        :term:`Queuey` cluster is reachable.
+
+        :param client: The client used to post messages.
+        :type client: :py:class:`queuey_py.client.Client`
+        :param interval: Seconds between replay attempts, defaults to 5.0.
+        :type interval: float
+        :param batch_size: Maximum number of messages per request, defaults
+            to 1000.
+        :type batch_size: int
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = Thread(target=self._run,
+            args=(client, interval, batch_size))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, client, interval, batch_size):
+        attempt = 0
+        while not self._stopped.is_set():
+            self.sync()
+            if self.pending() and time.time() - attempt >= interval:
+                attempt = time.time()
+                try:
+                    if client.connect().ok:
+                        self.replay(client, batch_size=batch_size)
+                except (ConnectionError, SSLError, Timeout):
+                    # the cluster is still unreachable, try again later
+                    pass
+                except Exception:
+                    # keep the messages for the next attempt
+                    log.exception(u'Replaying the spool failed')
+            self._stopped.wait(self.sync_interval)
+
+    def close(self):
+        """Stop the background thread and sync the current segment."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            if self._file is not None:
+                self._close_segment()
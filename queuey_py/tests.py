@@ -3,6 +3,14 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import multiprocessing
+import os
+import pickle
+import select
+import shutil
+import signal
+import tempfile
+import threading
 import xmlrpclib
 import time
 import urllib
@@ -12,10 +20,43 @@ import uuid
 import mock
 from requests.exceptions import ConnectionError
 from requests.exceptions import Timeout
+from requests.models import Response
 import ujson
 
+from queuey_py import AsyncClient
 from queuey_py import Client
+from queuey_py import Consumer
+from queuey_py.consumer import ConsumerSet
 from queuey_py import HTTPError
+from queuey_py import Producer
+from queuey_py.client import _decode
+from queuey_py.client import hash_partition
+from queuey_py.client import message_time
+from queuey_py.budget import RetryBudget
+from queuey_py.checkpoint import CheckpointStore
+from queuey_py.checkpoint import FileBackend
+from queuey_py.checkpoint import MemoryBackend
+from queuey_py.checkpoint import SQLiteBackend
+from queuey_py.dedup import Deduplicator
+from queuey_py.dedup import LRUSet
+from queuey_py.dedup import ScalableBloomFilter
+from queuey_py.lease import FileLeaseBackend
+from queuey_py.lease import LeaseManager
+from queuey_py.lease import MemoryLeaseBackend
+from queuey_py.metrics import Hooks
+from queuey_py.metrics import LatencyHistogram
+from queuey_py.metrics import MetricsCollector
+from queuey_py.poller import MultiQueuePoller
+from queuey_py.pool import ServerPool
+from queuey_py.runner import ProcessRunner
+from queuey_py.prefetch import Prefetcher
+from queuey_py.spool import Spool
+from queuey_py.scheduler import PollScheduler
+from queuey_py.servers import CLOSED
+from queuey_py.servers import HALF_OPEN
+from queuey_py.servers import OPEN
+from queuey_py.servers import parse_server
+from queuey_py.servers import Server
 
 processes = {}
 
@@ -90,11 +131,145 @@ class TestQueueyConnection(unittest.TestCase):
         servers.remove(conn.app_url)
         self.assertEqual(conn.fallback_urls, servers)
 
+    def test_configure_connection_weight(self):
+        servers = [u'https://10.0.0.1:5001/v1/queuey/;weight=0.5',
+                   u'https://10.0.0.2:5001/v1/queuey/; weight=4']
+        conn = self._make_one(u','.join(servers))
+        self.assertEqual(conn.app_url, u'https://10.0.0.2:5001/v1/queuey/')
+        self.assertEqual(conn.fallback_urls,
+            [u'https://10.0.0.1:5001/v1/queuey/'])
+        stats = conn.server_stats()
+        self.assertEqual(stats[conn.app_url][u'weight'], 4.0)
+
+    def test_rebalance_fastest(self):
+        servers = [u'https://127.0.0.1:5001/v1/queuey/',
+                   u'https://127.0.0.1:5002/v1/queuey/']
+        conn = self._make_one(u','.join(servers))
+        slow = conn.app_url
+        fast = conn.fallback_urls[0]
+        conn.servers[slow].record(1.0)
+        conn.servers[fast].record(0.0001)
+        response = conn.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(conn.app_url, fast)
+        self.assertEqual(conn.fallback_urls, [slow])
+        stats = conn.server_stats()
+        self.assertEqual(stats[slow][u'requests'], 2)
+
+    def test_pickle(self):
+        conn = Client(self.queuey_app_key,
+            connection=u'https://127.0.0.1:5001/v1/queuey/;weight=2,'
+            u'https://127.0.0.1:5002/v1/queuey/', retries=5, timeout=2.0,
+            pool_maxsize=3, retry_budget=RetryBudget(ratio=0.5))
+        conn.connect()
+        data = pickle.dumps(conn, 2)
+        self.assertTrue(len(data) < 1000, len(data))
+        copy = pickle.loads(data)
+        self.assertEqual(copy.connection, conn.connection)
+        self.assertEqual([copy.servers[u].weight for u in copy.connection],
+            [2.0, 1.0])
+        self.assertEqual((copy.retries, copy.timeout, copy.pool_maxsize),
+            (5, 2.0, 3))
+        self.assertEqual(copy.retry_budget.ratio, 0.5)
+        self.assertNotEqual(copy.session, conn.session)
+        self.assertEqual(copy.pool_stats(), {})
+        self.assertTrue(copy.connect().ok)
+
+    def test_fork(self):
+        conn = self._make_one()
+        self.assertTrue(conn.connect().ok)
+        session = conn.session
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # child process
+            try:
+                ok = conn.connect().ok and conn.session is not session and \
+                    conn.pool_stats().values()[0][u'requests'] == 1
+                os.write(write, ok and b'ok' or b'fail')
+            finally:
+                os._exit(0)
+        os.close(write)
+        result = os.read(read, 10)
+        os.close(read)
+        os.waitpid(pid, 0)
+        self.assertEqual(result, b'ok')
+        self.assertTrue(conn.session is session)
+        self.assertTrue(conn.connect().ok)
+
+    def test_fork_server_lock(self):
+        conn = self._make_one()
+        self.assertTrue(conn.connect().ok)
+        server = conn.servers[conn.app_url]
+        read, write = os.pipe()
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with server._lock:
+                held.set()
+                release.wait()
+
+        # fork while another thread holds the server's lock
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        pid = os.fork()
+        if pid == 0:
+            # child process
+            try:
+                ok = conn.connect().ok and \
+                    conn.server_stats()[conn.app_url][u'requests'] == 2
+                os.write(write, ok and b'ok' or b'fail')
+            finally:
+                os._exit(0)
+        os.close(write)
+        release.set()
+        thread.join()
+        # a deadlocked child doesn't answer
+        result = b'timeout'
+        if select.select([read], [], [], 10)[0]:
+            result = os.read(read, 10)
+        else:
+            os.kill(pid, signal.SIGKILL)
+        os.close(read)
+        os.waitpid(pid, 0)
+        self.assertEqual(result, b'ok')
+
     def test_connect(self):
         conn = self._make_one()
         response = conn.connect()
         self.assertEqual(response.status_code, 200)
 
+    def test_pool_stats(self):
+        conn = self._make_one()
+        conn.connect()
+        conn.get()
+        stats = conn.pool_stats()
+        self.assertEqual(stats.keys(), [u'https://127.0.0.1:5001'])
+        server = stats[u'https://127.0.0.1:5001']
+        self.assertEqual(server[u'maxsize'], 1)
+        self.assertEqual(server[u'in_use'], 0)
+        self.assertEqual(server[u'requests'], 2)
+
+    def test_pool_shared_threads(self):
+        conn = Client(self.queuey_app_key, pool_maxsize=2)
+        results = []
+
+        def work():
+            for i in range(5):
+                results.append(conn.get().status_code)
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [200] * 20)
+        stats = conn.pool_stats()[u'https://127.0.0.1:5001']
+        self.assertEqual(stats[u'requests'], 20)
+        self.assertEqual(stats[u'in_use'], 0)
+        self.assertEqual(stats[u'waiting'], 0)
+
     def test_connect_fail(self):
         conn = self._make_one(connection=u'https://127.0.0.1:9/')
         self.assertRaises(ConnectionError, conn.connect)
@@ -106,6 +281,95 @@ class TestQueueyConnection(unittest.TestCase):
             self.assertRaises(Timeout, conn.connect)
             self.assertEqual(len(head_mock.mock_calls), conn.retries)
 
+    def test_connect_timeout_backoff(self):
+        conn = Client(self.queuey_app_key, retries=4, backoff=0.1,
+            max_backoff=0.3)
+        with mock.patch(u'requests.sessions.Session.head') as head_mock:
+            head_mock.side_effect = Timeout
+            with mock.patch(u'time.sleep') as sleep_mock:
+                self.assertRaises(Timeout, conn.connect)
+            delays = [c[1][0] for c in sleep_mock.mock_calls]
+            self.assertEqual(len(delays), 3)
+            for delay, limit in zip(delays, [0.1, 0.2, 0.3]):
+                self.assertTrue(0 <= delay <= limit, delays)
+
+    def test_connect_timeout_budget(self):
+        budget = RetryBudget(min_per_second=0.0, capacity=1.0)
+        conn = Client(self.queuey_app_key, retry_budget=budget)
+        error = Timeout(u'original')
+        with mock.patch(u'requests.sessions.Session.head') as head_mock:
+            head_mock.side_effect = error
+            try:
+                conn.connect()
+            except Timeout, e:
+                self.assertTrue(e is error)
+            else:
+                self.fail(u'Timeout not raised')
+            # one retry from the initial token
+            self.assertEqual(len(head_mock.mock_calls), 2)
+        stats = conn.retry_stats()
+        self.assertEqual(stats[u'retries'], 1)
+        self.assertEqual(stats[u'exhausted'], 1)
+
+    def test_hooks(self):
+        collector = MetricsCollector()
+        events = []
+
+        class Recorder(Hooks):
+
+            def before_request(self, server, method, url):
+                events.append((u'before', method))
+
+            def after_response(self, server, method, response, latency,
+                               sent, received):
+                events.append((u'after', method, response.status_code))
+
+        conn = Client(self.queuey_app_key, hooks=[collector, Recorder()])
+        name = conn.create_queue()
+        conn.post(name, data=u'Hello')
+        response = conn.get(name)
+        self.assertEqual(events, [(u'before', u'post'),
+            (u'after', u'post', 201), (u'before', u'post'),
+            (u'after', u'post', 201), (u'before', u'get'),
+            (u'after', u'get', 200)])
+        stats = collector.stats()
+        self.assertEqual(stats[u'requests'], 3)
+        self.assertEqual(stats[u'errors'], 0)
+        self.assertEqual(stats[u'methods'][u'post'][u'count'], 2)
+        self.assertEqual(stats[u'methods'][u'get'][u'count'], 1)
+        self.assertEqual(stats[u'servers'][conn.app_url][u'count'], 3)
+        self.assertTrue(stats[u'methods'][u'get'][u'p50'] > 0)
+        self.assertTrue(stats[u'bytes_sent'] >= len(u'Hello'))
+        self.assertTrue(stats[u'bytes_received'] >= len(response.content))
+        # hooks aren't configuration
+        self.assertEqual(pickle.loads(pickle.dumps(conn)).hooks, [])
+
+    def test_hooks_retry(self):
+        collector = MetricsCollector()
+        conn = Client(self.queuey_app_key, backoff=0.0, hooks=[collector])
+        with mock.patch(u'requests.sessions.Session.head') as head_mock:
+            head_mock.side_effect = Timeout
+            self.assertRaises(Timeout, conn.connect)
+        stats = collector.stats()
+        self.assertEqual(stats[u'requests'], conn.retries)
+        self.assertEqual(stats[u'errors'], conn.retries)
+        self.assertEqual(stats[u'retries'], conn.retries - 1)
+        self.assertEqual(stats[u'methods'], {})
+
+    def test_hooks_fallback(self):
+        collector = MetricsCollector()
+        conn = Client(self.queuey_app_key, hooks=[collector],
+            connection=u'https://127.0.0.1:9/,'
+                u'https://127.0.0.1:5002/v1/queuey/')
+        unreachable, reachable = conn.connection
+        conn.app_url = unreachable
+        conn.fallback_urls = [reachable]
+        self.assertTrue(conn.connect().ok)
+        stats = collector.stats()
+        self.assertEqual(stats[u'fallbacks'], 1)
+        self.assertEqual(stats[u'errors'], 1)
+        self.assertEqual(stats[u'servers'].keys(), [reachable])
+
     def test_connect_multiple(self):
         conn = self._make_one(connection=u'https://127.0.0.1:5001/v1/queuey/,'
             u'https://127.0.0.1:5002/v1/queuey/')
@@ -124,6 +388,51 @@ class TestQueueyConnection(unittest.TestCase):
         response = conn.connect()
         self.assertEqual(response.status_code, 200)
 
+    def test_connect_multiple_recover(self):
+        servers = [u'https://127.0.0.1:5001/v1/queuey/',
+                   u'https://127.0.0.1:5002/v1/queuey/']
+        conn = Client(self.queuey_app_key, connection=u','.join(servers),
+            reset_timeout=0.0)
+        failed = conn.app_url
+        conn.servers[failed].mark_failure()
+        self.assertTrue(conn._fail_over(failed))
+        self.assertEqual(conn.failed_urls, [failed])
+        self.assertEqual(conn.recover(), [failed])
+        self.assertEqual(conn.failed_urls, [])
+        self.assertEqual(set([conn.app_url] + conn.fallback_urls),
+            set(servers))
+        self.assertEqual(conn.server_stats()[failed][u'state'], u'closed')
+
+    def test_connect_multiple_recover_unreachable(self):
+        conn = Client(self.queuey_app_key, connection=u'https://127.0.0.1:9/,'
+            u'https://127.0.0.1:5002/v1/queuey/', reset_timeout=0.0)
+        conn.app_url = u'https://127.0.0.1:9/'
+        conn.fallback_urls = [u'https://127.0.0.1:5002/v1/queuey/']
+        response = conn.connect()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(conn.failed_urls, [u'https://127.0.0.1:9/'])
+        self.assertEqual(conn.recover(), [])
+        self.assertEqual(conn.failed_urls, [u'https://127.0.0.1:9/'])
+        stats = conn.server_stats()[u'https://127.0.0.1:9/']
+        self.assertEqual(stats[u'state'], u'open')
+        self.assertEqual(stats[u'failures'], 2)
+
+    def test_connect_multiple_recover_timeout(self):
+        servers = [u'https://127.0.0.1:5001/v1/queuey/',
+                   u'https://127.0.0.1:5002/v1/queuey/']
+        conn = Client(self.queuey_app_key, connection=u','.join(servers),
+            reset_timeout=0.0)
+        failed = conn.app_url
+        conn.servers[failed].mark_failure()
+        self.assertTrue(conn._fail_over(failed))
+        with mock.patch(u'requests.sessions.Session.head') as head_mock:
+            head_mock.side_effect = Timeout
+            self.assertEqual(conn.recover(), [])
+        self.assertEqual(conn.server_stats()[failed][u'state'], u'open')
+        # the next probe succeeds
+        self.assertEqual(conn.recover(), [failed])
+        self.assertEqual(conn.failed_urls, [])
+
     def test_get(self):
         conn = self._make_one()
         response = conn.get()
@@ -137,6 +446,37 @@ class TestQueueyConnection(unittest.TestCase):
             self.assertRaises(Timeout, conn.get)
             self.assertEqual(len(get_mock.mock_calls), conn.retries)
 
+    def test_get_hedge(self):
+        servers = [u'https://127.0.0.1:5001/v1/queuey/',
+                   u'https://127.0.0.1:5002/v1/queuey/']
+        conn = Client(self.queuey_app_key, connection=u','.join(servers),
+            hedge=True)
+        primary = conn.app_url
+        backup = conn.fallback_urls[0]
+        for i in range(20):
+            conn.servers[primary].record(0.01)
+
+        def slow_primary(url, **kwargs):
+            if url.startswith(primary):
+                time.sleep(0.5)
+            return mock.Mock(status_code=200, ok=True, url=url)
+        with mock.patch(u'requests.sessions.Session.get') as get_mock:
+            get_mock.side_effect = slow_primary
+            response = conn.get(u'foo')
+        self.assertEqual(response.url, backup + u'foo')
+        self.assertEqual(conn.hedge_stats(),
+            {u'hedged': 1, u'backup_wins': 1})
+
+    def test_get_hedge_fast(self):
+        servers = [u'https://127.0.0.1:5001/v1/queuey/',
+                   u'https://127.0.0.1:5002/v1/queuey/']
+        conn = Client(self.queuey_app_key, connection=u','.join(servers),
+            hedge=True)
+        for i in range(5):
+            response = conn.get()
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(conn.hedge_stats()[u'backup_wins'], 0)
+
     def test_get_multiple_first_unreachable(self):
         conn = self._make_one(connection=u'https://127.0.0.1:9/,'
             u'https://127.0.0.1:5002/v1/queuey/')
@@ -207,6 +547,111 @@ class TestQueueyConnection(unittest.TestCase):
         result = ujson.decode(response.text)
         self.assertEqual(len(result[u'messages']), 3, result)
 
+    def test_post_messages_routing(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=4)
+        keys = conn.post_messages(name, [
+            u'a',
+            {u'body': u'b', u'partition': 3, u'ttl': 60},
+            {u'body': u'c', u'key': u'user-1'},
+            {u'body': u'd', u'key': u'user-1'},
+        ])
+        self.assertEqual(len(keys), 4)
+        self.assertEqual(keys[0][:2], u'1:')
+        self.assertEqual(keys[1][:2], u'3:')
+        partition = conn.partition_for(name, u'user-1')
+        self.assertEqual(partition, hash_partition(u'user-1', 4))
+        self.assertEqual(keys[2][:2], u'%s:' % partition)
+        self.assertEqual(keys[3][:2], u'%s:' % partition)
+        with mock.patch.object(conn, u'post', wraps=conn.post) as post_mock:
+            conn.post_messages(name, [{u'body': u'e', u'ttl': 0}, u'f'],
+                ttl=60)
+            data = post_mock.mock_calls[0][2][u'data']
+        self.assertEqual([m[u'ttl'] for m in data], [0, 60])
+        result = conn.post_messages(uuid.uuid4().hex, [u'no such queue'])
+        self.assertEqual(result, [None])
+        self.assertEqual(result.errors[0][:2], (0, 1))
+        self.assertTrue(isinstance(result.errors[0][2], HTTPError))
+
+    def test_post_messages_chunks(self):
+        conn = self._make_one()
+        name = conn.create_queue()
+        bodies = [u'message %s' % i for i in range(25)]
+        with mock.patch.object(conn, u'post', wraps=conn.post) as post_mock:
+            keys = conn.post_messages(name, bodies, max_messages=10)
+            self.assertEqual(sorted([len(c[2][u'data']) for c in
+                post_mock.mock_calls]), [5, 10, 10])
+        self.assertEqual(keys.errors, [])
+        # chunks are posted concurrently, so only keep order within a chunk
+        messages = dict((u'1:' + m[u'message_id'], m[u'body'])
+            for m in conn.messages(name, limit=50))
+        self.assertEqual([messages[k] for k in keys], bodies)
+        with mock.patch.object(conn, u'post', wraps=conn.post) as post_mock:
+            keys = conn.post_messages(name, [u'x' * 100] * 4, max_bytes=300)
+            self.assertEqual(len(post_mock.mock_calls), 2)
+        self.assertEqual(len([k for k in keys if k]), 4)
+
+    def test_post_messages_chunk_error(self):
+        conn = self._make_one()
+        name = conn.create_queue()
+        post = conn.post
+
+        def failing_post(queue_name, data):
+            if data[0][u'body'] == u'message 2':
+                raise Timeout()
+            return post(queue_name, data=data)
+
+        with mock.patch.object(conn, u'post', failing_post):
+            keys = conn.post_messages(name,
+                [u'message %s' % i for i in range(6)], max_messages=2)
+        self.assertEqual([k is None for k in keys],
+            [False, False, True, True, False, False])
+        self.assertEqual(len(keys.errors), 1)
+        self.assertEqual(keys.errors[0][:2], (2, 2))
+        self.assertTrue(isinstance(keys.errors[0][2], Timeout))
+
+    def test_delete_messages(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=2)
+        keys = conn.post_messages(name, [{u'body': u'message %s' % i,
+            u'partition': i % 2 + 1} for i in range(30)])
+        with mock.patch.object(conn, u'delete',
+                wraps=conn.delete) as delete_mock:
+            errors = conn.delete_messages(name, keys[:20],
+                max_url_length=len(conn.app_url) + len(name) + 200)
+            self.assertEqual(errors, [])
+            urls = [c[1][0] for c in delete_mock.mock_calls]
+        self.assertTrue(len(urls) > 2, urls)
+        for url in urls:
+            partitions = set([k.split(u'%3A')[0] for k in
+                url.split(u'/')[1].split(u',')])
+            self.assertEqual(len(partitions), 1, url)
+        bodies = [m[u'body'] for p in (1, 2) for m in
+            conn.messages(name, partition=p)]
+        self.assertEqual(sorted(bodies),
+            sorted([u'message %s' % i for i in range(20, 30)]))
+        errors = conn.delete_messages(uuid.uuid4().hex, keys[20:])
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(isinstance(errors[0][1], HTTPError))
+
+    def test_update_messages(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=2)
+        keys = conn.post_messages(name, [{u'body': u'old %s' % i,
+            u'partition': i % 2 + 1} for i in range(10)])
+        updates = dict([(k, u'new %s' % i) for i, k in enumerate(keys)])
+        missing = uuid.uuid1().hex
+        updates[missing] = u'created'
+        results = conn.update_messages(name, updates, concurrency=3)
+        self.assertEqual(results, dict([(k, None) for k in updates]))
+        bodies = [m[u'body'] for p in (1, 2) for m in
+            conn.messages(name, partition=p)]
+        self.assertEqual(sorted(bodies),
+            sorted([u'new %s' % i for i in range(10)] + [u'created']))
+        results = conn.update_messages(uuid.uuid4().hex,
+            [(keys[0], u'no such queue')])
+        self.assertTrue(isinstance(results[keys[0]], HTTPError))
+
     def test_create_queue(self):
         conn = self._make_one()
         name = conn.create_queue()
@@ -259,6 +704,444 @@ class TestQueueyConnection(unittest.TestCase):
         self.assertEqual(len(messages), 1)
         self.assertEqual(messages[0][u'body'], u'Hello 2')
 
+    def test_messages_since_key(self):
+        conn = self._make_one()
+        fetched = [{u'message_id': uuid.uuid1().hex, u'body': u'a'},
+            {u'message_id': uuid.uuid1().hex, u'body': u'b'}]
+        with mock.patch.object(conn, u'_fetch') as fetch_mock:
+            fetch_mock.return_value = fetched
+            # the since message itself is filtered out, given as a key
+            messages = conn.messages(u'queue', since=u'1:' +
+                fetched[0][u'message_id'])
+        self.assertEqual(messages, fetched[1:])
+
+    def test_iter_messages(self):
+        conn = self._make_one()
+        name = conn.create_queue()
+        bodies = [u'message %s' % i for i in range(250)]
+        conn.post(name, data=bodies)
+        messages = list(conn.iter_messages(name, page_size=100))
+        self.assertEqual([m[u'body'] for m in messages], bodies)
+        messages = list(conn.iter_messages(name,
+            since=messages[199][u'message_id'], page_size=30, prefetch=3))
+        self.assertEqual([m[u'body'] for m in messages], bodies[200:])
+
+    def test_iter_messages_page_size_one(self):
+        conn = self._make_one()
+        name = conn.create_queue()
+        bodies = [u'message %s' % i for i in range(5)]
+        conn.post(name, data=bodies)
+        messages = list(conn.iter_messages(name, page_size=1))
+        self.assertEqual([m[u'body'] for m in messages], bodies)
+        messages = list(conn.iter_messages(name, page_size=1,
+            since=messages[1][u'message_id']))
+        self.assertEqual([m[u'body'] for m in messages], bodies[2:])
+
+    def test_iter_messages_follow(self):
+        conn = self._make_one()
+        name = conn.create_queue()
+        conn.post(name, data=[u'a', u'b'])
+        messages = conn.iter_messages(name, page_size=10, follow=True,
+            poll_interval=0.1)
+        self.assertEqual(messages.next()[u'body'], u'a')
+        self.assertEqual(messages.next()[u'body'], u'b')
+        conn.post(name, data=[u'c'])
+        self.assertEqual(messages.next()[u'body'], u'c')
+        messages.close()
+
+    def test_iter_messages_checkpoints(self):
+        conn = self._make_one()
+        name = conn.create_queue()
+        bodies = [u'message %s' % i for i in range(10)]
+        keys = conn.post_messages(name, bodies)
+        checkpoints = CheckpointStore(every=1)
+        messages = conn.iter_messages(name, page_size=4,
+            checkpoints=checkpoints)
+        self.assertEqual([messages.next()[u'body'] for i in range(3)],
+            bodies[:3])
+        messages.close()
+        # the third message wasn't asked past, so it isn't processed yet
+        self.assertEqual(checkpoints.get(name, 1), keys[1][2:])
+        messages = list(conn.iter_messages(name, page_size=4,
+            checkpoints=checkpoints))
+        self.assertEqual([m[u'body'] for m in messages], bodies[2:])
+        self.assertEqual(checkpoints.get(name, 1), keys[9][2:])
+        self.assertEqual(list(conn.iter_messages(name,
+            checkpoints=checkpoints)), [])
+
+    def test_merge_messages_checkpoints(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=2)
+        bodies = [(i % 2 + 1, u'message %s' % i) for i in range(10)]
+        keys = self._post_partitions(conn, name, bodies)
+        checkpoints = CheckpointStore()
+        messages = list(conn.merge_messages(name, checkpoints=checkpoints))
+        self.assertEqual(len(messages), 10)
+        self.assertEqual(checkpoints.cursors(name, [1, 2]),
+            {1: keys[8][2:], 2: keys[9][2:]})
+        self._post_partitions(conn, name, [(2, u'new')])
+        messages = list(conn.merge_messages(name, checkpoints=checkpoints))
+        self.assertEqual([m[u'body'] for m in messages], [u'new'])
+
+    def test_merge_messages_dedup(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=2)
+        self._post_partitions(conn, name, [(1, u'a'), (2, u'b')])
+        dedup = Deduplicator()
+        messages = list(conn.merge_messages(name, dedup=dedup))
+        self.assertEqual([m[u'body'] for m in messages], [u'a', u'b'])
+        # reading again only delivers duplicates
+        self.assertEqual(list(conn.merge_messages(name, dedup=dedup)), [])
+        self.assertEqual(dedup.stats(),
+            {u'checked': 4, u'duplicates': 2, u'hit_rate': 0.5})
+
+    def test_poll_scheduler(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=2)
+        self._post_partitions(conn, name,
+            [(1, u'a1'), (1, u'b1'), (1, u'c1'), (2, u'a2')])
+        scheduler = PollScheduler(min_delay=0.01, max_delay=0.05)
+        scheduler.add(name, 1)
+        scheduler.add(name, 2)
+        polls = scheduler.poll(conn, limit=2)
+        pages = [polls.next() for i in range(3)]
+        bodies = [(p, [m[u'body'] for m in messages])
+            for q, p, messages in pages]
+        self.assertEqual(sorted(bodies),
+            [(1, [u'a1', u'b1']), (1, [u'c1']), (2, [u'a2'])])
+        self._post_partitions(conn, name, [(2, u'b2')])
+        q, p, messages = polls.next()
+        self.assertEqual((p, [m[u'body'] for m in messages]), (2, [u'b2']))
+        polls.close()
+        self.assertEqual(scheduler.stats()[u'full'], 1)
+
+    def test_multi_queue_poller(self):
+        conn = self._make_one()
+        names = [conn.create_queue() for i in range(3)]
+        for name in names:
+            conn.post_messages(name, [u'%s %s' % (name, i) for i in range(5)])
+        expected = sorted([u'%s %s' % (n, i) for n in names for i in range(5)])
+        bodies = []
+        with MultiQueuePoller(conn, limit=2, workers=2) as poller:
+            for name in names:
+                poller.subscribe(name)
+            for queue_name, partition, messages in poller:
+                bodies.extend([m[u'body'] for m in messages])
+                if len(bodies) >= len(expected):
+                    break
+        self.assertEqual(sorted(bodies), expected)
+        stats = poller.stats()
+        self.assertEqual(stats[u'errors'], 0)
+        self.assertEqual(stats[u'partitions'][(names[0], 1)][u'messages'], 5)
+
+    def test_consumer(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=3)
+        bodies = [(i % 3 + 1, u'message %s' % i) for i in range(60)]
+        keys = self._post_partitions(conn, name, bodies)
+        handled = []
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def handler(message):
+            time.sleep(0.001)
+            with lock:
+                handled.append((message[u'partition'], message[u'body']))
+                if len(handled) == len(bodies):
+                    done.set()
+
+        checkpoints = CheckpointStore()
+        consumer = Consumer(conn, name, handler, page_size=7,
+            buffer_size=5, poll_interval=0.05, checkpoints=checkpoints)
+        with consumer:
+            done.wait(5)
+        for p in (1, 2, 3):
+            self.assertEqual([b for q, b in handled if q == p],
+                [b for q, b in bodies if q == p])
+        self.assertEqual(checkpoints.cursors(name, [1, 2, 3]),
+            {1: keys[57][2:], 2: keys[58][2:], 3: keys[59][2:]})
+        stats = consumer.stats()
+        self.assertEqual(stats[u'partitions'][1][u'handled'], 20)
+
+    def test_consumer_error(self):
+        conn = self._make_one()
+        name = conn.create_queue()
+        keys = conn.post_messages(name, [u'a', u'b', u'fail', u'c'])
+
+        def handler(message):
+            if message[u'body'] == u'fail':
+                raise ValueError(message[u'body'])
+
+        checkpoints = CheckpointStore()
+        consumer = Consumer(conn, name, handler, checkpoints=checkpoints)
+        consumer.start()
+        self.assertRaises(ValueError, consumer.wait, 5)
+        consumer.close()
+        self.assertEqual(checkpoints.get(name, 1), keys[1][2:])
+
+    def test_consumer_assign(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=3)
+        bodies = [(i % 3 + 1, u'message %s' % i) for i in range(6)]
+        keys = self._post_partitions(conn, name, bodies)
+        handled = []
+
+        def handler(message):
+            handled.append(message[u'partition'])
+
+        checkpoints = CheckpointStore()
+        consumers = ConsumerSet(conn, handler, poll_interval=0.05,
+            checkpoints=checkpoints)
+        consumers.assign({name: [1, 2]})
+        consumer = consumers.consumers[name]
+        kept = consumer.partitions[1]
+        for i in range(100):
+            if len(handled) == 4:
+                break
+            time.sleep(0.05)
+        consumers.assign({name: (3, 2)})
+        # the consumer and the kept partition keep running
+        self.assertTrue(consumers.consumers[name] is consumer)
+        self.assertEqual([p.number for p in consumer.partitions], [2, 3])
+        self.assertTrue(consumer.partitions[0] is kept)
+        self.assertTrue(kept.thread.is_alive())
+        self.assertEqual(checkpoints.get(name, 1), keys[3][2:])
+        for i in range(100):
+            if len(handled) == 6:
+                break
+            time.sleep(0.05)
+        consumers.close()
+        self.assertEqual(consumers.consumers, {})
+        self.assertEqual(sorted(handled), [1, 1, 2, 2, 3, 3])
+
+    def test_consumer_reassign_dedup(self):
+        conn = self._make_one()
+        name = conn.create_queue()
+        bodies = [u'message %s' % i for i in range(20)]
+        conn.post_messages(name, bodies)
+        handled = []
+        gate = threading.Event()
+
+        def handler(message):
+            gate.wait(5)
+            handled.append(message[u'body'])
+
+        consumer = Consumer(conn, name, handler, poll_interval=0.05,
+            checkpoints=CheckpointStore(), dedup=Deduplicator())
+        consumer.start()
+        for i in range(100):
+            if consumer.stats()[u'partitions'][1][u'fetched'] == 20:
+                break
+            time.sleep(0.05)
+        threading.Timer(0.1, gate.set).start()
+        # drops the buffered messages, which are fetched again
+        consumer.assign([])
+        consumer.assign([1])
+        for i in range(100):
+            if len(handled) == 20:
+                break
+            time.sleep(0.05)
+        consumer.close()
+        self.assertEqual(handled, bodies)
+
+    def test_process_runner(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=4)
+        bodies = [(i % 4 + 1, u'message %s' % i) for i in range(20)]
+        keys = self._post_partitions(conn, name, bodies)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, u'checkpoints.db')
+        results = multiprocessing.Queue()
+
+        def handler(message):
+            results.put((os.getpid(), message[u'body']))
+
+        def checkpoints():
+            return CheckpointStore(SQLiteBackend(path), every=1)
+
+        def wait_committed(handled_keys):
+            # killed workers may not have committed their last message
+            store = checkpoints()
+            expected = dict((int(k.split(u':')[0]), k.split(u':')[1])
+                for k in handled_keys)
+            for i in range(100):
+                if store.cursors(name, expected.keys()) == expected:
+                    break
+                time.sleep(0.05)
+            store.close()
+
+        runner = ProcessRunner(self.queuey_app_key, conn.app_url,
+            {name: None}, handler, processes=2, checkpoints=checkpoints,
+            consumer_options={u'poll_interval': 0.05})
+        try:
+            runner.start()
+            self.assertEqual(runner.assignments,
+                {0: {name: [1, 3]}, 1: {name: [2, 4]}})
+            handled = [results.get(timeout=10) for b in bodies]
+            self.assertEqual(sorted([b for pid, b in handled]),
+                sorted([b for p, b in bodies]))
+            self.assertEqual(set([pid for pid, b in handled]),
+                set(runner.pids()))
+            wait_committed(keys[-4:])
+            # kill a worker, a new one takes over its partitions
+            os.kill(runner.pids()[0], 9)
+            runner._workers[0].join(5)
+            self.assertEqual(runner.check(), 1)
+            self.assertEqual(runner.restarts, 1)
+            new_keys = self._post_partitions(conn, name,
+                [(1, u'new 1'), (2, u'new 2')])
+            handled = [results.get(timeout=10) for i in range(2)]
+            self.assertEqual(sorted([b for pid, b in handled]),
+                [u'new 1', u'new 2'])
+            wait_committed(new_keys)
+            # without respawning, the other worker takes over
+            runner.respawn = False
+            os.kill(runner.pids()[0], 9)
+            runner._workers[0].join(5)
+            runner.check()
+            self.assertEqual(runner.assignments, {1: {name: [1, 2, 3, 4]}})
+            self._post_partitions(conn, name, [(3, u'new 3')])
+            self.assertEqual(results.get(timeout=10),
+                (runner.pids()[0], u'new 3'))
+        finally:
+            runner.close()
+            shutil.rmtree(directory)
+
+    def test_lease_consumers(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=4)
+        bodies = [(i % 4 + 1, u'message %s' % i) for i in range(20)]
+        self._post_partitions(conn, name, bodies)
+        backend = MemoryLeaseBackend()
+        store = CheckpointStore(every=1)
+        partitions = [(name, p) for p in range(1, 5)]
+        handled = []
+        lock = threading.Lock()
+
+        def make_handler(member):
+            def handler(message):
+                with lock:
+                    handled.append(message[u'message_id'])
+            return handler
+
+        nodes = []
+        for member in (u'a', u'b'):
+            consumers = ConsumerSet(conn, make_handler(member),
+                poll_interval=0.05, checkpoints=store)
+            manager = LeaseManager(backend, partitions, member=member,
+                on_change=consumers.assign)
+            nodes.append((manager, consumers))
+        for i in range(2):
+            for manager, consumers in nodes:
+                manager.tick()
+        for i in range(50):
+            if len(handled) >= len(bodies):
+                break
+            time.sleep(0.05)
+        self.assertEqual([m.assignment() for m, c in nodes],
+            [{name: [1, 3]}, {name: [2, 4]}])
+        for manager, consumers in nodes:
+            manager.close()
+            consumers.close()
+        # partitions are handed over at their checkpoints
+        self.assertEqual(len(handled), len(bodies))
+        self.assertEqual(len(set(handled)), len(bodies))
+
+    def test_queue_partitions(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=4)
+        self.assertEqual(conn.queue_partitions(name), 4)
+        self.assertRaises(ValueError, conn.queue_partitions,
+            uuid.uuid4().hex)
+        names = sorted([conn.create_queue(partitions=p) for p in (1, 2, 3)])
+        with mock.patch.object(conn, u'get', wraps=conn.get) as get_mock:
+            self.assertEqual(conn.queue_partitions(names[-1], page_size=1),
+                conn.queue_partitions(names[-1]))
+            self.assertTrue(len(get_mock.mock_calls) > 2)
+        self.assertRaises(ValueError, conn.queue_partitions,
+            u'~', page_size=2)
+
+    def test_merge_messages(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=3)
+        bodies = [(i % 3 + 1, u'message %s' % i) for i in range(50)]
+        keys = self._post_partitions(conn, name, bodies)
+        messages = list(conn.merge_messages(name, page_size=7))
+        self.assertEqual([m[u'body'] for m in messages],
+            [b for p, b in bodies])
+        cursors = {1: keys[45], 2: keys[46]}
+        messages = list(conn.merge_messages(name, partitions=[1, 2],
+            cursors=cursors))
+        self.assertEqual([m[u'body'] for m in messages],
+            [u'message 48', u'message 49'])
+
+    def _post_partitions(self, conn, name, bodies):
+        messages = [{u'body': b, u'partition': p} for p, b in bodies]
+        response = conn.post(name, data=ujson.encode({u'messages': messages}),
+            headers={u'content-type': u'application/json'})
+        return [m[u'key'] for m in ujson.decode(response.text)[u'messages']]
+
+    def test_partition_messages(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=3)
+        self._post_partitions(conn, name,
+            [(1, u'a1'), (2, u'a2'), (1, u'b1'), (3, u'a3')])
+        result, cursors = conn.partition_messages(name,
+            {1: None, 2: None, 3: None})
+        bodies = dict((p, [m[u'body'] for m in messages])
+            for p, messages in result.items())
+        self.assertEqual(bodies, {1: [u'a1', u'b1'], 2: [u'a2'], 3: [u'a3']})
+        self.assertEqual(cursors[3], result[3][-1][u'message_id'])
+        self._post_partitions(conn, name, [(2, u'b2'), (1, u'c1')])
+        result, cursors = conn.partition_messages(name, cursors)
+        bodies = dict((p, [m[u'body'] for m in messages])
+            for p, messages in result.items())
+        self.assertEqual(bodies, {1: [u'c1'], 2: [u'b2'], 3: []})
+        result, cursors = conn.partition_messages(name, cursors)
+        self.assertEqual(result, {1: [], 2: [], 3: []})
+
+    def test_partition_messages_cursors(self):
+        conn = self._make_one()
+        name = conn.create_queue(partitions=2)
+        keys = self._post_partitions(conn, name,
+            [(1, u'a1'), (2, u'a2'), (1, u'b1'), (2, u'b2')])
+        # partition 2 is further ahead than partition 1
+        result, cursors = conn.partition_messages(name,
+            {1: keys[0], 2: keys[3]}, limit=2)
+        self.assertEqual([m[u'body'] for m in result[1]], [u'b1'])
+        self.assertEqual(result[2], [])
+        result, cursors = conn.partition_messages(name, cursors)
+        self.assertEqual(result, {1: [], 2: []})
+
+    def test_partition_messages_uneven(self):
+        conn = self._make_one()
+        stored = dict((p, []) for p in (1, 2, 3))
+        for i in range(60):
+            # partition 1 fills up fastest, partition 3 slowest
+            p = i % 6 < 3 and 1 or i % 6 < 5 and 2 or 3
+            stored[p].append({u'message_id': uuid.uuid1().hex,
+                u'partition': p, u'body': u'%s' % i})
+
+        def fetch(queue_name, partitions, since, limit, order):
+            # applies the limit per partition, grouped by partition
+            page = []
+            for p in partitions:
+                page.extend([m for m in stored[p] if not since or
+                    message_time(m[u'message_id']) >=
+                    message_time(since)][:limit])
+            return page
+
+        received = dict((p, []) for p in stored)
+        cursors = {1: None, 2: None, 3: None}
+        with mock.patch.object(conn, u'_fetch') as fetch_mock:
+            fetch_mock.side_effect = fetch
+            for i in range(30):
+                result, cursors = conn.partition_messages(u'queue', cursors,
+                    limit=7)
+                for p, messages in result.items():
+                    received[p].extend(messages)
+        self.assertEqual(received, stored)
+
     def test_messages_error(self):
         conn = self._make_one()
         name = conn.create_queue()
@@ -270,3 +1153,862 @@ class TestQueueyConnection(unittest.TestCase):
             self.assertTrue(u'order' in messages, messages)
         else:
             self.fail(u'HTTPError not raised')
+
+
+class TestDecode(unittest.TestCase):
+
+    def test_decode(self):
+        response = Response()
+        response._content = u'{"body": "gr\xfc\xdf"}'.encode('utf-8')
+        response._content_consumed = True
+        with mock.patch(u'requests.models.Response.text') as text_mock:
+            self.assertEqual(_decode(response), {u'body': u'gr\xfc\xdf'})
+            self.assertEqual(text_mock.mock_calls, [])
+
+
+class TestMessageTime(unittest.TestCase):
+
+    def test_message_time(self):
+        first = uuid.uuid1()
+        second = uuid.uuid1()
+        self.assertEqual(message_time(first.hex), first.time)
+        self.assertEqual(message_time(u'2:' + first.hex), first.time)
+        self.assertTrue(message_time(first.hex) < message_time(second.hex))
+
+
+class TestHashPartition(unittest.TestCase):
+
+    def test_range(self):
+        keys = [u'key-%s' % i for i in range(1000)]
+        partitions = [hash_partition(k, 8) for k in keys]
+        self.assertEqual(sorted(set(partitions)), range(1, 9))
+        self.assertEqual(partitions, [hash_partition(k, 8) for k in keys])
+        self.assertEqual(hash_partition(u'gr\xfc\xdf', 8),
+            hash_partition(u'gr\xfc\xdf'.encode('utf-8'), 8))
+        self.assertEqual(hash_partition(u'key', 1), 1)
+
+    def test_grow(self):
+        keys = [u'key-%s' % i for i in range(1000)]
+        moved = [k for k in keys if
+            hash_partition(k, 8) != hash_partition(k, 9)]
+        # only keys moving to the new partition change
+        self.assertTrue(50 < len(moved) < 200, len(moved))
+        self.assertEqual(set([hash_partition(k, 9) for k in moved]),
+            set([9]))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(0.5), None)
+        values = [i / 1000.0 for i in range(1, 1001)]
+        for value in reversed(values):
+            histogram.record(value)
+        for fraction in (0.01, 0.5, 0.95, 0.99):
+            expected = values[int(len(values) * fraction) - 1]
+            estimate = histogram.percentile(fraction)
+            self.assertTrue(abs(estimate - expected) <= expected / 32.0,
+                (fraction, estimate, expected))
+        self.assertEqual(histogram.percentile(1.0), 1.0)
+        stats = histogram.stats()
+        self.assertEqual(stats[u'count'], 1000)
+        self.assertAlmostEqual(stats[u'mean'], 0.5005)
+
+    def test_histogram_zero(self):
+        histogram = LatencyHistogram()
+        histogram.record(0.0)
+        histogram.record(0.0)
+        self.assertEqual(histogram.percentile(0.5), 0.0)
+
+    def test_collector(self):
+        collector = MetricsCollector()
+        collector.after_response(u'a', u'get', None, 0.1, 0, 100)
+        collector.after_response(u'b', u'post', None, 0.2, 50, 10)
+        collector.on_error(u'a', u'get', Timeout(), 5.0)
+        collector.on_retry(u'get', 1, Timeout())
+        collector.on_fallback(u'get', u'a', u'b', ConnectionError())
+        stats = collector.stats()
+        self.assertEqual([stats[k] for k in (u'requests', u'errors',
+            u'retries', u'fallbacks', u'bytes_sent', u'bytes_received')],
+            [3, 1, 1, 1, 50, 110])
+        self.assertEqual(sorted(stats[u'methods']), [u'get', u'post'])
+        self.assertEqual(stats[u'servers'][u'a'][u'max'], 0.1)
+        collector.reset()
+        self.assertEqual(collector.stats()[u'requests'], 0)
+
+
+class TestPrefetcher(unittest.TestCase):
+
+    def test_pages(self):
+        pages = [[1, 2], [3], [4, 5, 6]]
+        self.assertEqual(list(Prefetcher(iter(pages), size=2)), pages)
+
+    def test_error(self):
+        def pages():
+            yield [1]
+            raise ValueError(u'fetch failed')
+        prefetcher = iter(Prefetcher(pages()))
+        self.assertEqual(prefetcher.next(), [1])
+        self.assertRaises(ValueError, prefetcher.next)
+
+    def test_bounded(self):
+        fetched = []
+
+        def pages():
+            for i in range(10):
+                fetched.append(i)
+                yield [i]
+        prefetcher = Prefetcher(pages(), size=2)
+        pages = iter(prefetcher)
+        self.assertEqual(pages.next(), [0])
+        time.sleep(0.2)
+        # two pages queued, one more waiting to be queued
+        self.assertEqual(len(fetched), 4)
+        pages.close()
+        prefetcher.thread.join(1)
+        self.assertFalse(prefetcher.thread.is_alive())
+
+
+class TestCheckpointStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_coalesce(self):
+        backend = MemoryBackend()
+        store = CheckpointStore(backend, every=3, interval=60)
+        ids = [uuid.uuid1().hex for i in range(4)]
+        for message_id in ids[:2]:
+            store.update(u'queue1', 1, message_id)
+        self.assertEqual(backend.checkpoints, {})
+        self.assertEqual(store.get(u'queue1', 1), ids[1])
+        store.update(u'queue1', 2, u'2:' + ids[2])
+        self.assertEqual(backend.checkpoints,
+            {(u'queue1', 1): ids[1], (u'queue1', 2): ids[2]})
+        store.update(u'queue1', 1, ids[3])
+        store.close()
+        self.assertEqual(backend.checkpoints[(u'queue1', 1)], ids[3])
+        self.assertEqual(store.stats(),
+            {u'updates': 4, u'commits': 2, u'pending': 0})
+
+    def test_interval(self):
+        backend = MemoryBackend()
+        store = CheckpointStore(backend, every=100, interval=0)
+        message_id = uuid.uuid1().hex
+        store.update(u'queue1', 1, message_id)
+        self.assertEqual(backend.checkpoints, {(u'queue1', 1): message_id})
+
+    def _check_backend(self, make_backend):
+        ids = [uuid.uuid1().hex for i in range(5)]
+        store = CheckpointStore(make_backend(), every=1)
+        for i, message_id in enumerate(ids):
+            store.update(u'queue%s' % i, i + 1, message_id)
+        store.update(u'gr\xfc\xdf', 1, ids[0])
+        store.update(u'queue0', 1, ids[4])
+        store.close()
+        store = CheckpointStore(make_backend())
+        self.assertEqual(store.get(u'queue0', 1), ids[4])
+        self.assertEqual(store.get(u'queue3', 4), ids[3])
+        self.assertEqual(store.get(u'gr\xfc\xdf', 1), ids[0])
+        self.assertEqual(store.get(u'queue3', 1), None)
+        store.close()
+
+    def test_file_backend(self):
+        path = os.path.join(self.directory, u'checkpoints')
+        self._check_backend(lambda: FileBackend(path, slots=2))
+        self.assertEqual(os.path.getsize(path) % 148, 0)
+        backend = FileBackend(path)
+        self.assertRaises(ValueError, backend.save,
+            {(u'x' * 128, 1): uuid.uuid1().hex})
+        backend.close()
+
+    def test_sqlite_backend(self):
+        path = os.path.join(self.directory, u'checkpoints.db')
+        self._check_backend(lambda: SQLiteBackend(path))
+
+
+class TestDedup(unittest.TestCase):
+
+    def test_lru(self):
+        seen = LRUSet(size=3)
+        self.assertEqual([seen.add(k) for k in u'abca'],
+            [False, False, False, True])
+        # b is the least recently seen key
+        self.assertFalse(seen.add(u'd'))
+        self.assertEqual(len(seen), 3)
+        self.assertFalse(seen.add(u'b'))
+        self.assertTrue(seen.add(u'a'))
+        for i in range(100):
+            seen.add(u'a')
+        self.assertTrue(len(seen._order) <= 6)
+
+    def test_bloom(self):
+        seen = ScalableBloomFilter(capacity=1000, error_rate=0.01)
+        keys = [uuid.uuid1().hex for i in range(5000)]
+        self.assertTrue(len([k for k in keys if seen.add(k)]) < 50)
+        self.assertEqual(len(seen.filters), 3)
+        self.assertTrue(all([seen.add(k) for k in keys]))
+        others = [uuid.uuid4().hex for i in range(5000)]
+        false_positives = len([k for k in others if seen.add(k)])
+        self.assertTrue(false_positives < 100, false_positives)
+
+    def test_bloom_max_bytes(self):
+        seen = ScalableBloomFilter(capacity=100, error_rate=0.01,
+            max_bytes=1000)
+        keys = [uuid.uuid1().hex for i in range(2000)]
+        for key in keys:
+            seen.add(key)
+        self.assertTrue(seen.nbytes <= 1000, seen.nbytes)
+        # the oldest keys have been forgotten
+        self.assertFalse(seen.add(keys[0]))
+        self.assertTrue(seen.add(keys[-1]))
+
+    def test_filter(self):
+        dedup = Deduplicator()
+        messages = [{u'message_id': k} for k in u'abab']
+        self.assertEqual(list(dedup.filter(messages)), messages[:2])
+        self.assertEqual(dedup.stats()[u'hit_rate'], 0.5)
+
+
+class TestPollScheduler(unittest.TestCase):
+
+    def test_backoff(self):
+        scheduler = PollScheduler(min_delay=0.01, max_delay=0.05)
+        scheduler.add(u'queue1')
+        delays = []
+        for i in range(5):
+            self.assertEqual(scheduler.wait(1), (u'queue1', 1, None))
+            scheduler.record(u'queue1', 1, [], 10)
+            delays.append(scheduler.subscriptions[(u'queue1', 1)].delay)
+        self.assertEqual(delays, [0.01, 0.02, 0.04, 0.05, 0.05])
+        self.assertEqual(scheduler.wait(0), None)
+
+    def test_full(self):
+        scheduler = PollScheduler(min_delay=10)
+        scheduler.add(u'queue1')
+        scheduler.wait(0)
+        messages = [{u'message_id': u'a'}, {u'message_id': u'b'}]
+        scheduler.record(u'queue1', 1, messages, 2)
+        # polled again right away, after the last message
+        self.assertEqual(scheduler.wait(0), (u'queue1', 1, u'b'))
+        scheduler.record(u'queue1', 1, messages[:1], 2)
+        self.assertEqual(scheduler.wait(0.01), None)
+        self.assertEqual(scheduler.subscriptions[(u'queue1', 1)].delay, 10)
+
+    def test_remove(self):
+        scheduler = PollScheduler()
+        scheduler.add(u'queue1')
+        scheduler.add(u'queue1', 2)
+        scheduler.remove(u'queue1')
+        self.assertEqual(scheduler.wait(0), (u'queue1', 2, None))
+        self.assertEqual(scheduler.wait(0), None)
+
+    def test_skip(self):
+        scheduler = PollScheduler(min_delay=10)
+        scheduler.add(u'queue1')
+        scheduler.add(u'queue1', 2)
+        self.assertEqual(scheduler.wait(0), (u'queue1', 1, None))
+        self.assertTrue(scheduler.due())
+        # queued behind the due partition, without a delay
+        scheduler.skip(u'queue1', 1, delay=10)
+        self.assertEqual(scheduler.wait(0), (u'queue1', 2, None))
+        self.assertEqual(scheduler.wait(0), (u'queue1', 1, None))
+        self.assertFalse(scheduler.due())
+        scheduler.record(u'queue1', 2, [], 10)
+        scheduler.skip(u'queue1', 1, delay=0.05)
+        self.assertEqual(scheduler.wait(0.01), None)
+        self.assertEqual(scheduler.wait(0.5), (u'queue1', 1, None))
+        self.assertEqual(scheduler.stats()[u'polls'], 2)
+
+    def test_max_rate(self):
+        scheduler = PollScheduler(max_rate=20)
+        for i in range(30):
+            scheduler.add(u'queue%s' % i)
+        start = time.time()
+        for i in range(30):
+            self.assertNotEqual(scheduler.wait(1), None)
+        duration = time.time() - start
+        self.assertTrue(0.4 < duration < 0.8, duration)
+        self.assertEqual(scheduler.stats()[u'throttled'], 10)
+
+
+class FakeClient(object):
+
+    pool_maxsize = 1
+    connection = [u'https://127.0.0.1:5001/v1/queuey/']
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def messages(self, queue_name, partition=1, since=None, limit=100):
+        # queues never run out of messages
+        return [{u'message_id': uuid.uuid1().hex,
+            u'body': u'x' * self.sizes[queue_name]} for i in range(limit)]
+
+
+class TestMultiQueuePoller(unittest.TestCase):
+
+    def _poll(self, poller, until):
+        counts = {u'a': 0, u'b': 0}
+        done = threading.Event()
+
+        def callback(queue_name, partition, messages):
+            counts[queue_name] += len(messages)
+            if counts[until] >= 1000:
+                done.set()
+
+        poller.start(callback)
+        done.wait(5)
+        poller.close()
+        return counts
+
+    def test_round_robin(self):
+        poller = MultiQueuePoller(FakeClient({u'a': 10, u'b': 10}),
+            scheduling=u'round_robin', limit=10)
+        poller.subscribe(u'a', weight=1)
+        poller.subscribe(u'b', weight=3)
+        counts = self._poll(poller, u'b')
+        ratio = counts[u'b'] / float(counts[u'a'])
+        self.assertTrue(2.5 < ratio < 3.5, counts)
+
+    def test_deficit(self):
+        poller = MultiQueuePoller(FakeClient({u'a': 1000, u'b': 10}),
+            limit=10, quantum=5000)
+        poller.subscribe(u'a')
+        poller.subscribe(u'b')
+        counts = self._poll(poller, u'b')
+        # a's pages cost twice its quantum, so it gets every other turn
+        ratio = counts[u'b'] / float(counts[u'a'])
+        self.assertTrue(1.8 < ratio < 2.6, counts)
+
+    def test_deficit_weights(self):
+        for size in (10, 1000):
+            poller = MultiQueuePoller(FakeClient({u'a': size, u'b': size}),
+                limit=10, quantum=5000)
+            poller.subscribe(u'a', weight=1)
+            poller.subscribe(u'b', weight=3)
+            counts = self._poll(poller, u'b')
+            ratio = counts[u'b'] / float(counts[u'a'])
+            self.assertTrue(2.5 < ratio < 3.5, (size, counts))
+
+    def test_deficit_alone(self):
+        scheduler = PollScheduler()
+        skipped = []
+        scheduler.skip = lambda *args, **kw: skipped.append(args)
+        poller = MultiQueuePoller(FakeClient({u'a': 1000}), limit=10,
+            quantum=5000, scheduler=scheduler)
+        poller.subscribe(u'a')
+        counts = self._poll(poller, u'a')
+        # with no other partition to take turns with, a isn't held back
+        self.assertTrue(counts[u'a'] >= 1000, counts)
+        self.assertEqual(skipped, [])
+
+    def test_errors(self):
+        client = FakeClient({})
+        poller = MultiQueuePoller(client)
+        self.assertRaises(ValueError, MultiQueuePoller, client,
+            scheduling=u'unknown')
+        poller.scheduler.min_delay = 10
+        poller.subscribe(u'a')
+        poller.start(lambda *args: None)
+        time.sleep(0.1)
+        poller.close()
+        self.assertEqual(poller.stats()[u'errors'], 1)
+        self.assertEqual(poller.scheduler.stats()[u'empty'], 1)
+
+
+class TestLease(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _check_backend(self, backend):
+        self.assertTrue(backend.acquire(u'q:1', u'a', 10))
+        self.assertFalse(backend.acquire(u'q:1', u'b', 10))
+        self.assertTrue(backend.acquire(u'q:1', u'a', 10))
+        backend.release(u'q:1', u'b')
+        self.assertFalse(backend.acquire(u'q:1', u'b', 10))
+        backend.release(u'q:1', u'a')
+        self.assertTrue(backend.acquire(u'q:1', u'b', 0))
+        # expired
+        self.assertTrue(backend.acquire(u'q:1', u'a', 10))
+        backend.heartbeat(u'b', 10)
+        backend.heartbeat(u'a', 10)
+        backend.heartbeat(u'c', -1)
+        self.assertEqual(backend.members(), [u'a', u'b'])
+        backend.leave(u'a')
+        self.assertEqual(backend.members(), [u'b'])
+        self.assertTrue(backend.acquire(u'q:1', u'b', 10))
+
+    def test_memory_backend(self):
+        self._check_backend(MemoryLeaseBackend())
+
+    def test_file_backend(self):
+        path = os.path.join(self.directory, u'leases')
+        self._check_backend(FileLeaseBackend(path))
+        self.assertEqual(FileLeaseBackend(path).members(), [u'b'])
+
+    def test_manager(self):
+        backend = FileLeaseBackend(os.path.join(self.directory, u'leases'))
+        partitions = [(u'q1', p) for p in (1, 2, 3)] + [(u'q2', 1)]
+        changes = []
+        a = LeaseManager(backend, partitions, member=u'a',
+            on_change=changes.append)
+        b = LeaseManager(backend, partitions, member=u'b')
+        a.tick()
+        self.assertEqual(changes, [{u'q1': [1, 2, 3], u'q2': [1]}])
+        b.tick()
+        # b's share is still held by a
+        self.assertEqual(b.owned, set())
+        a.tick()
+        self.assertEqual(changes[-1], {u'q1': [1, 3]})
+        b.tick()
+        self.assertEqual(b.assignment(), {u'q1': [2], u'q2': [1]})
+        a.close()
+        self.assertEqual(changes[-1], {})
+        b.tick()
+        self.assertEqual(b.owned, set(partitions))
+
+    def test_manager_expiry(self):
+        backend = MemoryLeaseBackend()
+        partitions = [(u'q1', p) for p in (1, 2)]
+        a = LeaseManager(backend, partitions, member=u'a', ttl=0.1)
+        b = LeaseManager(backend, partitions, member=u'b', ttl=0.1)
+        a.tick()
+        b.tick()
+        a.tick()
+        b.tick()
+        self.assertEqual((a.owned, b.owned),
+            (set([(u'q1', 1)]), set([(u'q1', 2)])))
+        # a stops renewing, b takes over after its leases expired
+        time.sleep(0.15)
+        b.tick()
+        self.assertEqual(b.owned, set(partitions))
+        # a notices it's too late and withdraws its partitions
+        a.tick()
+        self.assertEqual(a.owned, set())
+
+    def test_manager_slow_withdrawal(self):
+        backend = MemoryLeaseBackend()
+        partitions = [(u'q1', p) for p in range(1, 5)]
+        remaining = []
+
+        def on_change(assignment):
+            # time left on the leases kept while partitions are withdrawn
+            now = time.time()
+            remaining.append(dict((r, expires - now) for r, (owner, expires)
+                in backend._state[u'leases'].items() if owner == u'a'))
+            if len(remaining) == 2:
+                time.sleep(0.15)
+
+        a = LeaseManager(backend, partitions, member=u'a', ttl=0.2,
+            on_change=on_change)
+        a.tick()
+        time.sleep(0.1)
+        backend.heartbeat(u'b', 10)
+        a.tick()
+        self.assertTrue(remaining[1][u'q1:1'] > 0.15, remaining)
+        self.assertTrue(remaining[1][u'q1:3'] > 0.15, remaining)
+        self.assertEqual(a.assignment(), {u'q1': [1, 3]})
+        # the kept leases were renewed again after the withdrawal
+        self.assertFalse(backend.acquire(u'q1:1', u'b', 10))
+        self.assertTrue(backend.acquire(u'q1:2', u'b', 10))
+
+    def test_manager_thread(self):
+        backend = MemoryLeaseBackend()
+        partitions = [(u'q1', p) for p in range(1, 7)]
+        managers = [LeaseManager(backend, partitions, member=m, ttl=0.3)
+            for m in u'abc']
+        for manager in managers:
+            manager.start()
+        time.sleep(0.5)
+        owned = [m.owned for m in managers]
+        for manager in managers:
+            manager.close()
+        self.assertEqual([len(o) for o in owned], [2, 2, 2])
+        self.assertEqual(set.union(*owned), set(partitions))
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append(self):
+        spool = Spool(self.directory, segment_size=50)
+        self.assertFalse(spool.pending())
+        spool.append(u'queue1', [u'a', u'b'])
+        self.assertTrue(spool.pending())
+        self.assertEqual(len(spool.segments()), 1)
+        spool.append(u'queue1', [u'c' * 20])
+        spool.append(u'queue2', [u'd'])
+        self.assertEqual(len(spool.segments()), 2)
+        spool.close()
+        # a new spool picks up the existing segments
+        spool = Spool(self.directory)
+        self.assertTrue(spool.pending())
+        spool.append(u'queue2', [u'e'])
+        self.assertEqual(len(spool.segments()), 3)
+
+    def test_pending(self):
+        spool = Spool(self.directory, segment_size=10)
+        spool.append(u'queue1', [u'a'])
+        spool.append(u'queue1', [u'b'])
+        with mock.patch(u'os.listdir') as listdir_mock:
+            self.assertTrue(spool.pending())
+            self.assertFalse(listdir_mock.called)
+        client = mock.Mock()
+        client.post.return_value = mock.Mock(ok=True)
+        spool.replay(client)
+        self.assertFalse(spool.pending())
+        spool.close()
+        spool = Spool(self.directory)
+        self.assertFalse(spool.pending())
+
+    def test_replay(self):
+        spool = Spool(self.directory, segment_size=50)
+        spool.append(u'queue1', [u'a', u'b'])
+        spool.append(u'queue1', [u'c' * 20])
+        spool.append(u'queue2', [u'd'])
+        with open(spool.segments()[-1], 'ab') as segment:
+            segment.write('{"queue_name": "torn wr')
+        client = mock.Mock()
+        client.post.return_value = mock.Mock(ok=True)
+        self.assertEqual(spool.replay(client, batch_size=2), 4)
+        self.assertEqual([c[1] for c in client.post.mock_calls], [
+            (u'queue1', ), (u'queue1', ), (u'queue2', )])
+        self.assertEqual([c[2][u'data'] for c in client.post.mock_calls],
+            [[u'a', u'b'], [u'c' * 20], [u'd']])
+        self.assertFalse(spool.pending())
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_replay_error(self):
+        spool = Spool(self.directory)
+        spool.append(u'queue1', [u'a'])
+        client = mock.Mock()
+        client.post.side_effect = ConnectionError
+        self.assertRaises(ConnectionError, spool.replay, client)
+        self.assertTrue(spool.pending())
+
+    def test_replay_rejected(self):
+        spool = Spool(self.directory)
+        spool.append(u'deleted', [u'a', u'b'])
+        spool.append(u'queue1', [u'c'])
+        client = mock.Mock()
+        client.post.side_effect = lambda queue_name, data: mock.Mock(
+            ok=queue_name != u'deleted',
+            status_code=queue_name == u'deleted' and 404 or 201)
+        self.assertEqual(spool.replay(client), 1)
+        self.assertFalse(spool.pending())
+        self.assertEqual(spool.rejected, 2)
+        self.assertEqual(os.listdir(self.directory), [u'rejected.jsonl'])
+        with open(os.path.join(self.directory, u'rejected.jsonl')) as f:
+            self.assertEqual([ujson.decode(l) for l in f], [{
+                u'queue_name': u'deleted', u'bodies': [u'a', u'b'],
+                u'status': 404}])
+        # server errors and other refusals are retried later
+        spool.append(u'queue1', [u'd'])
+        client.post.side_effect = None
+        for status in (503, 401, 403, 408, 429):
+            client.post.return_value = mock.Mock(ok=False,
+                status_code=status)
+            self.assertRaises(HTTPError, spool.replay, client)
+            self.assertTrue(spool.pending())
+        self.assertEqual(spool.rejected, 2)
+
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_ratio(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=0.0, capacity=1.0)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        stats = budget.stats()
+        self.assertEqual(stats[u'requests'], 2)
+        self.assertEqual(stats[u'retries'], 2)
+        self.assertEqual(stats[u'exhausted'], 2)
+
+    def test_min_per_second(self):
+        budget = RetryBudget(ratio=0.0, min_per_second=20.0, capacity=1.0)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        time.sleep(0.1)
+        self.assertTrue(budget.withdraw())
+
+
+class TestServerPool(unittest.TestCase):
+
+    def test_wait(self):
+        pool = ServerPool(1)
+        pool.acquire()
+        self.assertEqual(pool.stats()[u'in_use'], 1)
+        thread = threading.Thread(target=pool.acquire)
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(pool.stats()[u'waiting'], 1)
+        pool.release()
+        thread.join()
+        stats = pool.stats()
+        self.assertEqual(stats[u'waiting'], 0)
+        self.assertEqual(stats[u'requests'], 2)
+        self.assertTrue(stats[u'max_wait'] >= 0.1, stats)
+
+    def test_connection(self):
+        pool = ServerPool(2)
+        with pool.connection():
+            self.assertEqual(pool.stats()[u'in_use'], 1)
+        self.assertEqual(pool.stats()[u'in_use'], 0)
+
+
+class TestServer(unittest.TestCase):
+
+    def test_parse_server(self):
+        self.assertEqual(parse_server(u' https://127.0.0.1:5001/v1/queuey/'),
+            (u'https://127.0.0.1:5001/v1/queuey/', 1.0))
+        self.assertEqual(parse_server(u'https://10.0.0.1/;weight=2.5'),
+            (u'https://10.0.0.1/', 2.5))
+        self.assertRaises(ValueError, parse_server,
+            u'https://10.0.0.1/;weight=0')
+
+    def test_score_prefers_local(self):
+        local = Server(u'https://127.0.0.1:5001/v1/queuey/')
+        remote = Server(u'https://10.0.0.1:5001/v1/queuey/')
+        self.assertTrue(local.local)
+        self.assertFalse(remote.local)
+        self.assertTrue(local.score() < remote.score())
+        local.record(0.2)
+        remote.record(0.1)
+        self.assertTrue(local.score() > remote.score())
+
+    def test_score_errors(self):
+        server = Server(u'https://10.0.0.1:5001/v1/queuey/')
+        server.record(0.1)
+        score = server.score()
+        server.record(error=True)
+        self.assertEqual(server.failures, 1)
+        self.assertTrue(server.error_rate > 0.0)
+        self.assertTrue(server.score() > score)
+
+    def test_percentile(self):
+        server = Server(u'https://10.0.0.1:5001/v1/queuey/')
+        for i in range(9):
+            server.record(0.01)
+        self.assertEqual(server.percentile(0.95), None)
+        for i in range(91):
+            server.record(i < 85 and 0.01 or 1.0)
+        self.assertEqual(server.percentile(0.5), 0.01)
+        self.assertEqual(server.percentile(0.95), 1.0)
+
+    def test_breaker(self):
+        server = Server(u'https://10.0.0.1:5001/v1/queuey/',
+            reset_timeout=0.1)
+        self.assertEqual(server.state, CLOSED)
+        self.assertFalse(server.probe_due())
+        server.mark_failure()
+        self.assertEqual(server.state, OPEN)
+        self.assertFalse(server.probe_due())
+        time.sleep(0.1)
+        self.assertTrue(server.probe_due())
+        self.assertEqual(server.state, HALF_OPEN)
+        # only a single probe at a time
+        self.assertFalse(server.probe_due())
+        server.mark_success()
+        self.assertEqual(server.state, CLOSED)
+
+    def test_score_weight(self):
+        server = Server(u'https://10.0.0.1:5001/v1/queuey/', weight=2.0)
+        server.record(0.1)
+        self.assertAlmostEqual(server.score(), 0.05)
+
+    def test_latency_decay(self):
+        server = Server(u'https://10.0.0.1:5001/v1/queuey/')
+        server.record(2.05)
+        # without new requests, the latency returns to the assumed one
+        server._latency_time -= 60
+        self.assertAlmostEqual(server.latency, 1.05, 4)
+        server.record(1.05)
+        self.assertAlmostEqual(server.latency, 1.05, 4)
+        server._latency_time -= 600
+        self.assertTrue(server.latency < 0.052, server.latency)
+
+    def test_rebalance_idle(self):
+        servers = [u'https://10.0.0.1:5001/v1/queuey/',
+                   u'https://10.0.0.2:5001/v1/queuey/']
+        conn = Client(u'key', connection=u','.join(servers))
+        conn.servers[servers[0]].record(2.0)
+        conn.servers[servers[1]].record(0.5)
+        conn._rebalance()
+        self.assertEqual(conn.app_url, servers[1])
+        # the slow server isn't out of rotation for good
+        conn.servers[servers[0]]._latency_time -= 600
+        conn._rebalance()
+        self.assertEqual(conn.app_url, servers[0])
+
+
+class TestAsyncClient(unittest.TestCase):
+
+    queuey_app_key = u'67e8107559e34fa48f91a746e775a751'
+
+    @classmethod
+    def setUpClass(cls):
+        setup_supervisor()
+        ensure_process(u'queuey')
+        ensure_process(u'nginx')
+
+    def _make_one(self, connection=u'https://127.0.0.1:5001/v1/queuey/'):
+        return AsyncClient(self.queuey_app_key, connection=connection)
+
+    def test_connect(self):
+        with self._make_one() as conn:
+            response = conn.connect().result()
+            self.assertEqual(response.status_code, 200)
+
+    def test_connect_multiple_first_unreachable(self):
+        with self._make_one(connection=u'https://127.0.0.1:9/,'
+                u'https://127.0.0.1:5002/v1/queuey/') as conn:
+            response = conn.connect().result()
+            self.assertEqual(response.status_code, 200)
+
+    def test_get_timeout(self):
+        with self._make_one() as conn:
+            with mock.patch(u'requests.sessions.Session.get') as get_mock:
+                get_mock.side_effect = Timeout
+                future = conn.get()
+                self.assertRaises(Timeout, future.result)
+                self.assertEqual(len(get_mock.mock_calls), conn.client.retries)
+
+    def test_messages(self):
+        with self._make_one() as conn:
+            name = conn.create_queue().result()
+            futures = [conn.post(name, data=u'Hello %s' % i)
+                for i in range(10)]
+            for f in futures:
+                self.assertEqual(f.result().status_code, 201)
+            messages = conn.messages(name).result()
+            bodies = set([m[u'body'] for m in messages])
+            self.assertEqual(bodies, set([u'Hello %s' % i for i in range(10)]))
+
+
+class TestProducer(unittest.TestCase):
+
+    queuey_app_key = u'67e8107559e34fa48f91a746e775a751'
+
+    @classmethod
+    def setUpClass(cls):
+        setup_supervisor()
+        ensure_process(u'queuey')
+        ensure_process(u'nginx')
+
+    def setUp(self):
+        self.client = Client(self.queuey_app_key)
+
+    def test_send(self):
+        name = self.client.create_queue()
+        with Producer(self.client, linger=0.01) as producer:
+            futures = [producer.send(name, u'Hello %s' % i) for i in range(5)]
+            keys = [f.result(timeout=5) for f in futures]
+        messages = self.client.messages(name)
+        self.assertEqual([m[u'body'] for m in messages],
+            [u'Hello %s' % i for i in range(5)])
+        self.assertEqual(keys,
+            [u'1:' + m[u'message_id'] for m in messages])
+
+    def test_send_key(self):
+        name = self.client.create_queue(partitions=3)
+        partition = self.client.partition_for(name, u'order-7')
+        with Producer(self.client, linger=0.01) as producer:
+            futures = [producer.send(name, u'Hello %s' % i, key=u'order-7')
+                for i in range(3)]
+            futures.append(producer.send(name, u'Bye', partition=2, ttl=60))
+            keys = [f.result(timeout=5) for f in futures]
+        self.assertEqual([k.split(u':')[0] for k in keys],
+            [unicode(partition)] * 3 + [u'2'])
+        messages = self.client.messages(name, partition=partition)
+        self.assertEqual([m[u'body'] for m in messages if
+            m[u'body'] != u'Bye'], [u'Hello %s' % i for i in range(3)])
+
+    def test_missing_keys(self):
+        client = mock.Mock()
+        client.post.return_value = mock.Mock(ok=True, content=ujson.encode(
+            {u'messages': [{u'key': u'1:a'}]}))
+        with Producer(client, max_messages=2, linger=60) as producer:
+            futures = [producer.send(u'queue1', u'a'),
+                producer.send(u'queue1', u'b')]
+            self.assertEqual(futures[0].result(timeout=5), u'1:a')
+            self.assertRaises(ValueError, futures[1].result, 5)
+
+    def test_max_messages(self):
+        name = self.client.create_queue()
+        producer = Producer(self.client, max_messages=3, linger=60)
+        with mock.patch.object(self.client, u'post',
+                wraps=self.client.post) as post_mock:
+            futures = [producer.send(name, u'Hello %s' % i) for i in range(7)]
+            for f in futures[:6]:
+                f.result(timeout=5)
+            self.assertFalse(futures[6].done())
+            producer.close()
+            self.assertTrue(futures[6].done())
+            self.assertEqual(len(post_mock.mock_calls), 3)
+
+    def test_max_bytes(self):
+        name = self.client.create_queue()
+        producer = Producer(self.client, max_bytes=10, linger=60)
+        with mock.patch.object(self.client, u'post',
+                wraps=self.client.post) as post_mock:
+            futures = [producer.send(name, u'\xfc' * 3) for i in range(3)]
+            producer.flush()
+            self.assertTrue(all([f.done() for f in futures]))
+            self.assertEqual([len(c[2][u'data']) for c in
+                post_mock.mock_calls], [1, 1, 1])
+        producer.close()
+        self.assertRaises(ValueError, producer.send, name, u'closed')
+
+    def test_error(self):
+        producer = Producer(self.client, linger=0.01)
+        future = producer.send(uuid.uuid4().hex, u'no such queue')
+        self.assertRaises(HTTPError, future.result, 5)
+        producer.close()
+
+    def test_spool(self):
+        name = self.client.create_queue()
+        directory = tempfile.mkdtemp()
+        try:
+            spool = Spool(directory)
+            unreachable = Client(self.queuey_app_key,
+                connection=u'https://127.0.0.1:9/')
+            producer = Producer(unreachable, linger=0.01, spool=spool)
+            futures = [producer.send(name, u'Hello %s' % i) for i in range(3)]
+            self.assertEqual([f.result(5) for f in futures], [None] * 3)
+            producer.close()
+            self.assertTrue(spool.pending())
+            self.assertEqual(spool.replay(self.client), 3)
+            self.assertFalse(spool.pending())
+        finally:
+            shutil.rmtree(directory)
+        messages = self.client.messages(name)
+        self.assertEqual([m[u'body'] for m in messages],
+            [u'Hello %s' % i for i in range(3)])
+
+    def test_spool_error(self):
+        spool = mock.Mock()
+        spool.pending.return_value = True
+        spool.append.side_effect = IOError(u'No space left on device')
+        producer = Producer(self.client, linger=0.01, spool=spool)
+        for i in range(2):
+            future = producer.send(u'queue', u'Hello %s' % i)
+            self.assertRaises(IOError, future.result, 5)
+        producer.close()